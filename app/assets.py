@@ -0,0 +1,221 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response, StreamingResponse
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Адрес с отпечатком содержимого никогда не меняется - кэшируем навсегда
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Адрес без отпечатка - каждый раз проверяем ETag
+REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+@dataclass
+class Asset:
+    content_type: str
+    etag: str
+    # Кодировка ("identity", "gzip", "br") -> тело
+    bodies: Dict[str, bytes]
+
+
+def _compress(content: bytes, content_type: str) -> Dict[str, bytes]:
+    bodies = {"identity": content}
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return bodies
+    # Сжатые варианты храним только если они действительно меньше
+    gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+    if len(gzipped) < len(content):
+        bodies["gzip"] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(content, quality=11)
+        if len(compressed) < len(content):
+            bodies["br"] = compressed
+    return bodies
+
+
+def _choose_encoding(asset: Asset, accept_encoding: str) -> str:
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in asset.bodies and encoding in accepted:
+            return encoding
+    return "identity"
+
+
+def _asset_response(asset: Asset, request_headers: Headers, cache_control: str, method: str) -> Response:
+    encoding = _choose_encoding(asset, request_headers.get("accept-encoding", ""))
+    # У каждого сжатого варианта свой ETag
+    etag = asset.etag if encoding == "identity" else f'{asset.etag[:-1]}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if etag in request_headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    body = asset.bodies[encoding]
+    if method == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        body = b""
+    return Response(body, media_type=asset.content_type, headers=headers)
+
+
+# Статика с отпечатками: /static/css/style.css -> /static/css/style.<hash>.css.
+# Отпечатки и сжатые варианты строятся один раз при запуске
+class AssetManifest:
+    def __init__(self, directory: str):
+        self.directory = directory
+        # Исходный путь (css/style.css) -> путь с отпечатком (css/style.0123abcd4567.css)
+        self.urls: Dict[str, str] = {}
+        self.assets: Dict[str, Asset] = {}
+        self.pages: Dict[str, Asset] = {}
+
+    def build(self):
+        for root, _, files in os.walk(self.directory):
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                relative_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                if name.endswith(".html"):
+                    continue
+                with open(full_path, "rb") as file:
+                    content = file.read()
+
+                digest = hashlib.sha256(content).hexdigest()[:12]
+                stem, extension = os.path.splitext(relative_path)
+                fingerprinted = f"{stem}.{digest}{extension}"
+                content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                self.urls[relative_path] = fingerprinted
+                self.assets[fingerprinted] = Asset(content_type, f'"{digest}"', _compress(content, content_type))
+
+        # Страницы собираются после статики, чтобы подставить адреса с отпечатками
+        for name in os.listdir(self.directory):
+            if name.endswith(".html"):
+                with open(os.path.join(self.directory, name), encoding="utf-8") as file:
+                    html = self.rewrite_html(file.read())
+                content = html.encode("utf-8")
+                digest = hashlib.sha256(content).hexdigest()[:12]
+                self.pages[name] = Asset("text/html; charset=utf-8", f'"{digest}"', _compress(content, "text/html"))
+        return self
+
+    def rewrite_html(self, html: str) -> str:
+        """Замена ссылок на /static/... в атрибутах href/src адресами с отпечатками"""
+        def replace(match):
+            relative_path = match.group(2).replace("\\", "/")
+            fingerprinted = self.urls.get(relative_path)
+            if fingerprinted is None:
+                return match.group(0)
+            return f'{match.group(1)}/static/{fingerprinted}{match.group(3)}'
+
+        return re.sub(r'((?:href|src)=["\'])/?static[/\\]([^"\']+)(["\'])', replace, html)
+
+    def page_response(self, name: str, request_headers: Headers, method: str = "GET") -> Optional[Response]:
+        page = self.pages.get(name)
+        if page is None:
+            return None
+        return _asset_response(page, request_headers, REVALIDATE, method)
+
+
+class AssetStaticFiles(StaticFiles):
+    def __init__(self, *, manifest: AssetManifest, **kwargs):
+        super().__init__(**kwargs)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope) -> Response:
+        asset = self.manifest.assets.get(path.replace(os.sep, "/"))
+        if asset is not None and scope["method"] in ("GET", "HEAD"):
+            return _asset_response(asset, Headers(scope=scope), IMMUTABLE, scope["method"])
+
+        response = await super().get_response(path, scope)
+        # Старые адреса без отпечатка (например, из script.js) проверяются при каждом запросе
+        response.headers.setdefault("Cache-Control", REVALIDATE)
+        return response
+
+
+_BLOB_NAME_RE = re.compile(r"^([0-9a-f]{64})(?:_[a-z_]+)?(\.[A-Za-z0-9]+)?$")
+
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон bytes=start-end -> (start, end) включительно; None - заголовок не поддерживается"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # bytes=-N - последние N байт
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    return start, end
+
+
+async def _file_chunks(path: str, start: int, length: int, chunk_size: int = 64 * 1024):
+    async with await anyio.open_file(path, "rb") as file:
+        await file.seek(start)
+        while length > 0:
+            chunk = await file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+# Раздача файлов хранилища: имя файла - SHA-256 содержимого, поэтому ETag строгий,
+# кэширование бессрочное, а запросы Range отдают часть файла (перемотка видео, докачка)
+class UploadStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        match = _BLOB_NAME_RE.match(os.path.basename(full_path))
+        if match is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers.setdefault("Cache-Control", REVALIDATE)
+            return response
+
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        etag = f'"{os.path.splitext(name)[0]}"'
+        size = stat_result.st_size
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE,
+            "Accept-Ranges": "bytes",
+        }
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        if etag in request_headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+        byte_range = None
+        range_header = request_headers.get("range")
+        # If-Range с другим ETag - файл изменился, отдаем целиком
+        if range_header and request_headers.get("if-range", etag) == etag:
+            byte_range = _parse_range(range_header, size)
+
+        if byte_range is None:
+            start, end, status_code = 0, size - 1, 200
+        else:
+            start, end = byte_range
+            if start >= size or start > end:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            status_code = 206
+
+        length = end - start + 1 if size else 0
+        headers["Content-Length"] = str(length)
+        if scope["method"] == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            _file_chunks(full_path, start, length), status_code=status_code,
+            headers=headers, media_type=media_type
+        )
@@ -1,19 +1,106 @@
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-import os
+from starlette.concurrency import run_in_threadpool
+import threading
+import time
 
 # Импортируем всё необходимое из database
-from .database import get_db, User, SessionLocal
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from .config import settings
+from .database import User, ReadSessionLocal
+from .queries import user_by_username
+from .passwords import build_password_context, PasswordHasher
+
+pwd_context = build_password_context(settings.bcrypt_rounds)
+# Пул процессов для bcrypt, чтобы вход и регистрация не занимали потоки остальных запросов
+password_hasher = PasswordHasher(
+    rounds=settings.bcrypt_rounds,
+    workers=settings.password_hash_workers,
+    max_pending=settings.password_hash_max_pending
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+
+
+# Снимок пользователя для текущего запроса (не привязан к сессии БД)
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    username: str
+    email: str
+    avatar_path: Optional[str]
+    is_active: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            avatar_path=user.avatar_path,
+            is_active=user.is_active
+        )
+
+
+# Кэш проверенных токенов: токен -> снимок пользователя (LRU с ограничением времени жизни)
+class TokenCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[UserSnapshot]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, snapshot = entry
+            if expires_at < time.monotonic():
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return snapshot
+
+    def put(self, token: str, snapshot: UserSnapshot, token_expires_at: float):
+        # Запись живет не дольше самого токена
+        expires_at = time.monotonic() + min(self.ttl, max(token_expires_at - time.time(), 0))
+        with self._lock:
+            self._entries[token] = (expires_at, snapshot)
+            self._entries.move_to_end(token)
+            self._tokens_by_user.setdefault(snapshot.id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        """Сброс всех токенов пользователя (смена аватара, деактивация)"""
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def _remove(self, token: str):
+        _, snapshot = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(snapshot.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[snapshot.id]
+
+
+token_cache = TokenCache(settings.token_cache_size, settings.token_cache_ttl)
+
+
+def _get_secret_key() -> str:
+    if not settings.secret_key:
+        raise ValueError("SECRET_KEY не установлен в переменных окружениях")
+    return settings.secret_key
 
 
 # Хэширование пароля
@@ -28,30 +115,14 @@ def verify_password(plain_password, hashed_password):
 
 # Создание JWT-токена
 def create_access_token(data: dict):
-    # Загружаем .env ТОЛЬКО когда функция вызывается
-    from dotenv import load_dotenv
-    load_dotenv()
-
-    secret_key = os.getenv("SECRET_KEY")
-    if not secret_key:
-        raise ValueError("SECRET_KEY не установлен в переменных окружениях")
-
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, secret_key, algorithm=ALGORITHM)
-
-
-# Получение текущего пользователя по токену
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    # Загружаем .env ТОЛЬКО когда функция вызывается
-    from dotenv import load_dotenv
-    load_dotenv()
+    return jwt.encode(to_encode, _get_secret_key(), algorithm=ALGORITHM)
 
-    secret_key = os.getenv("SECRET_KEY")
-    if not secret_key:
-        raise ValueError("SECRET_KEY не установлен в переменных окружениях")
 
+def _load_user_snapshot(token: str) -> UserSnapshot:
+    """Проверка подписи токена и загрузка пользователя из БД"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные",
@@ -59,15 +130,36 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     )
 
     try:
-        payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, _get_secret_key(), algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
+    db = ReadSessionLocal()
+    try:
+        user = db.scalars(user_by_username(username)).first()
+    finally:
+        db.close()
+
+    if user is None or not user.is_active:
         raise credentials_exception
 
-    return user
\ No newline at end of file
+    snapshot = UserSnapshot.from_user(user)
+    token_cache.put(token, snapshot, payload["exp"])
+    return snapshot
+
+
+# Получение пользователя по токену (общая часть для HTTP и WebSocket)
+async def authenticate_token(token: str) -> UserSnapshot:
+    # Попадание в кэш обходится без декодирования JWT и запроса к БД
+    snapshot = token_cache.get(token)
+    if snapshot is not None:
+        return snapshot
+    return await run_in_threadpool(_load_user_snapshot, token)
+
+
+# Получение текущего пользователя по токену
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserSnapshot:
+    return await authenticate_token(token)
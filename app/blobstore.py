@@ -0,0 +1,139 @@
+import hashlib
+import os
+import re
+import time
+import uuid
+from typing import Iterator, List, Optional, Set, Tuple
+
+from fastapi import UploadFile
+
+from app.config import settings
+from app.uploads import StoredUpload, save_upload
+
+DEFAULT_UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+
+_EXTENSION_RE = re.compile(r"\.[A-Za-z0-9]{1,10}")
+
+
+def _clean_extension(filename: Optional[str]) -> str:
+    """Расширение из имени файла клиента (по нему StaticFiles определяет тип); подозрительное отбрасывается"""
+    extension = os.path.splitext(filename or "")[1]
+    return extension.lower() if _EXTENSION_RE.fullmatch(extension) else ""
+
+
+# Хранилище файлов по содержимому: uploads/ab/cd/<sha256><ext>.
+# Одинаковые файлы хранятся один раз, ссылки на них - Message.file_path и User.avatar_path
+class BlobStore:
+    def __init__(self, root: str, url_prefix: str = "uploads"):
+        self.root = root
+        self.url_prefix = url_prefix
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def _relative_path(self, digest: str, extension: str) -> str:
+        # Два уровня подкаталогов по 256 - в каждом каталоге немного файлов
+        return os.path.join(digest[:2], digest[2:4], digest + extension)
+
+    def reference(self, digest: str, extension: str) -> str:
+        """Ссылка на файл для БД и клиента (путь под /uploads)"""
+        return "/".join((self.url_prefix, *self._relative_path(digest, extension).split(os.sep)))
+
+    def local_path(self, reference: str) -> Optional[str]:
+        """Путь к файлу хранилища по ссылке; None - ссылка не из хранилища"""
+        prefix = self.url_prefix + "/"
+        if not reference or not reference.startswith(prefix):
+            return None
+        parts = reference[len(prefix):].split("/")
+        if len(parts) != 3 or len(parts[0]) != 2 or len(parts[1]) != 2:
+            return None
+        return os.path.join(self.root, *parts)
+
+    def digest_of(self, reference: Optional[str]) -> Optional[str]:
+        """SHA-256 файла по ссылке на хранилище"""
+        if self.local_path(reference) is None:
+            return None
+        return os.path.splitext(reference.rsplit("/", 1)[1])[0]
+
+    def variant_reference(self, digest: str, name: str) -> str:
+        """Ссылка на производный файл (миниатюру) в uploads/variants/ab/<sha256>_<name>.webp"""
+        return f"{self.url_prefix}/variants/{digest[:2]}/{digest}_{name}.webp"
+
+    def variant_local_path(self, digest: str, name: str) -> str:
+        return os.path.join(self.root, "variants", digest[:2], f"{digest}_{name}.webp")
+
+    def remove_variants(self, digest: str):
+        variants_dir = os.path.join(self.root, "variants", digest[:2])
+        if not os.path.isdir(variants_dir):
+            return
+        for name in os.listdir(variants_dir):
+            if name.startswith(digest + "_"):
+                os.remove(os.path.join(variants_dir, name))
+
+    def _commit(self, stored: StoredUpload, extension: str) -> StoredUpload:
+        """Перенос временного файла на место по хэшу (или удаление, если такой уже есть)"""
+        relative_path = self._relative_path(stored.sha256, extension)
+        target = os.path.join(self.root, relative_path)
+        if os.path.exists(target):
+            os.remove(stored.path)
+            # Обновляем mtime, чтобы сборка мусора не удалила файл до фиксации ссылки
+            os.utime(target)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(stored.path, target)
+        return StoredUpload(path=self.reference(stored.sha256, extension), size=stored.size, sha256=stored.sha256)
+
+    async def put(self, file: UploadFile, max_size: int) -> StoredUpload:
+        """Потоковая загрузка файла в хранилище; path в ответе - ссылка для БД"""
+        extension = _clean_extension(file.filename)
+        temp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        stored = await save_upload(file, temp_path, max_size=max_size, chunk_size=settings.upload_chunk_size)
+        return self._commit(stored, extension)
+
+    def put_file(self, source_path: str) -> StoredUpload:
+        """Перенос существующего файла в хранилище (исходный файл удаляется)"""
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as source:
+            for chunk in iter(lambda: source.read(settings.upload_chunk_size), b""):
+                digest.update(chunk)
+        temp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        os.replace(source_path, temp_path)
+        stored = StoredUpload(path=temp_path, size=os.path.getsize(temp_path), sha256=digest.hexdigest())
+        return self._commit(stored, _clean_extension(source_path))
+
+    def iter_blobs(self) -> Iterator[Tuple[str, str]]:
+        """(ссылка, путь на диске) для всех файлов хранилища"""
+        for first in sorted(os.listdir(self.root)):
+            first_dir = os.path.join(self.root, first)
+            if first == "tmp" or len(first) != 2 or not os.path.isdir(first_dir):
+                continue
+            for second in sorted(os.listdir(first_dir)):
+                second_dir = os.path.join(first_dir, second)
+                if not os.path.isdir(second_dir):
+                    continue
+                for name in sorted(os.listdir(second_dir)):
+                    yield "/".join((self.url_prefix, first, second, name)), os.path.join(second_dir, name)
+
+    def collect_garbage(self, referenced: Set[str], grace: float, dry_run: bool = False) -> Tuple[int, int]:
+        """Удаление файлов без ссылок старше grace секунд; возвращает (файлов, байт)"""
+        removed, freed = 0, 0
+        cutoff = time.time() - grace
+        candidates: List[Tuple[Optional[str], str]] = list(self.iter_blobs())
+        # Недописанные загрузки, оставшиеся после падения процесса
+        candidates += [(None, os.path.join(self.tmp_dir, name)) for name in os.listdir(self.tmp_dir)]
+
+        for reference, path in candidates:
+            if reference in referenced:
+                continue
+            stat = os.stat(path)
+            if stat.st_mtime > cutoff:
+                continue
+            if not dry_run:
+                os.remove(path)
+                if reference is not None:
+                    self.remove_variants(self.digest_of(reference))
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+
+blob_store = BlobStore(settings.upload_dir or DEFAULT_UPLOAD_DIR)
@@ -0,0 +1,194 @@
+import abc
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Awaitable, Callable, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+# Базовый интерфейс брокера событий между воркерами
+class Broker(abc.ABC):
+    @abc.abstractmethod
+    async def start(self, handler: EventHandler):
+        """Подписка на события; handler вызывается для каждого события"""
+
+    @abc.abstractmethod
+    async def publish(self, event: dict):
+        pass
+
+    @abc.abstractmethod
+    async def stop(self):
+        pass
+
+
+# Брокер внутри одного процесса (один воркер uvicorn)
+class MemoryBroker(Broker):
+    def __init__(self):
+        self._handler: Optional[EventHandler] = None
+
+    async def start(self, handler: EventHandler):
+        self._handler = handler
+
+    async def publish(self, event: dict):
+        if self._handler is not None:
+            await self._handler(event)
+
+    async def stop(self):
+        self._handler = None
+
+
+# Брокер на общем SQLite-файле: воркеры на одной машине опрашивают журнал событий
+class SQLiteBroker(Broker):
+    def __init__(self, path: str, poll_interval: float = 0.05, retention: float = 60.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._handler: Optional[EventHandler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_id = 0
+        self._last_prune = 0.0
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _init_db(self):
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS broker_events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "payload TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            connection.commit()
+            row = connection.execute("SELECT COALESCE(MAX(id), 0) FROM broker_events").fetchone()
+            return row[0]
+        finally:
+            connection.close()
+
+    def _insert(self, payload: str):
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT INTO broker_events (payload, created_at) VALUES (?, ?)",
+                (payload, now)
+            )
+            # Старые события периодически удаляем, чтобы журнал не рос
+            if now - self._last_prune > self.retention:
+                self._last_prune = now
+                connection.execute("DELETE FROM broker_events WHERE created_at < ?", (now - self.retention,))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _fetch(self, last_id: int):
+        connection = self._connect()
+        try:
+            return connection.execute(
+                "SELECT id, payload FROM broker_events WHERE id > ? ORDER BY id",
+                (last_id,)
+            ).fetchall()
+        finally:
+            connection.close()
+
+    async def start(self, handler: EventHandler):
+        self._handler = handler
+        # Новый воркер получает только события, опубликованные после старта
+        self._last_id = await asyncio.to_thread(self._init_db)
+        self._task = asyncio.create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            try:
+                rows = await asyncio.to_thread(self._fetch, self._last_id)
+                for event_id, payload in rows:
+                    self._last_id = event_id
+                    await self._handler(json.loads(payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка обработки событий брокера")
+            await asyncio.sleep(self.poll_interval)
+
+    async def publish(self, event: dict):
+        await asyncio.to_thread(self._insert, json.dumps(event))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Брокер на Redis pub/sub для нескольких машин.
+# Клиент можно передать явно (например, fakeredis.aioredis.FakeRedis в тестах)
+class RedisBroker(Broker):
+    def __init__(self, url: str, channel: str = "messenger:events", client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("Для BROKER_URL=redis://... установите пакет redis")
+            client = redis.from_url(url)
+
+        self.channel = channel
+        self._client = client
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: EventHandler):
+        self._pubsub = self._client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen(handler))
+
+    async def _listen(self, handler: EventHandler):
+        async for message in self._pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            try:
+                await handler(json.loads(message["data"]))
+            except Exception:
+                logger.exception("Ошибка обработки событий брокера")
+
+    async def publish(self, event: dict):
+        await self._client.publish(self.channel, json.dumps(event))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.close()
+            self._pubsub = None
+
+
+def create_broker(url: str) -> Broker:
+    """Создание брокера по URL: memory://, sqlite:///path, redis://host:port/db"""
+    if url.startswith("memory://"):
+        return MemoryBroker()
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    raise ValueError(f"Неизвестный BROKER_URL: {url}")
+
+
+broker = create_broker(settings.broker_url)
@@ -0,0 +1,93 @@
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+# Настройки приложения: читаются один раз из окружения и .env при импорте
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    # Авторизация
+    secret_key: Optional[str] = None
+    access_token_expire_minutes: int = 30
+    # Кэш проверенных токенов: токен -> снимок пользователя
+    token_cache_size: int = 10000
+    token_cache_ttl: float = 60
+    # Стоимость bcrypt; при изменении хэши обновляются при следующем входе
+    bcrypt_rounds: int = 12
+    # Пул процессов для хэширования паролей и предел очереди (сверх него - 503)
+    password_hash_workers: int = 2
+    password_hash_max_pending: int = 32
+
+    # База данных
+    database_url: str = "sqlite:///./messenger.db"
+    async_database_url: Optional[str] = None
+    # Профиль SQLite: применяется к каждому новому подключению (основная база, шарды, писатель)
+    # и проверяется при запуске. WAL - читатели не блокируют писателя, NORMAL в режиме WAL
+    # не теряет целостность при сбое (последние транзакции могут откатиться)
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_cache_size_kb: int = 64 * 1024
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_temp_store: str = "MEMORY"
+    # Потоки для синхронных эндпоинтов и пулы подключений. Синхронные пулы (запись и отдельный
+    # только для чтения для GET) по умолчанию - по числу потоков, чтобы поток не ждал подключение.
+    # Записи в одну базу внутри процесса идут по очереди (SQLiteWriteQueue), размер пула их не ограничивает
+    threadpool_workers: int = 40
+    db_pool_size: Optional[int] = None
+    db_async_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    # Список чатов строится по денормализованной таблице chat_summaries
+    inbox_use_summary: bool = False
+    # Шардирование сообщений (только SQLite): 0 - сообщения в основной базе, N - в N файлах
+    # по chat_id % N; после изменения числа шардов - python -m app.manage rebalance-messages
+    message_shards: int = 0
+    message_shard_path: str = "./messages_{shard}.db"
+    # Сводки, счетчики непрочитанных и журнал изменений догоняют шарды пакетом раз в столько мс
+    message_shard_apply_delay_ms: float = 20
+
+    # Брокер событий между воркерами: memory://, sqlite:///path, redis://host:port/db
+    broker_url: str = "memory://"
+    # Присутствие и набор текста (только в памяти): сроки жизни в секундах, интервал рассылки
+    # изменений и число пользователей, для которых помнится время последнего визита
+    presence_ttl: float = 60
+    typing_ttl: float = 6
+    presence_flush_interval_ms: float = 250
+    presence_last_seen_size: int = 100000
+
+    # direct - каждое сообщение в своей транзакции, batched - групповая запись фоновым писателем
+    ingest_mode: str = "direct"
+    ingest_batch_size: int = 100
+    ingest_batch_delay_ms: float = 5
+    # Надежность записи пакета для SQLite: FULL, NORMAL или OFF (PRAGMA synchronous)
+    ingest_synchronous: str = "FULL"
+    # Максимум сообщений в одном запросе POST /api/messages/batch
+    max_batch_messages: int = 100
+
+    # Лимиты размера загружаемых файлов (байты); больший запрос обрывается на лету
+    max_attachment_size: int = 50 * 1024 * 1024
+    max_avatar_size: int = 5 * 1024 * 1024
+    upload_chunk_size: int = 1024 * 1024
+    # Каталог хранилища файлов (по умолчанию app/uploads) и возраст, после которого файл без ссылок удаляется
+    upload_dir: Optional[str] = None
+    blob_gc_grace_seconds: float = 3600
+    # Миниатюры изображений и аватаров (нужен пакет Pillow) и число процессов для них
+    media_enabled: bool = True
+    media_workers: int = 1
+
+    # Метрики /metrics и порог для журнала медленных SQL-запросов (мс)
+    metrics_enabled: bool = True
+    slow_query_ms: float = 200
+
+    # Сколько дней хранится журнал изменений для /api/sync (старее - клиенту нужна полная загрузка)
+    change_log_retention_days: int = 30
+
+    # Кэш поиска пользователей для коротких запросов
+    user_search_cache_size: int = 1024
+    user_search_cache_ttl: float = 30
+    user_search_cache_max_query: int = 3
+
+
+settings = Settings()
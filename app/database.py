@@ -1,22 +1,215 @@
 from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Boolean, Text, UniqueConstraint, \
-    Enum
+    Enum, Index, MetaData, Table, event, func, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util import await_only
 from datetime import datetime
-import os
-from dotenv import load_dotenv
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import enum
+import os
+import re
+import threading
 
-load_dotenv()
+from fastapi import Depends
 
-# Подключение к БД
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./messenger.db")
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+from app.config import settings
+
+SQLITE_JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+# Значения, которые PRAGMA возвращает при чтении
+SQLITE_SYNCHRONOUS = {"OFF": 0, "NORMAL": 1, "FULL": 2, "EXTRA": 3}
+SQLITE_TEMP_STORE = {"DEFAULT": 0, "FILE": 1, "MEMORY": 2}
+
+
+def is_memory_database(url: str) -> bool:
+    database = make_url(url).database
+    return not database or database == ":memory:" or "mode=memory" in url
+
+
+# Профиль производительности SQLite: PRAGMA выполняются при каждом новом подключении движка.
+# journal_mode сохраняется в файле базы, остальные действуют только на подключение; synchronous,
+# cache_size и mmap_size задаются для каждой схемы отдельно (у шардов - и для присоединенного каталога)
+class SQLiteProfile:
+    def __init__(self, journal_mode: str, synchronous: str, busy_timeout_ms: int, cache_size_kb: int,
+                 mmap_size: int, temp_store: str):
+        journal_mode, synchronous, temp_store = journal_mode.upper(), synchronous.upper(), temp_store.upper()
+        if journal_mode not in SQLITE_JOURNAL_MODES:
+            raise ValueError(f"Недопустимое значение SQLITE_JOURNAL_MODE: {journal_mode}")
+        if synchronous not in SQLITE_SYNCHRONOUS:
+            raise ValueError(f"Недопустимое значение SQLITE_SYNCHRONOUS: {synchronous}")
+        if temp_store not in SQLITE_TEMP_STORE:
+            raise ValueError(f"Недопустимое значение SQLITE_TEMP_STORE: {temp_store}")
+
+        self.journal_mode = journal_mode
+        # Подключение: ожидание блокировки до выполнения остальных PRAGMA
+        self.connection_pragmas = {"busy_timeout": busy_timeout_ms, "temp_store": temp_store}
+        # Схема: отрицательный cache_size - размер в КиБ, а не в страницах
+        self.schema_pragmas = {"synchronous": synchronous, "cache_size": -cache_size_kb, "mmap_size": mmap_size}
+
+    def expected(self, url: str, read_only: bool = False, synchronous: Optional[str] = None) -> Dict[str, object]:
+        """Ожидаемые значения PRAGMA в том виде, в каком их возвращает SQLite
+        (synchronous - если движок переопределяет значение профиля)"""
+        values = {
+            "busy_timeout": self.connection_pragmas["busy_timeout"],
+            "temp_store": SQLITE_TEMP_STORE[self.connection_pragmas["temp_store"]],
+            "synchronous": SQLITE_SYNCHRONOUS[synchronous or self.schema_pragmas["synchronous"]],
+            "cache_size": self.schema_pragmas["cache_size"],
+            "query_only": int(read_only),
+        }
+        # У базы в памяти журнал всегда memory, а mmap не используется
+        if not is_memory_database(url):
+            values["journal_mode"] = self.journal_mode.lower()
+            values["mmap_size"] = self.schema_pragmas["mmap_size"]
+        return values
+
+    def apply_to_schema(self, cursor, schema: str):
+        for name, value in self.schema_pragmas.items():
+            cursor.execute(f"PRAGMA {schema}.{name}={value}")
+
+    def apply(self, engine, read_only: bool = False):
+        """Профиль для каждого нового подключения движка (для async - engine.sync_engine);
+        read_only - подключения только для чтения (PRAGMA query_only)"""
+        if engine.dialect.name != "sqlite":
+            return
+        memory = is_memory_database(str(engine.url))
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in self.connection_pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            if not memory:
+                cursor.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self.apply_to_schema(cursor, "main")
+            if read_only:
+                cursor.execute("PRAGMA query_only=1")
+            cursor.close()
+
+    def verify(self, connection, read_only: bool = False,
+               synchronous: Optional[str] = None) -> Dict[str, Tuple[object, object]]:
+        """Несовпадения с профилем на подключении: PRAGMA -> (ожидалось, получено)"""
+        if connection.dialect.name != "sqlite":
+            return {}
+        mismatches = {}
+        for name, value in self.expected(str(connection.engine.url), read_only, synchronous).items():
+            actual = connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            if actual != value:
+                mismatches[name] = (value, actual)
+        return mismatches
+
+
+sqlite_profile = SQLiteProfile(
+    settings.sqlite_journal_mode, settings.sqlite_synchronous, settings.sqlite_busy_timeout_ms,
+    settings.sqlite_cache_size_kb, settings.sqlite_mmap_size, settings.sqlite_temp_store
 )
+
+
+# pysqlite открывает транзакцию только перед изменяющим запросом (SELECT и DDL - вне транзакции)
+_SQLITE_WRITE_RE = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+WRITE_QUEUE_INFO = "sqlite_write_queue"
+
+
+# Писатель SQLite один. Без очереди конкурирующие транзакции процесса ждут блокировку базы
+# в busy_timeout - повторы с паузами, а по таймауту "database is locked". Очередь держится
+# только на время транзакции записи: с первого изменяющего запроса до commit/rollback.
+# Чтения (в том числе запросы сессии до первой записи) идут параллельно по пулу подключений.
+# Очередь своя у каждого движка: синхронный и асинхронный движки одной базы, а также другие
+# процессы по-прежнему разбираются через busy_timeout
+class SQLiteWriteQueue:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+    def apply(self, engine):
+        """Очередь записи для движка (для async - engine.sync_engine)"""
+        if engine.dialect.name != "sqlite" or is_memory_database(str(engine.url)):
+            return
+        is_async = engine.dialect.is_async
+        lock = asyncio.Lock() if is_async else threading.Lock()
+        timeout = self.timeout
+
+        async def acquire_async() -> bool:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return False
+            return True
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def acquire(conn, cursor, statement, parameters, context, executemany):
+            if conn.info.get(WRITE_QUEUE_INFO) or not _SQLITE_WRITE_RE.match(statement):
+                return
+            # Асинхронный движок выполняет запросы в greenlet - ожидание не блокирует event loop
+            acquired = await_only(acquire_async()) if is_async else lock.acquire(timeout=timeout)
+            if not acquired:
+                raise TimeoutError(f"{engine.url.database}: очередь записи дольше {timeout} с")
+            conn.info[WRITE_QUEUE_INFO] = True
+
+        def release(info):
+            if info.pop(WRITE_QUEUE_INFO, False):
+                lock.release()
+
+        event.listen(engine, "commit", lambda conn: release(conn.info))
+        event.listen(engine, "rollback", lambda conn: release(conn.info))
+        # Подключение вернулось в пул, не завершив транзакцию средствами Connection
+        event.listen(engine, "checkin", lambda dbapi_connection, record: release(record.info))
+
+
+sqlite_write_queue = SQLiteWriteQueue(settings.db_pool_timeout)
+
+
+def engine_options(url: str, pool_size: int) -> dict:
+    """Аргументы create_engine: пул нужного размера (у базы в памяти пул без размера)"""
+    options = {}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+        if is_memory_database(url):
+            return options
+        if url.startswith("sqlite+aiosqlite"):
+            # По умолчанию aiosqlite открывает подключение (и выполняет PRAGMA) на каждую сессию
+            options["poolclass"] = AsyncAdaptedQueuePool
+    options.update(pool_size=pool_size, max_overflow=settings.db_max_overflow, pool_timeout=settings.db_pool_timeout)
+    return options
+
+
+# Синхронные подключения используются из пула потоков - по одному на поток
+DB_POOL_SIZE = settings.db_pool_size or settings.threadpool_workers
+
+# Подключение к БД
+DATABASE_URL = settings.database_url
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL, DB_POOL_SIZE))
+sqlite_profile.apply(engine)
+sqlite_write_queue.apply(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Отдельные подключения только для чтения (GET-запросы, проверка токена): в режиме WAL
+# читают последний зафиксированный снимок, не ждут писателя и не занимают его пул
+read_engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL, DB_POOL_SIZE))
+sqlite_profile.apply(read_engine, read_only=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+
+def to_async_url(url: str) -> str:
+    """URL с асинхронным драйвером для той же базы"""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgresql:"):
+        return "postgresql+asyncpg:" + url[len("postgresql:"):]
+    return url
+
+
+# Асинхронное подключение для async-эндпоинтов (не блокирует event loop)
+ASYNC_DATABASE_URL = settings.async_database_url or to_async_url(DATABASE_URL)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL, settings.db_async_pool_size)
+)
+sqlite_profile.apply(async_engine.sync_engine)
+sqlite_write_queue.apply(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
 
 
 # Enum для типов чата
@@ -36,6 +229,11 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # Индекс по lower(username) для поиска по префиксу без учета регистра
+    __table_args__ = (
+        Index("ix_users_username_lower", func.lower(username)),
+    )
+
     # Отношения
     sent_messages = relationship("Message", back_populates="sender", foreign_keys="Message.sender_id")
     chat_participations = relationship("ChatParticipant", back_populates="user")
@@ -50,13 +248,16 @@ class Chat(Base):
     chat_name = Column(String(100), nullable=True)  # Для групп
     chat_avatar = Column(String(255), nullable=True)
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    # Ключ личного чата: id собеседников по возрастанию (у групп - NULL)
+    pair_low_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    pair_high_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    # Уникальное ограничение для личных чатов (два пользователя)
+    # Один личный чат на пару пользователей; поиск чата пары - одно обращение к индексу
     __table_args__ = (
-        UniqueConstraint('chat_type', 'creator_id', name='unique_private_chat'),
+        Index("ux_chats_private_pair", "pair_low_id", "pair_high_id", unique=True),
     )
 
     # Отношения
@@ -73,10 +274,17 @@ class ChatParticipant(Base):
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     joined_at = Column(DateTime, default=datetime.utcnow)
     is_admin = Column(Boolean, default=False)  # Для групповых чатов
+    # Курсор прочтения: все сообщения с id <= last_read_message_id прочитаны участником
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default="0")
+    # Непрочитанные сообщения от других участников после курсора; растет при отправке,
+    # пересчитывается при прочтении (manage.py repair-unread-counts сверяет с сообщениями)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
 
-    # Уникальное ограничение - пользователь не может быть дважды в одном чате
+    # Уникальное ограничение - пользователь не может быть дважды в одном чате;
+    # индекс (user_id, chat_id) - для поиска чатов пользователя
     __table_args__ = (
         UniqueConstraint('chat_id', 'user_id', name='unique_chat_participant'),
+        Index("ix_chat_participants_user_id", "user_id", "chat_id"),
     )
 
     # Отношения
@@ -93,16 +301,68 @@ class Message(Base):
     content = Column(Text, nullable=False)
     file_path = Column(String(255), nullable=True)
     file_type = Column(String(50), nullable=True)
+    # Размер и SHA-256 вложения, считаются при потоковой загрузке
+    file_size = Column(Integer, nullable=True)
+    file_sha256 = Column(String(64), nullable=True)
+    # Идентификатор, сгенерированный клиентом: повторная отправка не создает дубликат
+    client_msg_id = Column(String(64), nullable=True)
     is_read = Column(Boolean, default=False)
     is_edited = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Покрывающий индекс для постраничной загрузки истории по курсору (chat_id, id)
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # NULL в уникальном индексе не совпадают друг с другом - сообщения без client_msg_id не ограничены
+        Index("ux_messages_sender_client_msg_id", "sender_id", "client_msg_id", unique=True),
+    )
 
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="sent_messages", foreign_keys=[sender_id])
 
 
+# Журнал изменений для дельта-синхронизации клиентов (/api/sync).
+# id - монотонный курсор синхронизации (AUTOINCREMENT: номера не переиспользуются)
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    # chat - чат создан, participant - изменился участник, message - новое сообщение, read - курсор прочтения
+    kind = Column(String(20), nullable=False)
+    # id сообщения (message) или пользователя (participant, read)
+    entity_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_change_log_chat_id_id", "chat_id", "id"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+CHANGE_CHAT = "chat"
+CHANGE_PARTICIPANT = "participant"
+CHANGE_MESSAGE = "message"
+CHANGE_READ = "read"
+
+
+# Сводка по чату: последнее сообщение и их количество (обновляется в send_message)
+class ChatSummary(Base):
+    __tablename__ = "chat_summaries"
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True)
+    last_message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+
+# Шардирование: до какого id сообщения шарда каталог (сводки, счетчики непрочитанных, время
+# обновления чатов, журнал изменений) уже обновлен. Обновляется вместе с каталогом одной транзакцией
+# (см. app/sharding.py, DirectoryApplier)
+class MessageShardWatermark(Base):
+    __tablename__ = "message_shard_watermarks"
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    last_message_id = Column(Integer, nullable=False, default=0)
+
+
 def get_db():
     """
     Зависимость для получения сессии базы данных
@@ -114,9 +374,254 @@ def get_db():
         db.close()
 
 
-def create_tables():
-    """Создание всех таблиц в базе данных"""
-    Base.metadata.create_all(bind=engine)
+def get_read_db():
+    """
+    Зависимость для GET-запросов: сессия на подключениях только для чтения
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    """
+    Зависимость для получения асинхронной сессии базы данных
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Шардирование сообщений (MESSAGE_SHARDS > 0, только SQLite): таблица messages чата хранится
+# в файле шарда chat_id % MESSAGE_SHARDS, пользователи, чаты и остальные таблицы - в основной базе
+# (каталоге). К каждому подключению шарда каталог присоединяется через ATTACH: имя messages
+# находится в файле шарда, остальные - в каталоге, поэтому запросы с join (отправитель, участники)
+# и обновление сводок в одной транзакции со вставкой сообщения работают без изменений.
+# Вставки в разные шарды идут параллельно, блокировка каталога берется только на короткие
+# обновления в конце транзакции.
+# id сообщений выдает последовательность шарда: шаг MESSAGE_ID_STRIDE, остаток - номер шарда.
+# Так id уникальны во всех шардах и продолжают расти в чате после его переноса в другой шард
+MESSAGE_ID_STRIDE = 1024
+MESSAGE_SHARD_INFO = "message_shard"
+
+shard_metadata = MetaData()
+message_id_sequence = Table(
+    "message_id_sequence", shard_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("last_id", Integer, nullable=False),
+)
+
+
+def allocate_message_ids(count: int):
+    """Резервирование count id в последовательности шарда; запрос возвращает последний из них"""
+    return update(message_id_sequence).values(
+        last_id=message_id_sequence.c.last_id + count * MESSAGE_ID_STRIDE
+    ).returning(message_id_sequence.c.last_id)
+
+
+class MessageShards:
+    def __init__(self, count: int, path_template: str, directory_url: str):
+        self.count = count
+        self.path_template = path_template
+        self.engines = []
+        self.read_engines = []
+        self.async_engines = []
+        self.session_factories = []
+        self.async_session_factories = []
+        self.read_session_factories = []
+        if count <= 0:
+            return
+        if count > MESSAGE_ID_STRIDE:
+            raise ValueError(f"MESSAGE_SHARDS не может быть больше {MESSAGE_ID_STRIDE}")
+        if not directory_url.startswith("sqlite"):
+            raise ValueError("Шардирование сообщений поддерживается только для SQLite")
+
+        self.directory_path = make_url(directory_url).database
+        for shard in range(count):
+            url = self.url(shard)
+            engine = create_engine(url, **engine_options(url, DB_POOL_SIZE))
+            read_engine = create_engine(url, **engine_options(url, DB_POOL_SIZE))
+            async_url = to_async_url(url)
+            async_engine = create_async_engine(async_url, **engine_options(async_url, settings.db_async_pool_size))
+            sqlite_profile.apply(engine)
+            sqlite_profile.apply(read_engine, read_only=True)
+            sqlite_profile.apply(async_engine.sync_engine)
+            sqlite_write_queue.apply(engine)
+            sqlite_write_queue.apply(async_engine.sync_engine)
+            for shard_engine in (engine, read_engine, async_engine.sync_engine):
+                self.attach_directory(shard_engine)
+            info = {MESSAGE_SHARD_INFO: shard}
+            self.engines.append(engine)
+            self.read_engines.append(read_engine)
+            self.async_engines.append(async_engine)
+            self.session_factories.append(
+                sessionmaker(autocommit=False, autoflush=False, bind=engine, info=info)
+            )
+            self.read_session_factories.append(
+                sessionmaker(autocommit=False, autoflush=False, bind=read_engine, info=info)
+            )
+            self.async_session_factories.append(
+                async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False, info=info)
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 0
+
+    def path(self, shard: int) -> str:
+        return self.path_template.format(shard=shard)
+
+    def url(self, shard: int) -> str:
+        return f"sqlite:///{self.path(shard)}"
+
+    def shard_of(self, chat_id: int) -> Optional[int]:
+        """Номер шарда чата; None - сообщения в основной базе"""
+        return chat_id % self.count if self.enabled else None
+
+    def attach_directory(self, engine):
+        """Присоединение каталога к каждому новому подключению движка шарда"""
+        directory_path = self.directory_path
+
+        @event.listens_for(engine, "connect")
+        def attach(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("ATTACH DATABASE ? AS directory", (directory_path,))
+            sqlite_profile.apply_to_schema(cursor, "directory")
+            cursor.close()
+
+
+message_shards = MessageShards(settings.message_shards, settings.message_shard_path, DATABASE_URL)
+
+
+# Сессии шардов в пределах одного запроса: открываются при первом обращении к шарду.
+# Без шардирования любой чат обслуживает сессия основной базы, переданная как directory
+class ShardSessions:
+    def __init__(self, directory, factories: list):
+        self.directory = directory
+        self._factories = factories
+        self._sessions = {}
+
+    def _session(self, shard: Optional[int]):
+        if shard is None:
+            return self.directory
+        session = self._sessions.get(shard)
+        if session is None:
+            session = self._sessions[shard] = self._factories[shard]()
+        return session
+
+    def for_chat(self, chat_id: int):
+        return self._session(message_shards.shard_of(chat_id))
+
+    def for_chats(self, chat_ids) -> List[Tuple[object, List[int]]]:
+        """Чаты, сгруппированные по сессиям их шардов"""
+        groups: Dict[Optional[int], List[int]] = {}
+        for chat_id in chat_ids:
+            groups.setdefault(message_shards.shard_of(chat_id), []).append(chat_id)
+        return [(self._session(shard), shard_chat_ids) for shard, shard_chat_ids in groups.items()]
+
+    def all(self) -> list:
+        if not self._factories:
+            return [self.directory]
+        return [self._session(shard) for shard in range(len(self._factories))]
+
+    def opened(self) -> list:
+        return list(self._sessions.values())
+
+
+def get_shard_db(db=Depends(get_db)):
+    """Зависимость: сессии шардов сообщений (основная сессия запроса - общая с get_db)"""
+    sessions = ShardSessions(db, message_shards.session_factories)
+    try:
+        yield sessions
+    finally:
+        for session in sessions.opened():
+            session.close()
+
+
+def get_read_shard_db(db=Depends(get_read_db)):
+    """Вариант get_shard_db для GET-запросов: подключения шардов только для чтения"""
+    sessions = ShardSessions(db, message_shards.read_session_factories)
+    try:
+        yield sessions
+    finally:
+        for session in sessions.opened():
+            session.close()
+
+
+async def get_async_shard_db(db=Depends(get_async_db)):
+    """Асинхронный вариант get_shard_db"""
+    sessions = ShardSessions(db, message_shards.async_session_factories)
+    try:
+        yield sessions
+    finally:
+        for session in sessions.opened():
+            await session.close()
+
+
+def _profile_problems(url, mismatches: Dict[str, Tuple[object, object]]) -> List[str]:
+    return [
+        f"{url.database}: PRAGMA {name} = {actual}, ожидалось {expected}"
+        for name, (expected, actual) in mismatches.items()
+    ]
+
+
+async def verify_async_engine_profile(engine, synchronous: Optional[str] = None) -> List[str]:
+    """Проверка профиля SQLite на подключении асинхронного движка"""
+    async with engine.connect() as connection:
+        mismatches = await connection.run_sync(
+            lambda sync_connection: sqlite_profile.verify(sync_connection, synchronous=synchronous)
+        )
+    return _profile_problems(engine.url, mismatches)
+
+
+async def verify_database_profile() -> List[str]:
+    """Проверка при запуске: профиль SQLite применился ко всем движкам (основная база и шарды).
+    Возвращает описания несовпадений"""
+    problems = []
+    sync_engines = [(engine, False), (read_engine, True)]
+    sync_engines += [(shard_engine, False) for shard_engine in message_shards.engines]
+    sync_engines += [(shard_engine, True) for shard_engine in message_shards.read_engines]
+    for sync_engine, read_only in sync_engines:
+        with sync_engine.connect() as connection:
+            problems += _profile_problems(sync_engine.url, sqlite_profile.verify(connection, read_only))
+    for checked_engine in [async_engine, *message_shards.async_engines]:
+        problems += await verify_async_engine_profile(checked_engine)
+    return problems
+
+
+async def dispose_engines():
+    """Закрытие подключений всех движков; с последним подключением SQLite переносит WAL в файл базы"""
+    for sync_engine in [engine, read_engine, *message_shards.engines, *message_shards.read_engines]:
+        sync_engine.dispose()
+    for disposed_engine in [async_engine, *message_shards.async_engines]:
+        await disposed_engine.dispose()
+
+
+def unread_count_source():
+    """Число непрочитанных по сообщениям (после курсора, не свои) для строки chat_participants"""
+    return select(func.count(Message.id)).where(
+        Message.chat_id == ChatParticipant.chat_id,
+        Message.id > ChatParticipant.last_read_message_id,
+        Message.sender_id != ChatParticipant.user_id
+    ).scalar_subquery()
+
+
+def upgrade_database():
+    """Обновление схемы до последней миграции Alembic (app/migrations).
+    Базы, созданные до миграций, обновляются на месте: ревизии пропускают уже существующие объекты"""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config()
+    config.set_main_option("script_location", MIGRATIONS_DIR)
+    with engine.connect() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+
+    if message_shards.enabled:
+        from app.sharding import prepare_message_shards
+        prepare_message_shards()
 
 
 def drop_tables():
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app.config import settings
+from app.database import ASYNC_DATABASE_URL, Message, MESSAGE_ID_STRIDE, MESSAGE_SHARD_INFO, allocate_message_ids, \
+    message_shards, sqlite_profile, to_async_url, verify_async_engine_profile, engine_options
+from app.queries import directory_updates, known_client_msg_ids
+from app.sharding import directory_applier
+
+logger = logging.getLogger(__name__)
+
+
+# Фоновый писатель сообщений: копит очередь и сохраняет ее одной транзакцией
+# (при шардировании - по транзакции на шард, шарды пишутся параллельно)
+class MessageWriter:
+    def __init__(self, database_url: str, batch_size: int = 100, batch_delay: float = 0.005,
+                 synchronous: str = "FULL"):
+        if synchronous not in ("FULL", "NORMAL", "OFF"):
+            raise ValueError(f"Недопустимое значение INGEST_SYNCHRONOUS: {synchronous}")
+
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.synchronous = synchronous
+        self.engines = []
+        self._session_factories = []
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        if message_shards.enabled:
+            for shard in range(message_shards.count):
+                shard_url = to_async_url(message_shards.url(shard))
+                shard_engine = create_async_engine(shard_url, **engine_options(shard_url, 1))
+                self._add_engine(shard_engine, synchronous, {MESSAGE_SHARD_INFO: shard})
+                message_shards.attach_directory(shard_engine.sync_engine)
+        else:
+            self._add_engine(create_async_engine(database_url, **engine_options(database_url, 1)), synchronous, {})
+
+    def _add_engine(self, engine, synchronous: str, info: dict):
+        # Пакеты одного движка пишутся по одному: одно подключение на все пакеты, без переподключения
+        self.engines.append(engine)
+        self._session_factories.append(async_sessionmaker(engine, expire_on_commit=False, info=info))
+        # Профиль SQLite, но со своей надежностью записи пакета
+        sqlite_profile.apply(engine.sync_engine)
+        if engine.dialect.name == "sqlite":
+            @event.listens_for(engine.sync_engine, "connect")
+            def set_synchronous(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f"PRAGMA synchronous={synchronous}")
+                cursor.close()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка писателя; уже принятые сообщения дописываются"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        for engine in self.engines:
+            await engine.dispose()
+
+    async def verify_profile(self) -> List[str]:
+        """Проверка профиля SQLite на подключениях писателя (см. verify_database_profile)"""
+        problems = []
+        for engine in self.engines:
+            problems += await verify_async_engine_profile(engine, self.synchronous)
+        return problems
+
+    async def submit(self, values: dict) -> Tuple[int, bool]:
+        """Постановка сообщения в очередь; после фиксации пакета возвращает (id, создано ли)"""
+        if self._task is None:
+            raise RuntimeError("MessageWriter не запущен")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((values, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            # Копим пакет до batch_size сообщений или batch_delay секунд
+            batch: List[Tuple[dict, asyncio.Future]] = [item]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        groups: Dict[int, List[Tuple[dict, asyncio.Future]]] = {}
+        for item in batch:
+            shard = message_shards.shard_of(item[0]["chat_id"])
+            groups.setdefault(shard or 0, []).append(item)
+        await asyncio.gather(*(self._flush_shard(shard, items) for shard, items in groups.items()))
+
+    async def _flush_shard(self, shard: int, batch: List[Tuple[dict, asyncio.Future]]):
+        rows = [values for values, _ in batch]
+        try:
+            try:
+                results = await self._write(shard, rows)
+            except IntegrityError:
+                # client_msg_id успели записать мимо писателя (пакетная отправка) - повтор найдет его
+                results = await self._write(shard, rows)
+        except Exception as error:
+            logger.exception("Ошибка записи пакета сообщений")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _write(self, shard: int, rows: List[dict]) -> List[Tuple[int, bool]]:
+        async with self._session_factories[shard]() as db:
+            results = await store_messages(db, rows)
+            await db.commit()
+        directory_applier.notify()
+        return results
+
+
+async def store_messages(db, rows: List[dict]) -> List[Tuple[int, bool]]:
+    """Запись сообщений с обновлением чатов, сводок и журнала изменений (без commit;
+    в сессии шарда каталог обновляется позже, см. DirectoryApplier).
+    Возвращает для каждой строки (id, создано ли); сообщение с уже известным
+    (sender_id, client_msg_id) не записывается повторно - возвращается id исходного"""
+    keys = {(values["sender_id"], values["client_msg_id"]) for values in rows if values.get("client_msg_id")}
+    known = {}
+    if keys:
+        existing = await db.execute(known_client_msg_ids(list(keys)))
+        known = {
+            (sender_id, client_msg_id): message_id
+            for sender_id, client_msg_id, message_id in existing
+            if (sender_id, client_msg_id) in keys
+        }
+
+    # Повтор внутри одного пакета тоже записывается один раз
+    new_rows, new_positions, seen = [], [], {}
+    for position, values in enumerate(rows):
+        key = (values["sender_id"], values.get("client_msg_id"))
+        if key[1] and (key in known or key in seen):
+            continue
+        if key[1]:
+            seen[key] = position
+        new_rows.append(values)
+        new_positions.append(position)
+
+    results: List[Optional[Tuple[int, bool]]] = [None] * len(rows)
+    if new_rows:
+        if MESSAGE_SHARD_INFO in db.info:
+            # Сессия шарда: id берутся из последовательности шарда (см. MessageShards)
+            last_id = (await db.execute(allocate_message_ids(len(new_rows)))).scalar_one()
+            first_id = last_id - (len(new_rows) - 1) * MESSAGE_ID_STRIDE
+            new_rows = [
+                dict(values, id=first_id + offset * MESSAGE_ID_STRIDE) for offset, values in enumerate(new_rows)
+            ]
+        result = await db.execute(
+            insert(Message).returning(Message.id, sort_by_parameter_order=True),
+            new_rows
+        )
+        for position, message_id in zip(new_positions, result.scalars().all()):
+            results[position] = (message_id, True)
+
+        # Сессия шарда пишет только в свой файл: каталог по этим сообщениям обновит DirectoryApplier.
+        # Без шардирования - сводки, счетчики и журнал в той же транзакции, по запросу на пакет
+        if MESSAGE_SHARD_INFO not in db.info:
+            messages = [
+                dict(values, id=results[position][0]) for position, values in zip(new_positions, new_rows)
+            ]
+            for statement, parameters in directory_updates(messages):
+                await db.execute(statement, parameters)
+
+    for position, values in enumerate(rows):
+        if results[position] is None:
+            key = (values["sender_id"], values["client_msg_id"])
+            message_id = known[key] if key in known else results[seen[key]][0]
+            results[position] = (message_id, False)
+    return results
+
+
+message_writer = MessageWriter(
+    ASYNC_DATABASE_URL,
+    batch_size=settings.ingest_batch_size,
+    batch_delay=settings.ingest_batch_delay_ms / 1000,
+    synchronous=settings.ingest_synchronous.upper()
+) if settings.ingest_mode == "batched" else None
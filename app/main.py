@@ -1,7 +1,7 @@
 import datetime
+import anyio
 from dotenv import load_dotenv
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import uvicorn
@@ -9,6 +9,12 @@ import socket
 
 load_dotenv()
 
+from app.config import settings
+from app.uploads import UploadLimitMiddleware
+from app.blobstore import blob_store
+from app.assets import AssetManifest, AssetStaticFiles, UploadStaticFiles
+from app.metrics import MetricsMiddleware, instrument_engine, render_metrics
+
 app = FastAPI(
     title="DozFire's Messenger",
     description="Secure messenger with private and group chats",
@@ -41,41 +47,143 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Ограничение размера загрузок до разбора тела запроса
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={
+        "/api/messages": settings.max_attachment_size,
+        "/api/users/avatar": settings.max_avatar_size,
+    },
+)
+
+# Метрики запросов (внешний слой - учитываются и ответы остальных middleware)
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
 # Монтируем статические файлы
 current_dir = os.path.dirname(os.path.abspath(__file__))
 static_dir = os.path.join(current_dir, "static")
-uploads_dir = os.path.join(current_dir, "uploads")
+# Файлы пользователей раздаются из хранилища по содержимому
+uploads_dir = blob_store.root
 
 os.makedirs(static_dir, exist_ok=True)
 os.makedirs(uploads_dir, exist_ok=True)
 
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
-app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
+# Отпечатки и сжатые копии статики строятся один раз при запуске, index.html ссылается на них
+asset_manifest = AssetManifest(static_dir).build()
+
+app.mount("/static", AssetStaticFiles(directory=static_dir, manifest=asset_manifest), name="static")
+app.mount("/uploads", UploadStaticFiles(directory=uploads_dir), name="uploads")
 
 # Импортируем и настраиваем базу данных
-from app.database import create_tables, engine, Base
+from app.database import upgrade_database, verify_database_profile, engine, read_engine, async_engine, message_shards
 from app.routers import router
+from app.broker import broker
+from app.realtime import handle_event, presence
+from app.ingest import message_writer
+from app.sharding import directory_applier
+from app.auth import password_hasher
+from app.media import media_processor
 
-Base.metadata.create_all(bind=engine)
+# Схема (таблицы, индексы, FTS) создается и обновляется миграциями Alembic
+upgrade_database()
+if settings.metrics_enabled:
+    # Подсчет запросов к БД подключается после создания таблиц, чтобы не учитывать миграции
+    instrument_engine(engine)
+    instrument_engine(read_engine)
+    instrument_engine(async_engine.sync_engine)
+    for shard_engine in message_shards.engines + message_shards.read_engines:
+        instrument_engine(shard_engine)
+    for shard_engine in message_shards.async_engines:
+        instrument_engine(shard_engine.sync_engine)
+    if message_writer is not None:
+        for writer_engine in message_writer.engines:
+            instrument_engine(writer_engine.sync_engine)
 app.include_router(router)
 
 
+@app.on_event("startup")
+async def check_database_profile():
+    # PRAGMA могут не примениться молча (например, WAL недоступен на файловой системе базы)
+    problems = await verify_database_profile()
+    if message_writer is not None:
+        problems += await message_writer.verify_profile()
+    if problems:
+        raise RuntimeError("Профиль SQLite не применился:\n" + "\n".join(dict.fromkeys(problems)))
+
+
+@app.on_event("startup")
+async def configure_threadpool():
+    # Синхронные эндпоинты выполняются в пуле потоков anyio; пулы подключений рассчитаны на его размер
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_workers
+
+
+@app.on_event("startup")
+async def start_broker():
+    await broker.start(handle_event)
+
+
+@app.on_event("startup")
+async def start_presence():
+    await presence.start()
+
+
+@app.on_event("startup")
+async def start_message_writer():
+    if message_writer is not None:
+        await message_writer.start()
+
+
+@app.on_event("startup")
+async def start_directory_applier():
+    await directory_applier.start()
+
+
+@app.on_event("shutdown")
+async def stop_message_writer():
+    if message_writer is not None:
+        await message_writer.stop()
+
+
+@app.on_event("shutdown")
+async def stop_directory_applier():
+    # После писателя: его последние сообщения тоже попадут в каталог
+    await directory_applier.stop()
+
+
+@app.on_event("shutdown")
+async def stop_presence():
+    await presence.stop()
+
+
+@app.on_event("shutdown")
+async def stop_broker():
+    await broker.stop()
+
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+
+@app.on_event("shutdown")
+async def stop_media_processor():
+    media_processor.shutdown()
+
 
 @app.get("/")
-async def read_root():
-    from fastapi.responses import FileResponse
-    index_path = os.path.join(static_dir, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
+async def read_root(request: Request):
+    response = asset_manifest.page_response("index.html", request.headers)
+    if response is not None:
+        return response
     return {"message": "Index.html not found"}
 
 
 @app.get("/test_connection.html")
-async def test_connection():
-    from fastapi.responses import FileResponse
-    test_path = os.path.join(static_dir, "test_connection.html")
-    if os.path.exists(test_path):
-        return FileResponse(test_path)
+async def test_connection(request: Request):
+    response = asset_manifest.page_response("test_connection.html", request.headers)
+    if response is not None:
+        return response
     return {"message": "Test page not found"}
 
 
@@ -89,6 +197,15 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    from fastapi.responses import PlainTextResponse
+    if not settings.metrics_enabled:
+        return PlainTextResponse("metrics disabled\n", status_code=404)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/ping")
 async def ping():
     return {
@@ -101,6 +218,11 @@ async def ping():
 if __name__ == "__main__":
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("WORKERS", 1))
+
+    # Несколько воркеров не видят память друг друга - события идут через общий брокер
+    if workers > 1 and "BROKER_URL" not in os.environ:
+        os.environ["BROKER_URL"] = "sqlite:///./broker.db"
 
     print("=" * 50)
     print("🚀 DozFire's Messenger Server")
@@ -116,6 +238,7 @@ if __name__ == "__main__":
     print("⚙️  CORS настроен для всех источников")
     print("📁 Статические файлы:", static_dir)
     print("💾 База данных: messenger.db")
+    print(f"👷 Воркеры: {workers}, брокер: {os.environ.get('BROKER_URL', 'memory://')}")
     print("=" * 50)
 
     app.add_middleware(
@@ -130,7 +253,9 @@ if __name__ == "__main__":
         "app.main:app",
         host=host,
         port=port,
-        reload=True,
+        # Автоперезагрузка несовместима с несколькими воркерами
+        reload=workers == 1,
+        workers=workers,
         log_level="info",
         access_log=True
     )
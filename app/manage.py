@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import os
+import sys
+
+from app.config import settings
+from app.database import upgrade_database, SessionLocal, User, Message, ChangeLog, message_shards
+
+
+def rebuild_search(args):
+    from app.search import SEARCH_ENABLED, create_search_index, rebuild_search_index
+
+    if not SEARCH_ENABLED:
+        print("❌ Полнотекстовый поиск поддерживается только для SQLite")
+        return
+    create_search_index()
+    rebuild_search_index()
+    print("✅ Индексы поиска по сообщениям и пользователям перестроены")
+
+
+def deactivate_user(args):
+    from app.realtime import publish_user_changed
+
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.username == args.username).first()
+        if user is None:
+            print(f"❌ Пользователь {args.username} не найден")
+            return
+        user.is_active = False
+        db.commit()
+        user_id = user.id
+    finally:
+        db.close()
+
+    # Воркеры сбрасывают кэш токенов пользователя (при общем брокере - сразу, иначе по TTL)
+    asyncio.run(publish_user_changed(user_id))
+    print(f"✅ Пользователь {args.username} деактивирован")
+
+
+def _message_sessions(db):
+    """Сессии всех мест хранения сообщений: шардов или сама сессия основной базы db
+    (вторая сессия той же базы в том же потоке ждала бы очередь записи, занятую первой)"""
+    if message_shards.enabled:
+        return [factory() for factory in message_shards.session_factories]
+    return [db]
+
+
+def _message_file_refs(sessions, *criteria) -> set:
+    return {
+        row[0]
+        for session in sessions
+        for row in session.query(Message.file_path).filter(Message.file_path.isnot(None), *criteria).distinct()
+    }
+
+
+def _resolve_legacy_upload(reference: str):
+    """Поиск файла старой плоской папки uploads/ (относительно запуска или рядом с хранилищем)"""
+    from app.blobstore import blob_store
+
+    reference = reference.replace("\\", "/")
+    candidates = [reference, os.path.join(blob_store.root, os.path.basename(reference))]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def migrate_uploads(args):
+    from app.blobstore import blob_store
+    from app.realtime import publish_user_changed
+
+    db = SessionLocal()
+    message_sessions = _message_sessions(db)
+    migrated = {}
+    missing = set()
+    changed_users = set()
+    try:
+        message_refs = _message_file_refs(message_sessions)
+        avatar_refs = [row[0] for row in db.query(User.avatar_path).filter(User.avatar_path.isnot(None)).distinct()]
+
+        # Разные ссылки могут указывать на один файл (например, с "\\" вместо "/")
+        sources = {}
+        for reference in message_refs | set(avatar_refs):
+            if blob_store.local_path(reference) is not None:
+                continue
+            source = _resolve_legacy_upload(reference)
+            if source is None:
+                missing.add(reference)
+                continue
+            sources.setdefault(os.path.abspath(source), []).append(reference)
+
+        for source, references in sources.items():
+            stored = blob_store.put_file(source)
+            for reference in references:
+                migrated[reference] = stored
+
+        # Сообщения обновляются и фиксируются до пользователей: без шардов это та же база
+        for session in message_sessions:
+            for reference, stored in migrated.items():
+                session.query(Message).filter(Message.file_path == reference).update({
+                    Message.file_path: stored.path,
+                    Message.file_size: stored.size,
+                    Message.file_sha256: stored.sha256
+                }, synchronize_session=False)
+            session.commit()
+
+        for reference, stored in migrated.items():
+            users = db.query(User.id).filter(User.avatar_path == reference).all()
+            changed_users.update(user_id for user_id, in users)
+            db.query(User).filter(User.avatar_path == reference).update(
+                {User.avatar_path: stored.path}, synchronize_session=False
+            )
+        db.commit()
+    finally:
+        db.close()
+        for session in message_sessions:
+            session.close()
+
+    async def notify():
+        for user_id in changed_users:
+            await publish_user_changed(user_id)
+
+    asyncio.run(notify())
+    unique = len({stored.sha256 for stored in migrated.values()})
+    print(f"✅ Перенесено файлов: {len(sources)} (уникальных: {unique})")
+    for reference in sorted(missing):
+        print(f"⚠️  Файл не найден: {reference}")
+
+
+def gc_uploads(args):
+    from app.blobstore import blob_store
+
+    db = SessionLocal()
+    message_sessions = _message_sessions(db)
+    try:
+        referenced = _message_file_refs(message_sessions)
+        referenced |= {row[0] for row in db.query(User.avatar_path).filter(User.avatar_path.isnot(None)).distinct()}
+    finally:
+        db.close()
+        for session in message_sessions:
+            session.close()
+
+    grace = settings.blob_gc_grace_seconds if args.grace is None else args.grace
+    removed, freed = blob_store.collect_garbage(referenced, grace=grace, dry_run=args.dry_run)
+    action = "Будет удалено" if args.dry_run else "Удалено"
+    print(f"✅ {action} файлов без ссылок: {removed} ({freed / 1024 / 1024:.1f} МБ)")
+
+
+def build_media(args):
+    from app.media import MEDIA_ENABLED, IMAGE_TYPES, AVATAR_VARIANTS, THUMBNAIL_VARIANTS, \
+        render_missing_variants
+
+    if not MEDIA_ENABLED:
+        print("❌ Для миниатюр установите пакет Pillow")
+        return
+
+    db = SessionLocal()
+    message_sessions = _message_sessions(db)
+    try:
+        jobs = [
+            (reference, THUMBNAIL_VARIANTS)
+            for reference in _message_file_refs(message_sessions, Message.file_type.in_(IMAGE_TYPES))
+        ]
+        jobs += [
+            (row[0], AVATAR_VARIANTS) for row in
+            db.query(User.avatar_path).filter(User.avatar_path.isnot(None)).distinct()
+        ]
+    finally:
+        db.close()
+        for session in message_sessions:
+            session.close()
+
+    built, failed = 0, 0
+    for reference, variants in jobs:
+        try:
+            if render_missing_variants(reference, variants):
+                built += 1
+        except Exception as error:
+            failed += 1
+            print(f"⚠️  {reference}: {error}")
+    print(f"✅ Миниатюры построены для файлов: {built}, ошибок: {failed}")
+
+
+def prune_change_log(args):
+    from datetime import datetime, timedelta
+    from sqlalchemy import func
+
+    days = settings.change_log_retention_days if args.days is None else args.days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    db = SessionLocal()
+    try:
+        # Последняя запись остается всегда: по ней /api/sync отличает очищенный журнал от пустого
+        latest = db.query(func.max(ChangeLog.id)).scalar() or 0
+        removed = db.query(ChangeLog).filter(
+            ChangeLog.created_at < cutoff,
+            ChangeLog.id < latest
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    print(f"✅ Удалено записей журнала изменений старше {days} дн.: {removed}")
+
+
+def repair_unread_counts(args):
+    from app.database import ChatParticipant, MESSAGE_SHARD_INFO, unread_count_source
+    from app.sharding import apply_pending_messages
+
+    # Счетчики непрочитанных пересчитываются по сообщениям; меняются только расходящиеся строки.
+    # При шардировании - в сессии каждого шарда для его чатов (каталог виден через ATTACH);
+    # сначала каталог догоняет шарды, иначе еще не учтенные сообщения выглядят как расхождение
+    if message_shards.enabled:
+        apply_pending_messages()
+    recomputed = unread_count_source()
+    total = 0
+    db = SessionLocal()
+    message_sessions = _message_sessions(db)
+    try:
+        for session in message_sessions:
+            mismatched = session.query(ChatParticipant).filter(ChatParticipant.unread_count != recomputed)
+            shard = session.info.get(MESSAGE_SHARD_INFO)
+            if shard is not None:
+                mismatched = mismatched.filter(ChatParticipant.chat_id % message_shards.count == shard)
+            if args.dry_run:
+                total += mismatched.count()
+                continue
+            total += mismatched.update(
+                {ChatParticipant.unread_count: recomputed}, synchronize_session=False
+            )
+            session.commit()
+    finally:
+        db.close()
+        for session in message_sessions:
+            session.close()
+    if args.dry_run:
+        print(f"⚠️  Расходящихся счетчиков непрочитанных: {total}")
+    else:
+        print(f"✅ Исправлено счетчиков непрочитанных: {total}")
+
+
+def rebalance_message_shards(args):
+    from app.sharding import plan_rebalance, rebalance_messages
+
+    moves = plan_rebalance()
+    total = sum(move.messages for move in moves)
+    if args.dry_run:
+        print(f"⚠️  Будет перенесено чатов: {len(moves)}, сообщений: {total}")
+        return
+    rebalance_messages(moves)
+    target = f"шардов: {message_shards.count}" if message_shards.enabled else "в основную базу"
+    print(f"✅ Перенесено чатов: {len(moves)}, сообщений: {total} ({target})")
+
+
+def check_query_plans(args):
+    from app.database import engine
+    from app.query_plans import HOT_QUERIES, find_full_scans
+
+    if engine.dialect.name != "sqlite":
+        print("❌ Проверка планов поддерживается только для SQLite (EXPLAIN QUERY PLAN)")
+        sys.exit(2)
+
+    with engine.connect() as connection:
+        problems = find_full_scans(connection)
+    for name, (tables, plan) in problems.items():
+        print(f"❌ {name}: полный просмотр {', '.join(tables)}")
+        for line in plan:
+            print(f"     {line}")
+    if problems:
+        sys.exit(1)
+    print(f"✅ Полных просмотров нет в {len(HOT_QUERIES)} запросах")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды мессенджера")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "rebuild-search", help="Перестроить FTS-индексы сообщений и пользователей"
+    ).set_defaults(handler=rebuild_search)
+
+    deactivate_parser = subparsers.add_parser("deactivate-user", help="Деактивировать пользователя")
+    deactivate_parser.add_argument("username")
+    deactivate_parser.set_defaults(handler=deactivate_user)
+
+    subparsers.add_parser(
+        "migrate-uploads", help="Перенести файлы из плоской папки uploads/ в хранилище по хэшу"
+    ).set_defaults(handler=migrate_uploads)
+
+    subparsers.add_parser(
+        "build-media", help="Построить недостающие миниатюры изображений и аватаров"
+    ).set_defaults(handler=build_media)
+
+    prune_parser = subparsers.add_parser("prune-change-log", help="Очистить старые записи журнала изменений")
+    prune_parser.add_argument("--days", type=int, default=None,
+                              help="Хранить столько дней (по умолчанию CHANGE_LOG_RETENTION_DAYS)")
+    prune_parser.set_defaults(handler=prune_change_log)
+
+    gc_parser = subparsers.add_parser("gc-uploads", help="Удалить файлы, на которые нет ссылок")
+    gc_parser.add_argument("--dry-run", action="store_true", help="Только посчитать, ничего не удалять")
+    gc_parser.add_argument("--grace", type=float, default=None,
+                           help="Не трогать файлы моложе стольких секунд (по умолчанию BLOB_GC_GRACE_SECONDS)")
+    gc_parser.set_defaults(handler=gc_uploads)
+
+    subparsers.add_parser(
+        "check-query-plans", help="Проверить по EXPLAIN QUERY PLAN, что горячие запросы используют индексы"
+    ).set_defaults(handler=check_query_plans)
+
+    repair_parser = subparsers.add_parser(
+        "repair-unread-counts", help="Пересчитать счетчики непрочитанных по сообщениям"
+    )
+    repair_parser.add_argument("--dry-run", action="store_true", help="Только посчитать расхождения")
+    repair_parser.set_defaults(handler=repair_unread_counts)
+
+    rebalance_parser = subparsers.add_parser(
+        "rebalance-messages",
+        help="Разложить сообщения по шардам согласно MESSAGE_SHARDS (при остановленном сервисе)"
+    )
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="Только посчитать переносы")
+    rebalance_parser.set_defaults(handler=rebalance_message_shards)
+
+    args = parser.parse_args()
+    upgrade_database()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
+
+# python -m app.manage rebuild-search
+# python -m app.manage deactivate-user <username>
+# python -m app.manage migrate-uploads
+# python -m app.manage build-media
+# python -m app.manage prune-change-log [--days N]
+# python -m app.manage gc-uploads [--dry-run] [--grace SECONDS]
+# python -m app.manage check-query-plans
+# python -m app.manage repair-unread-counts [--dry-run]
+# python -m app.manage rebalance-messages [--dry-run]
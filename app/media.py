@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.blobstore import blob_store
+from app.config import settings
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Миниатюры строятся только при установленном Pillow
+MEDIA_ENABLED = Image is not None and settings.media_enabled
+
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# Имя варианта -> размер большей стороны в пикселях
+AVATAR_VARIANTS = {"avatar_small": 64, "avatar_medium": 256}
+THUMBNAIL_VARIANTS = {"thumb": 320}
+
+
+def _render_variants(source_path: str, targets: List[Tuple[str, int]]):
+    """Построение уменьшенных копий изображения (выполняется в процессе пула)"""
+    with Image.open(source_path) as image:
+        # JPEG сразу декодируется в уменьшенном масштабе - быстрее и меньше памяти
+        image.draft("RGB", (max(size for _, size in targets) * 2,) * 2)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+
+        for target_path, size in targets:
+            variant = image.copy()
+            variant.thumbnail((size, size))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            partial_path = target_path + ".part"
+            variant.save(partial_path, "WEBP", quality=80)
+            os.replace(partial_path, target_path)
+
+
+def variant_path(reference: Optional[str], name: str) -> Optional[str]:
+    """Ссылка на вариант файла хранилища; None - варианта нет (еще не построен,
+    построение не удалось или файл не изображение), клиент показывает исходный файл"""
+    if not MEDIA_ENABLED:
+        return None
+    digest = blob_store.digest_of(reference)
+    if digest is None or not os.path.exists(blob_store.variant_local_path(digest, name)):
+        return None
+    return blob_store.variant_reference(digest, name)
+
+
+def missing_variants(reference: str, variants: Dict[str, int]) -> List[Tuple[str, int]]:
+    digest = blob_store.digest_of(reference)
+    if digest is None:
+        return []
+    targets = []
+    for name, size in variants.items():
+        target_path = blob_store.variant_local_path(digest, name)
+        if not os.path.exists(target_path):
+            targets.append((target_path, size))
+    return targets
+
+
+def render_missing_variants(reference: str, variants: Dict[str, int]) -> bool:
+    """Синхронное построение недостающих вариантов файла хранилища (для команд управления);
+    False - строить нечего или исходного файла нет"""
+    targets = missing_variants(reference, variants)
+    source_path = blob_store.local_path(reference)
+    if not targets or not os.path.exists(source_path):
+        return False
+    _render_variants(source_path, targets)
+    return True
+
+
+# Фоновое построение миниатюр в пуле процессов; запрос не ждет результата
+class MediaProcessor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._in_flight: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def schedule(self, reference: str, variants: Dict[str, int]):
+        """Постановка файла в очередь на построение недостающих вариантов"""
+        if not MEDIA_ENABLED or reference in self._in_flight:
+            return
+        targets = missing_variants(reference, variants)
+        if not targets:
+            return
+
+        self._in_flight.add(reference)
+        task = asyncio.create_task(self._render(reference, targets))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _render(self, reference: str, targets: List[Tuple[str, int]]):
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                self._get_executor(), _render_variants, blob_store.local_path(reference), targets
+            )
+        except Exception:
+            logger.warning("Не удалось построить миниатюры для %s", reference, exc_info=True)
+        finally:
+            self._in_flight.discard(reference)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+media_processor = MediaProcessor(settings.media_workers)
@@ -0,0 +1,225 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+# Минимальные метрики в текстовом формате Prometheus (без внешних зависимостей).
+# Значения хранятся в памяти процесса: при нескольких воркерах каждый отдает свои
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Метки -> (счетчики по корзинам, сумма, количество)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labels, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+http_requests = Counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests being processed")
+http_response_size = Histogram(
+    "http_response_size_bytes", "HTTP response body size", ("method", "route"), buckets=SIZE_BUCKETS
+)
+request_db_queries = Histogram(
+    "http_request_db_queries", "SQL queries per HTTP request", ("method", "route"), buckets=QUERY_COUNT_BUCKETS
+)
+request_db_time = Histogram("http_request_db_seconds", "Time in SQL queries per HTTP request", ("method", "route"))
+db_queries = Counter("db_queries_total", "SQL queries executed")
+db_query_duration = Histogram("db_query_duration_seconds", "SQL query latency")
+db_slow_queries = Counter("db_slow_queries_total", "SQL queries slower than SLOW_QUERY_MS")
+
+REGISTRY = [
+    http_requests, http_latency, http_in_flight, http_response_size,
+    request_db_queries, request_db_time, db_queries, db_query_duration, db_slow_queries,
+]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Статистика БД текущего запроса; объект общий для потоков, в которые запрос передает контекст
+@dataclass
+class RequestStats:
+    route: str = ""
+    queries: int = 0
+    db_time: float = 0.0
+
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    db_queries.inc()
+    db_query_duration.observe(elapsed)
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+    if elapsed * 1000 >= settings.slow_query_ms:
+        db_slow_queries.inc()
+        logger.warning(
+            "Медленный запрос %.1f мс (%s): %s",
+            elapsed * 1000, stats.route if stats is not None else "вне запроса", " ".join(statement.split())
+        )
+
+
+def instrument_engine(engine):
+    """Подключение подсчета запросов к движку SQLAlchemy (для async - к engine.sync_engine)"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# ASGI-middleware: время, размер ответа и число запросов к БД по шаблонам маршрутов
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._route_names: Dict[object, str] = {}
+
+    def _route_name(self, scope) -> str:
+        # Метка - шаблон маршрута (/api/chats/{chat_id}/messages), а не конкретный путь
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if not self._route_names:
+            for route in scope["app"].routes:
+                path = getattr(route, "path", "")
+                if hasattr(route, "endpoint"):
+                    self._route_names[route.endpoint] = path
+                elif hasattr(route, "app"):
+                    self._route_names[route.app] = path + "/{path}"
+        return self._route_names.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        # До выбора маршрута в логах медленных запросов виден путь
+        stats = RequestStats(route=f"{method} {scope['path']}")
+        token = _request_stats.set(stats)
+        status_code = 500
+        response_size = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            _request_stats.reset(token)
+
+            route = self._route_name(scope)
+            http_requests.inc(method, route, str(status_code))
+            http_latency.observe(elapsed, method, route)
+            http_response_size.observe(response_size, method, route)
+            request_db_queries.observe(stats.queries, method, route)
+            request_db_time.observe(stats.db_time, method, route)
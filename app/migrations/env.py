@@ -0,0 +1,58 @@
+import warnings
+
+from alembic import context
+
+from app.database import Base, engine
+from app.search import SEARCH_INDEXES
+
+target_metadata = Base.metadata
+
+# Индекс lower(username) SQLAlchemy не отражает для SQLite и предупреждает при каждом
+# пересоздании таблиц в batch-режиме; сами миграции проверяют его по sqlite_master
+warnings.filterwarnings("ignore", message="Skipped unsupported reflection of expression-based index")
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    # Таблицы FTS5 создаются миграцией вручную и в моделях не описаны
+    return not (type_ == "table" and name.startswith(tuple(SEARCH_INDEXES)))
+
+
+def run_migrations_offline():
+    """Вывод SQL миграций без подключения к базе (alembic upgrade head --sql)"""
+    context.configure(
+        url=str(engine.url),
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # Подключение может передать вызывающий код (upgrade_database), иначе - движок приложения
+    connection = context.config.attributes.get("connection")
+    if connection is None:
+        with engine.connect() as connection:
+            _run(connection)
+    else:
+        _run(connection)
+
+
+def _run(connection):
+    # SQLite не умеет изменять ограничения таблиц - batch-режим пересоздает таблицу
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
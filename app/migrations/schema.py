@@ -0,0 +1,41 @@
+from typing import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# Проверки для миграций, которые должны пройти и по базам, созданным до Alembic
+# (create_all и добавление колонок при запуске): существующие объекты пропускаются
+
+def has_table(table: str) -> bool:
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def has_column(table: str, column: str) -> bool:
+    return column in {item["name"] for item in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def has_index(table: str, index: str) -> bool:
+    bind = op.get_bind()
+    if bind.dialect.name == "sqlite":
+        # Индексы по выражениям (lower(username)) SQLAlchemy для SQLite не отражает
+        return bind.execute(sa.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND name = :name"
+        ), {"table": table, "name": index}).first() is not None
+    return index in {item["name"] for item in sa.inspect(bind).get_indexes(table)}
+
+
+def create_index_online(name: str, table: str, columns: Sequence, unique: bool = False):
+    """Построение индекса вне общей транзакции миграции: PostgreSQL строит его CONCURRENTLY,
+    не блокируя запись, SQLite - отдельной короткой транзакцией"""
+    if has_index(table, name):
+        return
+    with op.get_context().autocommit_block():
+        op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True)
+
+
+def drop_index_online(name: str, table: str):
+    if not has_index(table, name):
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
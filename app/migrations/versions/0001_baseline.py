@@ -0,0 +1,84 @@
+"""baseline: users, chats, participants, messages
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_table
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# Схема первой версии приложения (Base.metadata.create_all); в старых базах таблицы уже есть
+def upgrade():
+    if not has_table("users"):
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("username", sa.String(50), nullable=False),
+            sa.Column("email", sa.String(100), nullable=False),
+            sa.Column("password_hash", sa.String(255), nullable=False),
+            sa.Column("avatar_path", sa.String(255), nullable=True),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_username", "users", ["username"], unique=True)
+        op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    if not has_table("chats"):
+        op.create_table(
+            "chats",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_type", sa.Enum("PRIVATE", "GROUP", name="chattype"), nullable=False),
+            sa.Column("chat_name", sa.String(100), nullable=True),
+            sa.Column("chat_avatar", sa.String(255), nullable=True),
+            sa.Column("creator_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=True),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.UniqueConstraint("chat_type", "creator_id", name="unique_private_chat"),
+        )
+        op.create_index("ix_chats_id", "chats", ["id"])
+
+    if not has_table("chat_participants"):
+        op.create_table(
+            "chat_participants",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("joined_at", sa.DateTime(), nullable=True),
+            sa.Column("is_admin", sa.Boolean(), nullable=True),
+            sa.UniqueConstraint("chat_id", "user_id", name="unique_chat_participant"),
+        )
+        op.create_index("ix_chat_participants_id", "chat_participants", ["id"])
+
+    if not has_table("messages"):
+        op.create_table(
+            "messages",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("content", sa.Text(), nullable=False),
+            sa.Column("file_path", sa.String(255), nullable=True),
+            sa.Column("file_type", sa.String(50), nullable=True),
+            sa.Column("is_read", sa.Boolean(), nullable=True),
+            sa.Column("is_edited", sa.Boolean(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_messages_id", "messages", ["id"])
+
+
+def downgrade():
+    op.drop_table("messages")
+    op.drop_table("chat_participants")
+    op.drop_table("chats")
+    op.drop_table("users")
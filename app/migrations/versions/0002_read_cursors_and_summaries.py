@@ -0,0 +1,57 @@
+"""read cursors, chat summaries, history and username indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_table, has_column, create_index_online, drop_index_online
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not has_column("chat_participants", "last_read_message_id"):
+        with op.batch_alter_table("chat_participants") as batch:
+            batch.add_column(sa.Column("last_read_message_id", sa.Integer(), nullable=False, server_default="0"))
+        # Состояние прочтения переносится из Message.is_read в курсоры участников
+        op.execute(
+            "UPDATE chat_participants SET last_read_message_id = COALESCE(("
+            "SELECT MAX(messages.id) FROM messages "
+            "WHERE messages.chat_id = chat_participants.chat_id "
+            "AND (messages.sender_id = chat_participants.user_id OR messages.is_read = 1)"
+            "), 0)"
+        )
+
+    if not has_table("chat_summaries"):
+        op.create_table(
+            "chat_summaries",
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True),
+            sa.Column("last_message_id", sa.Integer(), sa.ForeignKey("messages.id"), nullable=True),
+            sa.Column("message_count", sa.Integer(), nullable=False),
+        )
+    # Сводки для чатов, у которых их еще нет
+    op.execute(
+        "INSERT INTO chat_summaries (chat_id, last_message_id, message_count) "
+        "SELECT chats.id, "
+        "(SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id), "
+        "(SELECT COUNT(messages.id) FROM messages WHERE messages.chat_id = chats.id) "
+        "FROM chats WHERE chats.id NOT IN (SELECT chat_id FROM chat_summaries)"
+    )
+
+    create_index_online("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+    create_index_online("ix_users_username_lower", "users", [sa.text("lower(username)")])
+
+
+def downgrade():
+    drop_index_online("ix_users_username_lower", "users")
+    drop_index_online("ix_messages_chat_id_id", "messages")
+    op.drop_table("chat_summaries")
+    with op.batch_alter_table("chat_participants") as batch:
+        batch.drop_column("last_read_message_id")
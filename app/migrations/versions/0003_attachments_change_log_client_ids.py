@@ -0,0 +1,55 @@
+"""attachment metadata, change log, client message ids
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_table, has_column, create_index_online, drop_index_online
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def _message_columns():
+    return [
+        sa.Column("file_size", sa.Integer(), nullable=True),
+        sa.Column("file_sha256", sa.String(64), nullable=True),
+        sa.Column("client_msg_id", sa.String(64), nullable=True),
+    ]
+
+
+def upgrade():
+    missing = [column for column in _message_columns() if not has_column("messages", column.name)]
+    if missing:
+        with op.batch_alter_table("messages") as batch:
+            for column in missing:
+                batch.add_column(column)
+    create_index_online(
+        "ux_messages_sender_client_msg_id", "messages", ["sender_id", "client_msg_id"], unique=True
+    )
+
+    if not has_table("change_log"):
+        op.create_table(
+            "change_log",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("kind", sa.String(20), nullable=False),
+            sa.Column("entity_id", sa.Integer(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sqlite_autoincrement=True,
+        )
+    create_index_online("ix_change_log_chat_id_id", "change_log", ["chat_id", "id"])
+
+
+def downgrade():
+    op.drop_table("change_log")
+    drop_index_online("ux_messages_sender_client_msg_id", "messages")
+    with op.batch_alter_table("messages") as batch:
+        for column in reversed(_message_columns()):
+            batch.drop_column(column.name)
@@ -0,0 +1,37 @@
+"""full-text search indexes for messages and usernames (SQLite FTS5)
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:30:00
+
+"""
+from alembic import op
+
+from app.migrations.schema import has_table
+from app.search import SEARCH_INDEXES
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for name, statements in SEARCH_INDEXES.items():
+        exists = has_table(name)
+        for ddl in statements:
+            op.execute(ddl)
+        # Новый индекс по существующим данным заполняется сразу
+        if not exists:
+            op.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for name in SEARCH_INDEXES:
+        for suffix in ("ai", "ad", "au"):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}_{suffix}")
+        op.execute(f"DROP TABLE IF EXISTS {name}")
@@ -0,0 +1,24 @@
+"""hot-path index: chats of a user
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 09:40:00
+
+"""
+from app.migrations.schema import create_index_online, drop_index_online
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+# Уникальный индекс (chat_id, user_id) не помогает искать чаты пользователя: список чатов,
+# /sync, подключение WebSocket и подсчет непрочитанных просматривали chat_participants целиком.
+# messages.chat_id покрыт индексом (chat_id, id), messages.sender_id - (sender_id, client_msg_id)
+def upgrade():
+    create_index_online("ix_chat_participants_user_id", "chat_participants", ["user_id", "chat_id"])
+
+
+def downgrade():
+    drop_index_online("ix_chat_participants_user_id", "chat_participants")
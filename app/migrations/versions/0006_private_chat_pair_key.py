@@ -0,0 +1,72 @@
+"""canonical pair key for private chats
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_column, create_index_online, drop_index_online
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def _has_unique_constraint(table: str, name: str) -> bool:
+    return name in {item["name"] for item in sa.inspect(op.get_bind()).get_unique_constraints(table)}
+
+
+# Ограничение unique_private_chat (chat_type, creator_id) разрешало каждому пользователю только
+# один личный и один групповой чат. Его заменяет ключ пары (pair_low_id, pair_high_id)
+def upgrade():
+    add_columns = not has_column("chats", "pair_low_id")
+    drop_constraint = _has_unique_constraint("chats", "unique_private_chat")
+    if add_columns or drop_constraint:
+        # SQLite: таблица пересоздается целиком (batch), ограничения иначе не удалить
+        with op.batch_alter_table("chats") as batch:
+            if add_columns:
+                batch.add_column(sa.Column("pair_low_id", sa.Integer(), nullable=True))
+                batch.add_column(sa.Column("pair_high_id", sa.Integer(), nullable=True))
+                batch.create_foreign_key("fk_chats_pair_low_id_users", "users", ["pair_low_id"], ["id"])
+                batch.create_foreign_key("fk_chats_pair_high_id_users", "users", ["pair_high_id"], ["id"])
+            if drop_constraint:
+                batch.drop_constraint("unique_private_chat", type_="unique")
+
+    # Ключ получает самый старый личный чат каждой пары; возможные дубликаты остаются без ключа
+    bind = op.get_bind()
+    pairs = bind.execute(sa.text(
+        "SELECT chat_participants.chat_id, MIN(chat_participants.user_id), MAX(chat_participants.user_id) "
+        "FROM chat_participants JOIN chats ON chats.id = chat_participants.chat_id "
+        "WHERE chats.chat_type = 'PRIVATE' AND chats.pair_low_id IS NULL "
+        "GROUP BY chat_participants.chat_id HAVING COUNT(*) = 2 "
+        "ORDER BY chat_participants.chat_id"
+    )).all()
+    taken = {tuple(row) for row in bind.execute(sa.text(
+        "SELECT pair_low_id, pair_high_id FROM chats WHERE pair_low_id IS NOT NULL"
+    ))}
+    updates = []
+    for chat_id, low_id, high_id in pairs:
+        if (low_id, high_id) in taken:
+            continue
+        taken.add((low_id, high_id))
+        updates.append({"chat_id": chat_id, "low_id": low_id, "high_id": high_id})
+    if updates:
+        bind.execute(sa.text(
+            "UPDATE chats SET pair_low_id = :low_id, pair_high_id = :high_id WHERE id = :chat_id"
+        ), updates)
+
+    create_index_online("ux_chats_private_pair", "chats", ["pair_low_id", "pair_high_id"], unique=True)
+
+
+def downgrade():
+    drop_index_online("ux_chats_private_pair", "chats")
+    with op.batch_alter_table("chats") as batch:
+        batch.drop_constraint("fk_chats_pair_high_id_users", type_="foreignkey")
+        batch.drop_constraint("fk_chats_pair_low_id_users", type_="foreignkey")
+        batch.drop_column("pair_high_id")
+        batch.drop_column("pair_low_id")
+        batch.create_unique_constraint("unique_private_chat", ["chat_type", "creator_id"])
@@ -0,0 +1,37 @@
+"""materialized unread counters on chat participants
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 10:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_column
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if has_column("chat_participants", "unread_count"):
+        return
+    with op.batch_alter_table("chat_participants") as batch:
+        batch.add_column(sa.Column("unread_count", sa.Integer(), nullable=False, server_default="0"))
+
+    # Начальные значения - по сообщениям после курсора прочтения (кроме своих)
+    op.execute(
+        "UPDATE chat_participants SET unread_count = ("
+        "SELECT COUNT(messages.id) FROM messages "
+        "WHERE messages.chat_id = chat_participants.chat_id "
+        "AND messages.id > chat_participants.last_read_message_id "
+        "AND messages.sender_id != chat_participants.user_id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("chat_participants") as batch:
+        batch.drop_column("unread_count")
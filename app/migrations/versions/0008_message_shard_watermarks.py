@@ -0,0 +1,32 @@
+"""applied-message watermarks for message shards
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 12:40:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations.schema import has_table
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if has_table("message_shard_watermarks"):
+        return
+    # Строки шардов создает prepare_message_shards при запуске с MESSAGE_SHARDS > 0
+    op.create_table(
+        "message_shard_watermarks",
+        sa.Column("shard", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("last_message_id", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("shard"),
+    )
+
+
+def downgrade():
+    op.drop_table("message_shard_watermarks")
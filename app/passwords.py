@@ -0,0 +1,76 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+
+def build_password_context(rounds: int) -> CryptContext:
+    """Контекст bcrypt с заданной стоимостью; хэши с другой стоимостью помечаются на перехэширование"""
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+
+
+# Контекст внутри процесса пула (создается инициализатором)
+_worker_context: Optional[CryptContext] = None
+
+
+def _init_worker(rounds: int):
+    global _worker_context
+    _worker_context = build_password_context(rounds)
+
+
+def _hash(password: str) -> str:
+    return _worker_context.hash(password)
+
+
+def _verify_and_update(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    return _worker_context.verify_and_update(password, password_hash)
+
+
+# Хэширование паролей в отдельном пуле процессов с ограничением очереди
+class PasswordHasher:
+    def __init__(self, rounds: int, workers: int, max_pending: int):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Пул создается лениво - в каждом воркере uvicorn свой
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.rounds,)
+            )
+        return self._executor
+
+    async def _run(self, function, *args):
+        # Переполненная очередь - сразу 503, а не ожидание, отнимающее ресурсы у остальных запросов
+        if self._pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please try again later",
+                headers={"Retry-After": "1"}
+            )
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), function, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+        """(пароль верен, новый хэш - если стоимость хэша устарела)"""
+        return await self._run(_verify_and_update, password, password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.broker import broker, SQLiteBroker
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+TYPING = "typing"
+
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return datetime.utcfromtimestamp(value).isoformat() if value else None
+
+
+# Присутствие (онлайн, последний визит) и индикаторы набора текста.
+# Состояние живет только в памяти и истекает по TTL - в SQLite ничего не пишется.
+# Каждый воркер держит копию состояния всех пользователей: изменения расходятся через брокер
+# пачкой раз в flush_interval, а уведомления получают подключенные к воркеру участники общих чатов.
+# Брокер на SQLite для присутствия не используется - тогда каждый воркер видит только свои подключения.
+# На пользователя хранится: срок на каждый воркер с его подключениями, список чатов,
+# одна запись набора текста и время последнего визита (ограниченный LRU)
+class PresenceService:
+    def __init__(self, manager, ttl: float = 60, typing_ttl: float = 6, flush_interval: float = 0.25,
+                 last_seen_size: int = 100000):
+        self.manager = manager
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self.flush_interval = flush_interval
+        self.last_seen_size = last_seen_size
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # user_id -> {воркер: срок}; пользователь онлайн, пока не истекла хотя бы одна запись
+        self._sessions: Dict[int, Dict[str, float]] = {}
+        # user_id -> чаты пользователя, который онлайн (кого уведомить об уходе)
+        self._chats: Dict[int, Tuple[int, ...]] = {}
+        # user_id -> (chat_id, срок): текст набирается в одном чате за раз
+        self._typing: Dict[int, Tuple[int, float]] = {}
+        self._last_seen: "OrderedDict[int, float]" = OrderedDict()
+        # Сроки, опубликованные этим воркером для своих подключений
+        self._announced: Dict[int, float] = {}
+        # Изменения до ближайшей отправки: (вид, user_id) -> обновление, остается последнее
+        self._pending: Dict[Tuple[str, int], dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.replicate = not isinstance(broker, SQLiteBroker)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # Состояние для ответов API (вызывается и из потоков пула)
+
+    def is_online(self, user_id: int, now: Optional[float] = None) -> bool:
+        now = now or time.time()
+        return any(expires_at > now for expires_at in tuple(self._sessions.get(user_id, {}).values()))
+
+    def snapshot(self, user_ids: Iterable[int]) -> List[dict]:
+        now = time.time()
+        result = []
+        for user_id in user_ids:
+            online = self.is_online(user_id, now)
+            result.append({
+                "user_id": user_id,
+                "online": online,
+                "last_seen": None if online else _timestamp(self._last_seen.get(user_id)),
+            })
+        return result
+
+    def typing_by_chat(self, chat_ids: Iterable[int]) -> Dict[int, List[int]]:
+        now = time.time()
+        chat_ids = set(chat_ids)
+        result: Dict[int, List[int]] = {}
+        for user_id, (chat_id, expires_at) in tuple(self._typing.items()):
+            if chat_id in chat_ids and expires_at > now:
+                result.setdefault(chat_id, []).append(user_id)
+        return result
+
+    # События подключений этого воркера
+
+    def heartbeat(self, user_id: int):
+        """Активность подключенного пользователя (любой кадр WebSocket)"""
+        now = time.time()
+        # Срок продлевается не чаще, чем раз в половину TTL
+        if self._announced.get(user_id, 0) - now > self.ttl / 2:
+            return
+        expires_at = now + self.ttl
+        self._announced[user_id] = expires_at
+        self._queue(ONLINE, user_id, {
+            "worker": self.worker_id,
+            "expires_at": expires_at,
+            "chat_ids": sorted(self.manager.user_chat_ids(user_id)),
+        })
+
+    def disconnected(self, user_id: int):
+        """Закрыто последнее подключение пользователя к этому воркеру"""
+        self._announced.pop(user_id, None)
+        self._queue(ONLINE, user_id, {"worker": self.worker_id, "expires_at": 0})
+        self.stop_typing(user_id)
+
+    def typing(self, user_id: int, chat_id: int):
+        if chat_id not in self.manager.user_chat_ids(user_id):
+            return
+        pending = self._pending.get((TYPING, user_id))
+        if pending is not None and pending["chat_id"] == chat_id and pending["expires_at"]:
+            return
+        # Повторные нажатия в пределах половины TTL не рассылаются
+        current = self._typing.get(user_id)
+        if current is not None and current[0] == chat_id and current[1] - time.time() > self.typing_ttl / 2:
+            return
+        self._queue(TYPING, user_id, {"chat_id": chat_id, "expires_at": time.time() + self.typing_ttl})
+
+    def stop_typing(self, user_id: int):
+        current = self._pending.get((TYPING, user_id)) or (
+            {"chat_id": self._typing[user_id][0]} if user_id in self._typing else None
+        )
+        if current is not None:
+            self._queue(TYPING, user_id, {"chat_id": current["chat_id"], "expires_at": 0})
+
+    def _queue(self, kind: str, user_id: int, update: dict):
+        self._pending[(kind, user_id)] = {"kind": kind, "user_id": user_id, **update}
+
+    # Рассылка
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка рассылки присутствия")
+
+    async def flush(self):
+        if self._pending:
+            updates = list(self._pending.values())
+            self._pending.clear()
+            if self.replicate:
+                await broker.publish({"presence": updates})
+            else:
+                await self.apply(updates)
+        await self._notify(*self._expire(time.time()))
+
+    async def apply(self, updates: List[dict]):
+        """Обновления из брокера (от всех воркеров, включая этот)"""
+        now = time.time()
+        online_changes, typing_changes = [], []
+        for update in updates:
+            user_id = update["user_id"]
+            if update["kind"] == ONLINE:
+                was_online = self.is_online(user_id, now)
+                sessions = self._sessions.setdefault(user_id, {})
+                if update["expires_at"] > now:
+                    sessions[update["worker"]] = update["expires_at"]
+                    self._chats[user_id] = tuple(update.get("chat_ids", self._chats.get(user_id, ())))
+                else:
+                    sessions.pop(update["worker"], None)
+
+                if self.is_online(user_id, now):
+                    self._last_seen.pop(user_id, None)
+                    if not was_online:
+                        online_changes.append(self._online_change(user_id, True))
+                else:
+                    change = self._go_offline(user_id, now)
+                    if was_online:
+                        online_changes.append(change)
+            else:
+                previous = self._typing.get(user_id)
+                previous_chat = previous[0] if previous is not None and previous[1] > now else None
+                if update["expires_at"] > now:
+                    self._typing[user_id] = (update["chat_id"], update["expires_at"])
+                    current_chat = update["chat_id"]
+                else:
+                    self._typing.pop(user_id, None)
+                    current_chat = None
+                if previous_chat != current_chat:
+                    if previous_chat is not None:
+                        typing_changes.append({"chat_id": previous_chat, "user_id": user_id, "typing": False})
+                    if current_chat is not None:
+                        typing_changes.append({"chat_id": current_chat, "user_id": user_id, "typing": True})
+
+        await self._notify(online_changes, typing_changes)
+
+    def _online_change(self, user_id: int, online: bool, last_seen: Optional[float] = None):
+        entry = {"user_id": user_id, "online": online, "last_seen": _timestamp(last_seen)}
+        return entry, self._chats.get(user_id, ())
+
+    def _go_offline(self, user_id: int, last_seen: float):
+        change = self._online_change(user_id, False, last_seen)
+        self._sessions.pop(user_id, None)
+        self._chats.pop(user_id, None)
+        self._last_seen[user_id] = last_seen
+        self._last_seen.move_to_end(user_id)
+        while len(self._last_seen) > self.last_seen_size:
+            self._last_seen.popitem(last=False)
+        return change
+
+    def _expire(self, now: float):
+        """Истекшие по TTL записи (воркер упал, клиент пропал без закрытия сокета)"""
+        online_changes, typing_changes = [], []
+        for user_id, sessions in list(self._sessions.items()):
+            if not any(expires_at > now for expires_at in sessions.values()):
+                # Последний визит - время последнего продления
+                last_seen = max(sessions.values(), default=now) - self.ttl
+                online_changes.append(self._go_offline(user_id, max(last_seen, 0)))
+        for user_id, (chat_id, expires_at) in list(self._typing.items()):
+            if expires_at <= now:
+                del self._typing[user_id]
+                typing_changes.append({"chat_id": chat_id, "user_id": user_id, "typing": False})
+        return online_changes, typing_changes
+
+    async def _notify(self, online_changes: list, typing_changes: list):
+        # Все изменения для одного получателя уходят одним кадром
+        frames: Dict[int, dict] = {}
+        for entry, chat_ids in online_changes:
+            for recipient in self._recipients(chat_ids, entry["user_id"]):
+                frames.setdefault(recipient, {ONLINE: [], TYPING: []})[ONLINE].append(entry)
+        for entry in typing_changes:
+            for recipient in self._recipients((entry["chat_id"],), entry["user_id"]):
+                frames.setdefault(recipient, {ONLINE: [], TYPING: []})[TYPING].append(entry)
+        if frames:
+            await asyncio.gather(*(
+                self.manager.send_to_users([recipient], {"type": "presence", "data": frame})
+                for recipient, frame in frames.items()
+            ))
+
+    def _recipients(self, chat_ids: Iterable[int], user_id: int) -> set:
+        recipients = set()
+        for chat_id in chat_ids:
+            recipients.update(self.manager.chat_members(chat_id))
+        recipients.discard(user_id)
+        return recipients
@@ -0,0 +1,200 @@
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, desc, func, insert, select, update
+from sqlalchemy.orm import joinedload, selectinload
+
+from app.database import User, Chat, ChatParticipant, Message, ChatSummary, ChangeLog, MessageShardWatermark, \
+    CHANGE_MESSAGE
+
+# Построители горячих запросов. Эндпоинты выполняют именно эти выражения, а query_plans.py
+# проверяет их планы (manage.py check-query-plans) - при изменении запроса проверка видит новый план
+
+
+def user_by_username(username: str):
+    return select(User).where(User.username == username)
+
+
+def active_user_by_id(user_id: int):
+    return select(User).where(User.id == user_id, User.is_active == True)
+
+
+def chat_member_ids(chat_id: int):
+    """Участники чата: проверка участия и получатели рассылки"""
+    return select(ChatParticipant.user_id).where(ChatParticipant.chat_id == chat_id)
+
+
+def chat_participants(chat_ids: Iterable[int]):
+    return select(ChatParticipant).where(ChatParticipant.chat_id.in_(list(chat_ids)))
+
+
+def user_chat_ids(user_id: int):
+    return select(ChatParticipant.chat_id).where(ChatParticipant.user_id == user_id)
+
+
+def chat_list(user_id: int, chat_ids: Optional[List[int]] = None):
+    """Чаты пользователя (все или только chat_ids), новые сверху; участники - одним доп. запросом"""
+    query = select(Chat).join(ChatParticipant).where(
+        ChatParticipant.user_id == user_id,
+        Chat.is_active == True
+    )
+    if chat_ids is not None:
+        query = query.where(Chat.id.in_(chat_ids))
+    return query.options(
+        selectinload(Chat.participants).joinedload(ChatParticipant.user)
+    ).order_by(desc(Chat.updated_at))
+
+
+def last_messages(chat_ids: List[int], use_summary: bool):
+    """Последние сообщения чатов: по сводкам или по индексу (chat_id, id)"""
+    if use_summary:
+        last_message_ids = select(ChatSummary.last_message_id).where(ChatSummary.chat_id.in_(chat_ids))
+    else:
+        last_message_ids = select(func.max(Message.id)).where(
+            Message.chat_id.in_(chat_ids)
+        ).group_by(Message.chat_id)
+    return select(Message).where(Message.id.in_(last_message_ids)).options(joinedload(Message.sender))
+
+
+def messages_by_ids(message_ids: List[int]):
+    return select(Message).where(Message.id.in_(message_ids)).options(joinedload(Message.sender))
+
+
+def history_page(chat_id: int, limit: int, before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Страница истории по курсору (limit + 1 строк - признак продолжения): поиск по индексу
+    (chat_id, id) вместо OFFSET. after_id - более новые по возрастанию, иначе - более старые по убыванию"""
+    query = select(Message).where(Message.chat_id == chat_id).options(joinedload(Message.sender))
+    if after_id is not None:
+        return query.where(Message.id > after_id).order_by(Message.id).limit(limit + 1)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    return query.order_by(desc(Message.id)).limit(limit + 1)
+
+
+def last_message_id(chat_id: int):
+    return select(func.max(Message.id)).where(Message.chat_id == chat_id)
+
+
+def applied_message_id(shard: int):
+    """До какого id сообщения шарда каталог уже обновлен"""
+    return select(MessageShardWatermark.last_message_id).where(
+        MessageShardWatermark.shard == shard
+    ).scalar_subquery()
+
+
+def unread_after(chat_id: int, user_id: int, message_id: int, applied_up_to=None):
+    """Число сообщений других участников после message_id; applied_up_to - только сообщения,
+    уже учтенные в счетчиках (остальные добавит unread_increment при обновлении каталога)"""
+    query = select(func.count(Message.id)).where(
+        Message.chat_id == chat_id,
+        Message.id > message_id,
+        Message.sender_id != user_id
+    )
+    if applied_up_to is not None:
+        query = query.where(Message.id <= applied_up_to)
+    return query.scalar_subquery()
+
+
+def read_cursor_update(chat_id: int, user_id: int, read_up_to: int, applied_up_to=None):
+    """Сдвиг курсора только вперед с пересчетом счетчика непрочитанных"""
+    return update(ChatParticipant).where(
+        ChatParticipant.chat_id == chat_id,
+        ChatParticipant.user_id == user_id,
+        ChatParticipant.last_read_message_id < read_up_to
+    ).values(
+        last_read_message_id=read_up_to,
+        unread_count=unread_after(chat_id, user_id, read_up_to, applied_up_to)
+    )
+
+
+def read_cursor(chat_id: int, user_id: int):
+    return select(ChatParticipant.last_read_message_id).where(
+        ChatParticipant.chat_id == chat_id,
+        ChatParticipant.user_id == user_id
+    )
+
+
+def unread_increment():
+    """+1 непрочитанное у участников, кроме отправителя, чей курсор еще до сообщения (при шардировании
+    курсор может уйти вперед раньше, чем каталог обновлен). executemany: b_chat_id, b_sender_id, b_message_id"""
+    participant_table = ChatParticipant.__table__
+    return update(participant_table).where(
+        participant_table.c.chat_id == bindparam("b_chat_id"),
+        participant_table.c.user_id != bindparam("b_sender_id"),
+        participant_table.c.last_read_message_id < bindparam("b_message_id")
+    ).values(unread_count=participant_table.c.unread_count + 1)
+
+
+def directory_updates(messages: List[dict]) -> List[Tuple[object, List[dict]]]:
+    """Обновления каталога по новым сообщениям (id, chat_id, sender_id, created_at):
+    пары (выражение, параметры executemany) - время обновления и сводки чатов,
+    счетчики непрочитанных и журнал изменений"""
+    chats = {}
+    for message in messages:
+        last_id, count, updated_at = chats.get(message["chat_id"], (0, 0, message["created_at"]))
+        chats[message["chat_id"]] = (
+            max(last_id, message["id"]), count + 1, max(updated_at, message["created_at"])
+        )
+
+    chat_table = Chat.__table__
+    summary_table = ChatSummary.__table__
+    return [
+        (
+            update(chat_table).where(chat_table.c.id == bindparam("b_chat_id")).values(
+                updated_at=bindparam("b_updated_at")
+            ),
+            [{"b_chat_id": chat_id, "b_updated_at": updated_at} for chat_id, (_, _, updated_at) in chats.items()]
+        ),
+        (
+            update(summary_table).where(summary_table.c.chat_id == bindparam("b_chat_id")).values(
+                last_message_id=bindparam("b_last_id"),
+                message_count=summary_table.c.message_count + bindparam("b_count")
+            ),
+            [
+                {"b_chat_id": chat_id, "b_last_id": last_id, "b_count": count}
+                for chat_id, (last_id, count, _) in chats.items()
+            ]
+        ),
+        (
+            unread_increment(),
+            [
+                {"b_chat_id": message["chat_id"], "b_sender_id": message["sender_id"], "b_message_id": message["id"]}
+                for message in messages
+            ]
+        ),
+        (
+            insert(ChangeLog),
+            [
+                {"chat_id": message["chat_id"], "kind": CHANGE_MESSAGE, "entity_id": message["id"],
+                 "created_at": message["created_at"]}
+                for message in messages
+            ]
+        ),
+    ]
+
+
+def known_client_msg_ids(keys: List[tuple]):
+    """Сохраненные сообщения для пар (sender_id, client_msg_id). SQLite не ищет по индексу
+    для IN со списком пар, поэтому условие - два IN по колонкам индекса; результат может содержать
+    лишние сочетания, вызывающий отбирает нужные пары"""
+    return select(Message.sender_id, Message.client_msg_id, Message.id).where(
+        Message.sender_id.in_({sender_id for sender_id, _ in keys}),
+        Message.client_msg_id.in_({client_msg_id for _, client_msg_id in keys})
+    )
+
+
+def sent_messages(sender_id: int, client_msg_ids: List[str]):
+    return select(Message).options(selectinload(Message.sender)).where(
+        Message.sender_id == sender_id, Message.client_msg_id.in_(client_msg_ids)
+    )
+
+
+def private_chat_id(pair_low_id: int, pair_high_id: int):
+    return select(Chat.id).where(Chat.pair_low_id == pair_low_id, Chat.pair_high_id == pair_high_id)
+
+
+def changes_since(user_id: int, since: int, limit: int):
+    """Изменения в чатах пользователя после курсора (limit + 1 строк - признак продолжения)"""
+    return select(ChangeLog).where(
+        ChangeLog.chat_id.in_(user_chat_ids(user_id)),
+        ChangeLog.id > since
+    ).order_by(ChangeLog.id).limit(limit + 1)
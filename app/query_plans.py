@@ -0,0 +1,86 @@
+import re
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+from app import queries
+from app.database import Chat
+
+
+def _directory_update(position: int):
+    """Обновление каталога по сообщению (queries.directory_updates): выражение и параметры одной строки"""
+    statement, parameters = queries.directory_updates([
+        {"id": 10, "chat_id": 1, "sender_id": 1, "created_at": datetime(2024, 1, 1)}
+    ])[position]
+    return statement, parameters[0]
+
+
+# Горячие запросы - те же построители, что выполняют эндпоинты (app/queries.py), с произвольными
+# параметрами; выражения с параметрами executemany - парой (выражение, параметры).
+# Новый горячий запрос в routers.py нужно вынести в queries.py и добавить сюда
+HOT_QUERIES = {
+    # Вход и проверка токена
+    "user_by_username": queries.user_by_username("alice"),
+    "user_by_id": queries.active_user_by_id(1),
+    # Проверка участия: отправка, история, прочтение
+    "chat_members": queries.chat_member_ids(1),
+    "chat_participants": queries.chat_participants([1, 2]),
+    # Чаты пользователя: WebSocket, список чатов, /sync
+    "user_chats": queries.user_chat_ids(1),
+    "chat_list": queries.chat_list(1),
+    "chat_list_subset": queries.chat_list(1, [1, 2, 3]),
+    # Последние сообщения чатов списка (по каждому шарду - для его чатов)
+    "last_messages": queries.last_messages([1, 2, 3], use_summary=False),
+    "last_messages_summary": queries.last_messages([1, 2, 3], use_summary=True),
+    "messages_by_ids": queries.messages_by_ids([1, 2, 3]),
+    # История: последняя страница, листание назад и вперед
+    "history_latest": queries.history_page(1, 50),
+    "history_before": queries.history_page(1, 50, before_id=1000),
+    "history_after": queries.history_page(1, 50, after_id=1000),
+    "last_message_id": queries.last_message_id(1),
+    "read_cursor_update": queries.read_cursor_update(1, 1, 10),
+    "read_cursor_update_shard": queries.read_cursor_update(1, 1, 10, queries.applied_message_id(1)),
+    "read_cursor": queries.read_cursor(1, 1),
+    # Отправка: обновление каталога (чат, сводка, счетчики непрочитанных) и поиск повторов по client_msg_id
+    "chat_touch": _directory_update(0),
+    "summary_update": _directory_update(1),
+    "unread_increment": _directory_update(2),
+    "known_client_msg_ids": queries.known_client_msg_ids([(1, "a"), (2, "b")]),
+    "client_msg_replay": queries.sent_messages(1, ["a", "b"]),
+    "existing_private_chat": queries.private_chat_id(1, 2),
+    "sync_changes": queries.changes_since(1, 1000, 500),
+}
+
+# Полный просмотр таблицы или всего индекса: "SCAN messages", "SCAN messages USING INDEX ..."
+# (поиск по индексу выглядит как "SEARCH messages USING INDEX ...")
+_FULL_SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+
+def explain(connection, query) -> List[str]:
+    if not isinstance(query, tuple):
+        sql = str(query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+        return [row[-1] for row in connection.execute(text("EXPLAIN QUERY PLAN " + sql))]
+    # Параметры executemany не подставить через literal_binds - передаются драйверу
+    statement, parameters = query
+    compiled = statement.compile(dialect=connection.dialect)
+    values = compiled.construct_params(parameters)
+    plan = connection.exec_driver_sql(
+        "EXPLAIN QUERY PLAN " + str(compiled), tuple(values[name] for name in compiled.positiontup)
+    )
+    return [row[-1] for row in plan]
+
+
+def find_full_scans(connection) -> Dict[str, Tuple[List[str], List[str]]]:
+    """Запросы, план которых содержит полный просмотр таблицы: имя -> (таблицы, план)"""
+    tables = {table.name for table in Chat.metadata.sorted_tables}
+    problems = {}
+    for name, statement in HOT_QUERIES.items():
+        plan = explain(connection, statement)
+        scanned = [
+            match.group(1) for match in map(_FULL_SCAN_RE.match, plan)
+            if match is not None and match.group(1) in tables
+        ]
+        if scanned:
+            problems[name] = (scanned, plan)
+    return problems
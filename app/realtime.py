@@ -0,0 +1,117 @@
+import asyncio
+from typing import Dict, Iterable, List, Set
+
+from fastapi import WebSocket
+
+from app.auth import token_cache
+from app.broker import broker
+from app.config import settings
+from app.presence import PresenceService
+
+
+# Реестр WebSocket-подключений внутри процесса
+class ConnectionManager:
+    def __init__(self):
+        # user_id -> открытые сокеты пользователя (несколько вкладок/устройств)
+        self._user_connections: Dict[int, Set[WebSocket]] = {}
+        # chat_id -> подключенные участники чата
+        self._chat_members: Dict[int, Set[int]] = {}
+        # user_id -> чаты, в которых состоит подключенный пользователь
+        self._user_chats: Dict[int, Set[int]] = {}
+
+    async def connect(self, user_id: int, websocket: WebSocket, chat_ids: Iterable[int]):
+        await websocket.accept()
+        self._user_connections.setdefault(user_id, set()).add(websocket)
+        for chat_id in chat_ids:
+            self._add_member(chat_id, user_id)
+
+    def disconnect(self, user_id: int, websocket: WebSocket):
+        sockets = self._user_connections.get(user_id)
+        if sockets is None:
+            return
+
+        sockets.discard(websocket)
+        if sockets:
+            return
+
+        # Последнее подключение закрыто - убираем пользователя из индекса чатов
+        del self._user_connections[user_id]
+        for chat_id in self._user_chats.pop(user_id, set()):
+            members = self._chat_members.get(chat_id)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self._chat_members[chat_id]
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self._user_connections
+
+    def user_chat_ids(self, user_id: int) -> Set[int]:
+        return self._user_chats.get(user_id, set())
+
+    def chat_members(self, chat_id: int) -> Set[int]:
+        """Подключенные к этому воркеру участники чата"""
+        return self._chat_members.get(chat_id, set())
+
+    def join_chat(self, chat_id: int, user_ids: Iterable[int]):
+        """Добавление подключенных пользователей в индекс нового чата"""
+        for user_id in user_ids:
+            if user_id in self._user_connections:
+                self._add_member(chat_id, user_id)
+
+    def _add_member(self, chat_id: int, user_id: int):
+        self._chat_members.setdefault(chat_id, set()).add(user_id)
+        self._user_chats.setdefault(user_id, set()).add(chat_id)
+
+    async def send_to_users(self, user_ids: Iterable[int], payload: dict):
+        targets: List[tuple] = []
+        for user_id in set(user_ids):
+            for websocket in self._user_connections.get(user_id, ()):
+                targets.append((user_id, websocket))
+
+        if not targets:
+            return
+
+        results = await asyncio.gather(
+            *(websocket.send_json(payload) for _, websocket in targets),
+            return_exceptions=True
+        )
+
+        # Закрытые сокеты удаляем из реестра
+        for (user_id, websocket), result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.disconnect(user_id, websocket)
+
+    async def send_to_chat(self, chat_id: int, payload: dict):
+        await self.send_to_users(list(self._chat_members.get(chat_id, ())), payload)
+
+
+manager = ConnectionManager()
+presence = PresenceService(
+    manager,
+    ttl=settings.presence_ttl,
+    typing_ttl=settings.typing_ttl,
+    flush_interval=settings.presence_flush_interval_ms / 1000,
+    last_seen_size=settings.presence_last_seen_size
+)
+
+
+async def publish_to_users(user_ids: Iterable[int], payload: dict):
+    """Публикация события через брокер, чтобы его получили воркеры всех процессов"""
+    await broker.publish({"user_ids": list(user_ids), "payload": payload})
+
+
+async def publish_user_changed(user_id: int):
+    """Сброс кэша токенов пользователя во всех воркерах (аватар, деактивация)"""
+    await broker.publish({"invalidate_user_id": user_id})
+
+
+async def handle_event(event: dict):
+    """Обработка события из брокера в текущем воркере"""
+    if "invalidate_user_id" in event:
+        token_cache.invalidate_user(event["invalidate_user_id"])
+        return
+    if "presence" in event:
+        await presence.apply(event["presence"])
+        return
+    await manager.send_to_users(event["user_ids"], event["payload"])
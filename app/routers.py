@@ -1,15 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, status
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, status, WebSocket, \
+    WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import or_, and_, desc, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, func, select, update, insert, literal
+from sqlalchemy.exc import IntegrityError
+import json
 from typing import List, Optional
 from datetime import datetime
-import os
-import uuid
 
-from app.database import get_db, User, Chat, ChatParticipant, Message, ChatType
-from app.auth import hash_password, verify_password, create_access_token, get_current_user
-from pydantic import BaseModel, EmailStr
-import shutil
+from app.database import get_db, get_read_db, get_async_db, get_read_shard_db, get_async_shard_db, ShardSessions, \
+    ReadSessionLocal, User, Chat, ChatParticipant, Message, ChatType, ChatSummary, \
+    ChangeLog, CHANGE_CHAT, CHANGE_PARTICIPANT, CHANGE_MESSAGE, CHANGE_READ, message_shards
+from app.config import settings
+from app import queries
+from app.auth import create_access_token, get_current_user, authenticate_token, password_hasher, UserSnapshot
+from app.realtime import manager, presence, publish_to_users, publish_user_changed
+from app.ingest import message_writer, store_messages
+from app.sharding import directory_applier
+from app.search import SEARCH_ENABLED, search_message_shards, search_users as search_users_index, user_search_cache
+from app.blobstore import blob_store
+from app.media import media_processor, variant_path, IMAGE_TYPES, AVATAR_VARIANTS, THUMBNAIL_VARIANTS
+from pydantic import BaseModel, EmailStr, Field, computed_field
 
 router = APIRouter(prefix="/api", tags=["API"])
 
@@ -35,6 +47,17 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+    # Уменьшенные аватары для списков (строятся в фоне после загрузки)
+    @computed_field
+    @property
+    def avatar_small(self) -> Optional[str]:
+        return variant_path(self.avatar_path, "avatar_small")
+
+    @computed_field
+    @property
+    def avatar_medium(self) -> Optional[str]:
+        return variant_path(self.avatar_path, "avatar_medium")
+
 
 class CreatePrivateChatRequest(BaseModel):
     target_user_id: int
@@ -48,6 +71,11 @@ class CreateGroupChatRequest(BaseModel):
 class SendMessageRequest(BaseModel):
     chat_id: int
     content: str
+    client_msg_id: Optional[str] = Field(None, max_length=64)
+
+
+class SendMessageBatchRequest(BaseModel):
+    messages: List[SendMessageRequest]
 
 
 class MessageResponse(BaseModel):
@@ -57,6 +85,9 @@ class MessageResponse(BaseModel):
     content: str
     file_path: Optional[str] = None
     file_type: Optional[str] = None
+    file_size: Optional[int] = None
+    file_sha256: Optional[str] = None
+    client_msg_id: Optional[str] = None
     is_read: bool
     created_at: datetime
     sender: UserResponse
@@ -64,6 +95,47 @@ class MessageResponse(BaseModel):
     class Config:
         from_attributes = True
 
+    # Миниатюра для изображений; оригинал - по file_path
+    @computed_field
+    @property
+    def thumbnail_path(self) -> Optional[str]:
+        if self.file_type not in IMAGE_TYPES:
+            return None
+        return variant_path(self.file_path, "thumb")
+
+
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    # Курсор для загрузки более старых сообщений (before_id), None - история закончилась
+    next_before_id: Optional[int] = None
+    # Курсор для загрузки более новых сообщений (after_id)
+    next_after_id: Optional[int] = None
+    # Есть ли еще сообщения в направлении листания
+    has_more: bool = False
+
+
+class MessageSearchResult(BaseModel):
+    message: MessageResponse
+    # Фрагмент текста в виде экранированного HTML, совпадения обернуты в <mark>...</mark>
+    snippet: str
+    rank: float
+
+
+class MessageSearchPage(BaseModel):
+    results: List[MessageSearchResult]
+    next_offset: Optional[int] = None
+
+
+class MarkReadRequest(BaseModel):
+    message_id: Optional[int] = None
+
+
+class PresenceResponse(BaseModel):
+    user_id: int
+    online: bool
+    # Для пользователей не в сети, если время визита еще помнится
+    last_seen: Optional[datetime] = None
+
 
 class ChatResponse(BaseModel):
     id: int
@@ -73,6 +145,9 @@ class ChatResponse(BaseModel):
     last_message: Optional[MessageResponse] = None
     unread_count: int = 0
     participants: List[UserResponse] = []
+    # Снимок присутствия собеседников и кто сейчас набирает текст (из памяти, без запросов к БД)
+    presence: List[PresenceResponse] = []
+    typing_user_ids: List[int] = []
     created_at: datetime
     updated_at: datetime
 
@@ -80,18 +155,45 @@ class ChatResponse(BaseModel):
         from_attributes = True
 
 
-# Папка для загрузки файлов
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-
-# Регистрация
-@router.post("/register", response_model=dict)
-def register(request: RegisterRequest, db: Session = Depends(get_db)):
-    # Проверка существующего пользователя
-    existing_user = db.query(User).filter(
-        or_(User.username == request.username, User.email == request.email)
-    ).first()
+class ReadCursorResponse(BaseModel):
+    chat_id: int
+    user_id: int
+    last_read_message_id: int
+
+
+class SyncResponse(BaseModel):
+    # Курсор для следующего запроса /sync?since=
+    cursor: int
+    # Изменений больше, чем поместилось в ответ - нужно запросить еще раз с новым курсором
+    has_more: bool = False
+    # Курсор слишком старый (журнал очищен) - клиенту нужно загрузить все заново
+    full_resync: bool = False
+    chats: List[ChatResponse] = []
+    messages: List[MessageResponse] = []
+    read_cursors: List[ReadCursorResponse] = []
+
+
+def _message_response(message: Message, current_user_id: int, participants: List[ChatParticipant]):
+    """Ответ с сообщением; is_read вычисляется по курсорам прочтения участников"""
+    response = MessageResponse.model_validate(message)
+    if message.sender_id == current_user_id:
+        # Свое сообщение прочитано, если его прочитал кто-то из собеседников
+        response.is_read = any(
+            participant.user_id != current_user_id and participant.last_read_message_id >= message.id
+            for participant in participants
+        )
+    else:
+        response.is_read = any(
+            participant.user_id == current_user_id and participant.last_read_message_id >= message.id
+            for participant in participants
+        )
+    return response
+
+
+async def _check_registration_conflict(db: AsyncSession, request: RegisterRequest):
+    existing_user = (await db.execute(
+        select(User).where(or_(User.username == request.username, User.email == request.email))
+    )).scalars().first()
 
     if existing_user:
         if existing_user.username == request.username:
@@ -99,8 +201,17 @@ def register(request: RegisterRequest, db: Session = Depends(get_db)):
         else:
             raise HTTPException(status_code=400, detail="Email already registered")
 
-    # Создание нового пользователя
-    hashed_password = hash_password(request.password)
+
+# Регистрация
+@router.post("/register", response_model=dict)
+async def register(request: RegisterRequest, db: AsyncSession = Depends(get_async_db)):
+    # Проверка существующего пользователя
+    await _check_registration_conflict(db, request)
+    # Подключение не держим, пока считается хэш
+    await db.close()
+
+    # Создание нового пользователя (bcrypt - в пуле процессов)
+    hashed_password = await password_hasher.hash(request.password)
     user = User(
         username=request.username,
         email=request.email,
@@ -108,23 +219,44 @@ def register(request: RegisterRequest, db: Session = Depends(get_db)):
     )
 
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Такое же имя или email успели зарегистрировать, пока считался хэш
+        await db.rollback()
+        await _check_registration_conflict(db, request)
+        raise
+
+    # Новый пользователь должен сразу находиться поиском
+    user_search_cache.clear()
 
     return {"success": True, "user_id": user.id, "message": "Registration successful"}
 
 
 # Логин
 @router.post("/login", response_model=dict)
-def login(request: LoginRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.username).first()
+async def login(request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(
+        queries.user_by_username(request.username)
+    )).scalars().first()
 
-    if not user or not verify_password(request.password, user.password_hash):
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    # Подключение не держим, пока проверяется пароль; поля пользователя уже загружены
+    await db.close()
+
+    # Проверка пароля в пуле процессов; при смене стоимости bcrypt получаем новый хэш
+    is_valid, new_hash = await password_hasher.verify_and_update(request.password, user.password_hash)
+    if not is_valid:
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
     if not user.is_active:
         raise HTTPException(status_code=403, detail="Account is disabled")
 
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(password_hash=new_hash))
+        await db.commit()
+
     access_token = create_access_token(data={"sub": user.username, "user_id": user.id})
 
     return {
@@ -144,23 +276,69 @@ def login(request: LoginRequest, db: Session = Depends(get_db)):
 @router.get("/users/search", response_model=List[UserResponse])
 def search_users(
         q: str = Query(..., min_length=1),
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: Session = Depends(get_read_db)
 ):
-    users = db.query(User).filter(
-        User.username.ilike(f"%{q}%"),
-        User.id != current_user.id,
-        User.is_active == True
-    ).limit(20).all()
+    # Префикс - по индексу lower(username), подстрока - по триграммному FTS-индексу
+    return search_users_index(db, q, limit=20, exclude_user_id=current_user.id)
+
+
+# Полнотекстовый поиск по сообщениям своих чатов
+@router.get("/search/messages", response_model=MessageSearchPage)
+def search_chat_messages(
+        q: str = Query(..., min_length=1, max_length=200),
+        limit: int = Query(20, ge=1, le=50),
+        offset: int = Query(0, ge=0),
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: Session = Depends(get_read_db),
+        shard_db: ShardSessions = Depends(get_read_shard_db)
+):
+    if not SEARCH_ENABLED:
+        raise HTTPException(status_code=501, detail="Message search is not supported by this database")
+
+    found = search_message_shards(shard_db.all(), current_user.id, q, limit + 1, offset)
+    has_more = len(found) > limit
+    found = found[:limit]
+    rows = [row for _, row in found]
+
+    # Сообщения - из тех шардов, где они найдены
+    ids_by_session = {}
+    for session, row in found:
+        ids_by_session.setdefault(session, []).append(row.id)
+    messages = {
+        message.id: message
+        for session, message_ids in ids_by_session.items()
+        for message in session.query(Message).filter(
+            Message.id.in_(message_ids)
+        ).options(joinedload(Message.sender)).all()
+    }
+
+    # Участники найденных чатов - для статуса прочтения
+    participants_by_chat = {}
+    for participant in db.query(ChatParticipant).filter(
+        ChatParticipant.chat_id.in_({message.chat_id for message in messages.values()})
+    ).all():
+        participants_by_chat.setdefault(participant.chat_id, []).append(participant)
+
+    results = [
+        MessageSearchResult(
+            message=_message_response(
+                messages[row.id], current_user.id, participants_by_chat[messages[row.id].chat_id]
+            ),
+            snippet=row.snippet,
+            rank=row.rank
+        )
+        for row in rows
+    ]
 
-    return users
+    return MessageSearchPage(results=results, next_offset=offset + limit if has_more else None)
 
 
 # Создание личного чата
 @router.post("/chats/private", response_model=dict)
 def create_private_chat(
         request: CreatePrivateChatRequest,
-        current_user: User = Depends(get_current_user),
+        current_user: UserSnapshot = Depends(get_current_user),
         db: Session = Depends(get_db)
 ):
     # Проверка существования целевого пользователя
@@ -175,41 +353,49 @@ def create_private_chat(
     if target_user.id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot create chat with yourself")
 
-    # Проверка существующего личного чата
-
-    existing_chat = db.query(Chat).join(ChatParticipant).filter(
-        Chat.chat_type == ChatType.PRIVATE
-    ).filter(
-        ChatParticipant.user_id.in_([current_user.id, target_user.id])
-    ).group_by(Chat.id).having(func.count(ChatParticipant.id) == 2).first()
+    # Проверка существующего личного чата - по ключу пары (один поиск по индексу)
+    pair_low_id, pair_high_id = sorted((current_user.id, target_user.id))
+    existing_chat_id = db.scalar(queries.private_chat_id(pair_low_id, pair_high_id))
 
-    if existing_chat:
+    if existing_chat_id is not None:
         return {
             "success": True,
-            "chat_id": existing_chat.id,
+            "chat_id": existing_chat_id,
             "message": "Chat already exists",
             "is_new": False
         }
 
-    # Создание нового чата
+    # Создание чата с участниками одной транзакцией
     chat = Chat(
         chat_type=ChatType.PRIVATE,
-        creator_id=current_user.id
+        creator_id=current_user.id,
+        pair_low_id=pair_low_id,
+        pair_high_id=pair_high_id
     )
-
     db.add(chat)
-    db.commit()
-    db.refresh(chat)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Собеседник одновременно создал тот же чат - уникальный индекс пары пропустил только один
+        db.rollback()
+        existing_chat_id = db.scalar(queries.private_chat_id(pair_low_id, pair_high_id))
+        return {
+            "success": True,
+            "chat_id": existing_chat_id,
+            "message": "Chat already exists",
+            "is_new": False
+        }
 
-    # Добавление участников
-    participants = [
+    db.add_all([
         ChatParticipant(chat_id=chat.id, user_id=current_user.id),
         ChatParticipant(chat_id=chat.id, user_id=target_user.id)
-    ]
-
-    db.add_all(participants)
+    ])
+    db.add(ChatSummary(chat_id=chat.id, message_count=0))
+    db.add(ChangeLog(chat_id=chat.id, kind=CHANGE_CHAT))
     db.commit()
 
+    manager.join_chat(chat.id, [current_user.id, target_user.id])
+
     return {
         "success": True,
         "chat_id": chat.id,
@@ -222,7 +408,7 @@ def create_private_chat(
 @router.post("/chats/group", response_model=dict)
 def create_group_chat(
         request: CreateGroupChatRequest,
-        current_user: User = Depends(get_current_user),
+        current_user: UserSnapshot = Depends(get_current_user),
         db: Session = Depends(get_db)
 ):
     if not request.name:
@@ -259,8 +445,12 @@ def create_group_chat(
             participants.append(ChatParticipant(chat_id=chat.id, user_id=user_id))
 
     db.add_all(participants)
+    db.add(ChatSummary(chat_id=chat.id, message_count=0))
+    db.add(ChangeLog(chat_id=chat.id, kind=CHANGE_CHAT))
     db.commit()
 
+    manager.join_chat(chat.id, [participant.user_id for participant in participants])
+
     return {
         "success": True,
         "chat_id": chat.id,
@@ -270,34 +460,29 @@ def create_group_chat(
 
 
 
-# Получение списка чатов пользователя
-@router.get("/chats", response_model=List[ChatResponse])
-def get_user_chats(
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
-):
-    # Получаем все чаты пользователя
-    chats = db.query(Chat).join(ChatParticipant).filter(
-        ChatParticipant.user_id == current_user.id,
-        Chat.is_active == True
-    ).options(
-        joinedload(Chat.participants).joinedload(ChatParticipant.user),
-        joinedload(Chat.messages)
-    ).order_by(desc(Chat.updated_at)).all()
+def _build_chat_list(db: Session, shard_db: ShardSessions, current_user_id: int,
+                     chat_ids: Optional[List[int]] = None) -> List[ChatResponse]:
+    """Чаты пользователя с последним сообщением и числом непрочитанных (все или только chat_ids)"""
+    # Получаем чаты пользователя (участники подгружаются одним дополнительным запросом)
+    chats = db.scalars(queries.chat_list(current_user_id, chat_ids)).all()
+
+    # Последнее сообщение каждого чата - одним запросом на шард
+    last_messages = {}
+    for session, shard_chat_ids in shard_db.for_chats(chat.id for chat in chats):
+        for message in session.scalars(queries.last_messages(shard_chat_ids, settings.inbox_use_summary)):
+            last_messages[message.chat_id] = message
+
+    typing = presence.typing_by_chat(chat.id for chat in chats)
 
     result = []
     for chat in chats:
-        # Получаем последнее сообщение
-        last_message = None
-        if chat.messages:
-            last_message = sorted(chat.messages, key=lambda x: x.created_at, reverse=True)[0]
-
-        # Считаем непрочитанные сообщения
-        unread_count = db.query(Message).filter(
-            Message.chat_id == chat.id,
-            Message.sender_id != current_user.id,
-            Message.is_read == False
-        ).count()
+        # Число непрочитанных хранится в строке участника (ChatParticipant.unread_count)
+        unread_count = next(
+            (p.unread_count for p in chat.participants if p.user_id == current_user_id), 0
+        )
+        last_message = last_messages.get(chat.id)
+        if last_message is not None:
+            last_message = _message_response(last_message, current_user_id, chat.participants)
 
         # Формируем список участников
         participants = [participant.user for participant in chat.participants]
@@ -305,7 +490,7 @@ def get_user_chats(
         # Для личного чата определяем собеседника
         chat_name = chat.chat_name
         if chat.chat_type == ChatType.PRIVATE:
-            other_participant = next((p for p in participants if p.id != current_user.id), None)
+            other_participant = next((p for p in participants if p.id != current_user_id), None)
             if other_participant:
                 chat_name = other_participant.username
 
@@ -317,6 +502,8 @@ def get_user_chats(
             last_message=last_message,
             unread_count=unread_count,
             participants=participants,
+            presence=presence.snapshot(p.id for p in participants if p.id != current_user_id),
+            typing_user_ids=[user_id for user_id in typing.get(chat.id, []) if user_id != current_user_id],
             created_at=chat.created_at,
             updated_at=chat.updated_at
         ))
@@ -324,44 +511,174 @@ def get_user_chats(
     return result
 
 
+# Получение списка чатов пользователя
+@router.get("/chats", response_model=List[ChatResponse])
+def get_user_chats(
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: Session = Depends(get_read_db),
+        shard_db: ShardSessions = Depends(get_read_shard_db)
+):
+    return _build_chat_list(db, shard_db, current_user.id)
+
+
+# Изменения с момента последней синхронизации клиента (после переподключения)
+@router.get("/sync", response_model=SyncResponse)
+def sync_changes(
+        since: Optional[int] = Query(None, ge=0),
+        limit: int = Query(500, ge=1, le=1000),
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: Session = Depends(get_read_db),
+        shard_db: ShardSessions = Depends(get_read_shard_db)
+):
+    # SQLite выполняет записи по одной, поэтому номера в журнале появляются в порядке фиксации
+    latest = db.query(func.max(ChangeLog.id)).scalar() or 0
+
+    # Без курсора клиент получает текущую позицию и загружает все обычными запросами
+    if since is None:
+        return SyncResponse(cursor=latest, full_resync=True)
+
+    oldest = db.query(func.min(ChangeLog.id)).scalar()
+    if since > latest or (oldest is not None and since < oldest - 1):
+        return SyncResponse(cursor=latest, full_resync=True)
+
+    changes = db.scalars(queries.changes_since(current_user.id, since, limit)).all()
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if not changes:
+        return SyncResponse(cursor=latest)
+
+    changed_chat_ids = sorted({change.chat_id for change in changes})
+    message_chats = {change.entity_id: change.chat_id for change in changes if change.kind == CHANGE_MESSAGE}
+    read_keys = {(change.chat_id, change.entity_id) for change in changes if change.kind == CHANGE_READ}
+
+    # Участники нужны для is_read и для актуальных курсоров прочтения
+    participants_by_chat = {}
+    for participant in db.scalars(queries.chat_participants(changed_chat_ids)):
+        participants_by_chat.setdefault(participant.chat_id, []).append(participant)
+
+    # Сообщения - из шардов их чатов
+    messages = []
+    for session, shard_chat_ids in shard_db.for_chats(sorted(set(message_chats.values()))):
+        shard_chat_ids = set(shard_chat_ids)
+        message_ids = [message_id for message_id, chat_id in message_chats.items() if chat_id in shard_chat_ids]
+        messages.extend(session.scalars(queries.messages_by_ids(message_ids)))
+    messages = [
+        _message_response(message, current_user.id, participants_by_chat.get(message.chat_id, []))
+        for message in sorted(messages, key=lambda message: message.id)
+    ]
+
+    read_cursors = [
+        ReadCursorResponse(
+            chat_id=participant.chat_id,
+            user_id=participant.user_id,
+            last_read_message_id=participant.last_read_message_id
+        )
+        for chat_id in changed_chat_ids
+        for participant in participants_by_chat.get(chat_id, [])
+        if (participant.chat_id, participant.user_id) in read_keys
+    ]
+
+    return SyncResponse(
+        cursor=changes[-1].id if has_more else max(latest, changes[-1].id),
+        has_more=has_more,
+        chats=_build_chat_list(db, shard_db, current_user.id, changed_chat_ids),
+        messages=messages,
+        read_cursors=read_cursors
+    )
+
+
 # Получение сообщений чата
-@router.get("/chats/{chat_id}/messages", response_model=List[MessageResponse])
+@router.get("/chats/{chat_id}/messages", response_model=MessagePage)
 def get_chat_messages(
         chat_id: int,
-        skip: int = Query(0, ge=0),
+        before_id: Optional[int] = Query(None, ge=1),
+        after_id: Optional[int] = Query(None, ge=0),
         limit: int = Query(50, ge=1, le=100),
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        current_user: UserSnapshot = Depends(get_current_user),
+        shard_db: ShardSessions = Depends(get_read_shard_db)
 ):
-    # Проверка участия в чате
-    participation = db.query(ChatParticipant).filter(
-        ChatParticipant.chat_id == chat_id,
-        ChatParticipant.user_id == current_user.id
-    ).first()
+    # Все запросы - через сессию шарда чата (участники и отправители видны в ней через каталог)
+    db = shard_db.for_chat(chat_id)
+
+    # Проверка участия в чате (курсоры остальных участников нужны для статуса прочтения)
+    participants = db.scalars(queries.chat_participants([chat_id])).all()
 
-    if not participation:
+    if not any(participant.user_id == current_user.id for participant in participants):
         raise HTTPException(status_code=403, detail="Not a participant of this chat")
 
-    # Получение сообщений
-    messages = db.query(Message).filter(
-        Message.chat_id == chat_id
-    ).options(
-        joinedload(Message.sender)
-    ).order_by(desc(Message.created_at)).offset(skip).limit(limit).all()
-
-    # Помечаем сообщения как прочитанные
-    unread_messages = db.query(Message).filter(
-        Message.chat_id == chat_id,
-        Message.sender_id != current_user.id,
-        Message.is_read == False
-    ).all()
+    # Получение сообщений по курсору: поиск по индексу (chat_id, id) вместо OFFSET
+    messages = db.scalars(queries.history_page(chat_id, limit, before_id, after_id)).all()
+    has_more = len(messages) > limit
+    if after_id is not None:
+        # Более новые сообщения (догрузка после переподключения)
+        messages = messages[:limit]
+    else:
+        messages = list(reversed(messages[:limit]))  # Возвращаем в хронологическом порядке
+
+    # Чтение больше не изменяет сообщения - прочтение фиксируется через /chats/{chat_id}/read
+    return MessagePage(
+        messages=[_message_response(message, current_user.id, participants) for message in messages],
+        next_before_id=messages[0].id if has_more and after_id is None else None,
+        next_after_id=messages[-1].id if messages else after_id,
+        has_more=has_more
+    )
 
-    for msg in unread_messages:
-        msg.is_read = True
 
-    db.commit()
+# Отметка сообщений чата как прочитанных (сдвиг курсора участника)
+@router.post("/chats/{chat_id}/read", response_model=dict)
+async def mark_chat_read(
+        chat_id: int,
+        request: Optional[MarkReadRequest] = None,
+        current_user: UserSnapshot = Depends(get_current_user),
+        shard_db: ShardSessions = Depends(get_async_shard_db)
+):
+    db = shard_db.for_chat(chat_id)
+    participant_ids = (await db.execute(queries.chat_member_ids(chat_id))).scalars().all()
+
+    if current_user.id not in participant_ids:
+        raise HTTPException(status_code=403, detail="Not a participant of this chat")
+
+    # По умолчанию - до последнего сообщения чата
+    read_up_to = request.message_id if request else None
+    if read_up_to is None:
+        read_up_to = (await db.execute(queries.last_message_id(chat_id))).scalar() or 0
 
-    return list(reversed(messages))  # Возвращаем в хронологическом порядке
+    # Курсор двигается только вперед; счетчик непрочитанных пересчитывается по сообщениям
+    # после нового курсора (при прочтении до конца - пустой диапазон индекса, счетчик 0).
+    # В шарде считаются только сообщения, уже учтенные каталогом: остальные прибавит DirectoryApplier
+    shard = message_shards.shard_of(chat_id)
+    applied_up_to = queries.applied_message_id(shard) if shard is not None else None
+    moved = await db.execute(queries.read_cursor_update(chat_id, current_user.id, read_up_to, applied_up_to))
+    if moved.rowcount:
+        db.add(ChangeLog(chat_id=chat_id, kind=CHANGE_READ, entity_id=current_user.id))
+    await db.commit()
+
+    cursor = (await db.execute(queries.read_cursor(chat_id, current_user.id))).scalar()
+
+    await publish_to_users(participant_ids, {
+        "type": "read",
+        "data": {"chat_id": chat_id, "user_id": current_user.id, "last_read_message_id": cursor}
+    })
+
+    return {"success": True, "chat_id": chat_id, "last_read_message_id": cursor}
+
+
+async def _find_sent_messages(db: AsyncSession, sender_id: int, client_msg_ids: List[str]) -> dict:
+    """Уже сохраненные сообщения отправителя по client_msg_id (повторная отправка)"""
+    messages = (await db.execute(queries.sent_messages(sender_id, client_msg_ids))).scalars().all()
+    if not messages:
+        return {}
+
+    participants = (await db.execute(
+        queries.chat_participants({message.chat_id for message in messages})
+    )).scalars().all()
+    return {
+        message.client_msg_id: _message_response(
+            message, sender_id, [participant for participant in participants if participant.chat_id == message.chat_id]
+        )
+        for message in messages
+    }
 
 
 # Отправка сообщения
@@ -370,92 +687,221 @@ async def send_message(
         chat_id: int = Form(...),
         content: str = Form(...),
         file: Optional[UploadFile] = File(None),
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        client_msg_id: Optional[str] = Form(None, max_length=64),
+        current_user: UserSnapshot = Depends(get_current_user),
+        shard_db: ShardSessions = Depends(get_async_shard_db)
 ):
-    # Проверка участия в чате
-    participation = db.query(ChatParticipant).filter(
-        ChatParticipant.chat_id == chat_id,
-        ChatParticipant.user_id == current_user.id
-    ).first()
+    # Сообщение пишется в сессии шарда чата (без шардирования - вместе со сводками и счетчиками)
+    db = shard_db.for_chat(chat_id)
+
+    # Проверка участия в чате (заодно получаем получателей для рассылки)
+    participant_ids = (await db.execute(queries.chat_member_ids(chat_id))).scalars().all()
 
-    if not participation:
+    if current_user.id not in participant_ids:
         raise HTTPException(status_code=403, detail="Not a participant of this chat")
 
+    # Повтор запроса после таймаута: возвращаем уже сохраненное сообщение, файл не загружаем заново
+    if client_msg_id:
+        replayed = await _find_sent_messages(db, current_user.id, [client_msg_id])
+        if replayed:
+            return replayed[client_msg_id]
+
+    # Проверки закончены: подключение возвращается в пул на время загрузки файла и ожидания
+    # пакета писателя, иначе параллельные отправки ждали бы подключение, а не попадали в пакет
+    await db.commit()
+
     # Обработка файла
     file_path = None
     file_type = None
+    file_size = None
+    file_sha256 = None
 
     if file:
-        # Генерируем уникальное имя файла
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
         file_type = file.content_type
 
-        # Сохраняем файл
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Файл пишется по частям в хранилище по хэшу: повторная отправка не создает копию
+        stored = await blob_store.put(file, max_size=settings.max_attachment_size)
+        file_path, file_size, file_sha256 = stored.path, stored.size, stored.sha256
+        if file_type in IMAGE_TYPES:
+            media_processor.schedule(file_path, THUMBNAIL_VARIANTS)
 
     # Создание сообщения
-    message = Message(
+    created_at = datetime.utcnow()
+    values = dict(
         chat_id=chat_id,
         sender_id=current_user.id,
         content=content,
         file_path=file_path,
-        file_type=file_type
+        file_type=file_type,
+        file_size=file_size,
+        file_sha256=file_sha256,
+        client_msg_id=client_msg_id,
+        created_at=created_at,
+        updated_at=created_at
     )
 
-    db.add(message)
-
-    # Обновляем время последнего обновления чата
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    chat.updated_at = datetime.utcnow()
-
-    db.commit()
-    db.refresh(message)
+    try:
+        if message_writer is not None:
+            # Групповая запись: сообщение сохранится в общей транзакции фонового писателя
+            message_id, created = await message_writer.submit(values)
+        else:
+            [(message_id, created)] = await store_messages(db, [values])
+            await db.commit()
+    except IntegrityError:
+        # Параллельный повтор с тем же client_msg_id успел записать сообщение раньше
+        if not client_msg_id:
+            raise
+        await db.rollback()
+        created = False
+    directory_applier.notify()
+
+    if not created:
+        return (await _find_sent_messages(db, current_user.id, [client_msg_id]))[client_msg_id]
+
+    # Отправитель берется из текущего пользователя, без повторного запроса
+    response = MessageResponse(
+        id=message_id,
+        is_read=False,
+        sender=UserResponse.model_validate(current_user),
+        **values
+    )
 
-    # Загружаем отправителя для ответа
-    message.sender = current_user
+    # Рассылаем сообщение подключенным участникам
+    await publish_to_users(participant_ids, {
+        "type": "message",
+        "data": response.model_dump(mode="json")
+    })
+    presence.stop_typing(current_user.id)
+
+    return response
+
+
+# Пакетная отправка текстовых сообщений одной транзакцией (очередь клиента после потери связи;
+# при шардировании - по транзакции на шард, повтор пакета не создаст дублей благодаря client_msg_id).
+# Ответ - сообщения в порядке запроса; повторы по client_msg_id возвращают исходные сообщения
+@router.post("/messages/batch", response_model=List[MessageResponse])
+async def send_message_batch(
+        request: SendMessageBatchRequest,
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_db),
+        shard_db: ShardSessions = Depends(get_async_shard_db)
+):
+    if not request.messages:
+        return []
+    if len(request.messages) > settings.max_batch_messages:
+        raise HTTPException(
+            status_code=400, detail=f"Too many messages in batch (max {settings.max_batch_messages})"
+        )
+
+    # Участие во всех чатах пакета - одним запросом; пакет принимается целиком или отклоняется
+    chat_ids = {item.chat_id for item in request.messages}
+    members = (await db.execute(
+        select(ChatParticipant.chat_id, ChatParticipant.user_id).where(ChatParticipant.chat_id.in_(chat_ids))
+    )).all()
+    participant_ids = {}
+    for member_chat_id, user_id in members:
+        participant_ids.setdefault(member_chat_id, []).append(user_id)
+    for member_chat_id in chat_ids:
+        if current_user.id not in participant_ids.get(member_chat_id, []):
+            raise HTTPException(status_code=403, detail=f"Not a participant of chat {member_chat_id}")
+
+    created_at = datetime.utcnow()
+    rows = [
+        dict(
+            chat_id=item.chat_id,
+            sender_id=current_user.id,
+            content=item.content,
+            client_msg_id=item.client_msg_id,
+            created_at=created_at,
+            updated_at=created_at
+        )
+        for item in request.messages
+    ]
 
-    return message
+    results = [None] * len(rows)
+    replayed = {}
+    for session, shard_chat_ids in shard_db.for_chats(chat_ids):
+        positions = [position for position, values in enumerate(rows) if values["chat_id"] in shard_chat_ids]
+        shard_rows = [rows[position] for position in positions]
+        try:
+            shard_results = await store_messages(session, shard_rows)
+            await session.commit()
+        except IntegrityError:
+            # Параллельный повтор записал часть сообщений раньше - повторяем, они найдутся как уже отправленные
+            await session.rollback()
+            shard_results = await store_messages(session, shard_rows)
+            await session.commit()
+        for position, result in zip(positions, shard_results):
+            results[position] = result
+
+        replayed_ids = [values["client_msg_id"] for values, (_, created) in zip(shard_rows, shard_results) if not created]
+        if replayed_ids:
+            replayed.update(await _find_sent_messages(session, current_user.id, replayed_ids))
+    directory_applier.notify()
+
+    sender = UserResponse.model_validate(current_user)
+    responses = []
+    for values, (message_id, created) in zip(rows, results):
+        if not created:
+            responses.append(replayed[values["client_msg_id"]])
+            continue
+        response = MessageResponse(id=message_id, is_read=False, sender=sender, **values)
+        responses.append(response)
+        await publish_to_users(participant_ids[values["chat_id"]], {
+            "type": "message",
+            "data": response.model_dump(mode="json")
+        })
+
+    return responses
 
 
 # Загрузка аватара пользователя
 @router.post("/users/avatar", response_model=dict)
 async def upload_avatar(
         file: UploadFile = File(...),
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: AsyncSession = Depends(get_async_db)
 ):
     # Проверяем тип файла
     allowed_types = ["image/jpeg", "image/png", "image/gif", "image/webp"]
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Invalid file type. Only images are allowed")
 
-    # Генерируем уникальное имя файла
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"avatar_{current_user.id}_{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-    # Сохраняем файл
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Старый аватар остается в хранилище до сборки мусора (python -m app.manage gc-uploads)
+    stored = await blob_store.put(file, max_size=settings.max_avatar_size)
+    file_path = stored.path
+    media_processor.schedule(file_path, AVATAR_VARIANTS)
 
     # Обновляем путь к аватару в базе
-    current_user.avatar_path = file_path
-    db.commit()
+    await db.execute(
+        update(User).where(User.id == current_user.id).values(avatar_path=file_path)
+    )
+    # Собеседники увидят новый аватар при синхронизации всех чатов пользователя
+    await db.execute(
+        insert(ChangeLog).from_select(
+            ["chat_id", "kind", "entity_id", "created_at"],
+            select(
+                ChatParticipant.chat_id, literal(CHANGE_PARTICIPANT), literal(current_user.id),
+                literal(datetime.utcnow())
+            ).where(ChatParticipant.user_id == current_user.id)
+        )
+    )
+    await db.commit()
+    user_search_cache.clear()
+    await publish_user_changed(current_user.id)
 
     return {
         "success": True,
         "avatar_path": file_path,
+        "avatar_small": variant_path(file_path, "avatar_small"),
+        "avatar_medium": variant_path(file_path, "avatar_medium"),
         "message": "Avatar uploaded successfully"
     }
 
 
 # Получение профиля пользователя
 @router.get("/users/me", response_model=UserResponse)
-def get_current_user_profile(current_user: User = Depends(get_current_user)):
+def get_current_user_profile(current_user: UserSnapshot = Depends(get_current_user)):
     return current_user
 
 
@@ -463,15 +909,57 @@ def get_current_user_profile(current_user: User = Depends(get_current_user)):
 @router.get("/users/{user_id}", response_model=UserResponse)
 def get_user_by_id(
         user_id: int,
-        current_user: User = Depends(get_current_user),
-        db: Session = Depends(get_db)
+        current_user: UserSnapshot = Depends(get_current_user),
+        db: Session = Depends(get_read_db)
 ):
-    user = db.query(User).filter(
-        User.id == user_id,
-        User.is_active == True
-    ).first()
+    user = db.scalars(queries.active_user_by_id(user_id)).first()
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return user
\ No newline at end of file
+    return user
+
+
+# WebSocket для доставки событий в реальном времени
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
+    def load_chat_ids(user_id: int):
+        db = ReadSessionLocal()
+        try:
+            return db.scalars(queries.user_chat_ids(user_id)).all()
+        finally:
+            db.close()
+
+    try:
+        user = await authenticate_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    user_id = user.id
+    chat_ids = await run_in_threadpool(load_chat_ids, user_id)
+
+    await manager.connect(user_id, websocket, chat_ids)
+    presence.heartbeat(user_id)
+    try:
+        while True:
+            # Любой кадр продлевает присутствие; {"type": "typing", "chat_id": ...} - набор текста,
+            # {"type": "typing_stop"} - набор прекращен, остальные кадры служат keep-alive
+            frame = await websocket.receive_text()
+            presence.heartbeat(user_id)
+            try:
+                data = json.loads(frame)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            if data.get("type") == "typing" and isinstance(data.get("chat_id"), int):
+                presence.typing(user_id, data["chat_id"])
+            elif data.get("type") == "typing_stop":
+                presence.stop_typing(user_id)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(user_id, websocket)
+        if not manager.is_connected(user_id):
+            presence.disconnected(user_id)
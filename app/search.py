@@ -0,0 +1,261 @@
+import html
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import List, Optional
+
+from sqlalchemy import text, func
+
+from app.config import settings
+from app.database import engine, message_shards, User
+
+# Полнотекстовый поиск доступен только на SQLite (FTS5)
+SEARCH_ENABLED = engine.dialect.name == "sqlite"
+
+# Маркеры подсветки совпадений в сниппетах. FTS5 вставляет их в исходный текст сообщения,
+# поэтому сначала ставятся символы из области частного использования, а после экранирования
+# HTML они заменяются на теги - разметка из текста сообщения в ответ не попадает
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+_SENTINEL_START = "\ue000"
+_SENTINEL_END = "\ue001"
+
+MessageSearchRow = namedtuple("MessageSearchRow", ["id", "snippet", "rank"])
+
+# Индекс с внешним содержимым: тексты хранятся только в messages,
+# а триггеры синхронизируют индекс при вставке, изменении и удалении
+MESSAGES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); "
+    "END",
+]
+
+
+# Триграммный индекс имен пользователей для поиска по подстроке
+USERS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, content='users', content_rowid='id', "
+    "tokenize='trigram case_sensitive 0')",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username) VALUES (new.id, new.username); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.id, old.username); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.id, old.username); "
+    "INSERT INTO users_fts(rowid, username) VALUES (new.id, new.username); "
+    "END",
+]
+
+SEARCH_INDEXES = {
+    "messages_fts": MESSAGES_FTS_DDL,
+    "users_fts": USERS_FTS_DDL,
+}
+
+
+def create_search_index():
+    """Создание FTS-индексов; для существующей базы новый индекс сразу заполняется"""
+    if not SEARCH_ENABLED:
+        return
+
+    created = []
+    with engine.begin() as connection:
+        for name, statements in SEARCH_INDEXES.items():
+            exists = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+            ), {"name": name}).first()
+            for ddl in statements:
+                connection.execute(text(ddl))
+            if not exists:
+                created.append(name)
+
+    if created:
+        rebuild_search_index(created)
+
+
+def rebuild_search_index(names: Optional[List[str]] = None):
+    """Полная перестройка FTS-индексов по исходным таблицам"""
+    with engine.begin() as connection:
+        for name in names or SEARCH_INDEXES:
+            connection.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+
+    # У каждого шарда сообщений - свой индекс messages_fts
+    if names is None or "messages_fts" in names:
+        for shard_engine in message_shards.engines:
+            with shard_engine.begin() as connection:
+                connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    Преобразование пользовательской строки в запрос FTS5:
+    каждое слово берется в кавычки (без операторов FTS), последнее - как префикс
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+# Ранжированный поиск только по чатам, где пользователь - участник
+SEARCH_MESSAGES_SQL = text(
+    "SELECT messages.id, "
+    "snippet(messages_fts, 0, :highlight_start, :highlight_end, '…', 12) AS snippet, "
+    "bm25(messages_fts) AS rank "
+    "FROM messages_fts "
+    "JOIN messages ON messages.id = messages_fts.rowid "
+    "JOIN chat_participants ON chat_participants.chat_id = messages.chat_id "
+    "AND chat_participants.user_id = :user_id "
+    "WHERE messages_fts MATCH :match "
+    "ORDER BY rank "
+    "LIMIT :limit OFFSET :offset"
+)
+
+
+def highlight_snippet(snippet: str) -> str:
+    """Сниппет с маркерами-заменителями -> экранированный HTML с <mark>"""
+    # Такой же символ в самом тексте сообщения даст лишь лишний <mark>, а не произвольную разметку
+    return html.escape(snippet).replace(_SENTINEL_START, HIGHLIGHT_START).replace(_SENTINEL_END, HIGHLIGHT_END)
+
+
+def search_messages(db, user_id: int, query: str, limit: int, offset: int) -> List[MessageSearchRow]:
+    """Список (message_id, snippet, rank), лучшие совпадения первыми; snippet - экранированный HTML"""
+    match = build_match_query(query)
+    if match is None:
+        return []
+
+    rows = db.execute(SEARCH_MESSAGES_SQL, {
+        "highlight_start": _SENTINEL_START,
+        "highlight_end": _SENTINEL_END,
+        "user_id": user_id,
+        "match": match,
+        "limit": limit,
+        "offset": offset,
+    }).all()
+    return [MessageSearchRow(row.id, highlight_snippet(row.snippet), row.rank) for row in rows]
+
+
+def search_message_shards(sessions: list, user_id: int, query: str, limit: int, offset: int) -> list:
+    """Поиск по всем шардам сообщений: пары (сессия шарда, строка), лучшие совпадения первыми.
+    Ранги bm25 считаются по статистике своего шарда, поэтому общий порядок - приближенный"""
+    if len(sessions) == 1:
+        return [(sessions[0], row) for row in search_messages(sessions[0], user_id, query, limit, offset)]
+
+    found = [
+        (session, row)
+        for session in sessions
+        for row in search_messages(session, user_id, query, offset + limit, 0)
+    ]
+    found.sort(key=lambda item: item[1].rank)
+    return found[offset:offset + limit]
+
+
+# Кэш результатов поиска пользователей для коротких (самых частых) запросов
+class UserSearchCache:
+    """LRU-кэш с ограничением времени жизни записей"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # Синхронные эндпоинты выполняются в пуле потоков
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_search_cache = UserSearchCache(settings.user_search_cache_size, settings.user_search_cache_ttl)
+
+
+def _ascii_lower(value: str) -> str:
+    # lower() в SQLite меняет регистр только у ASCII - приводим запрос так же
+    return "".join(char.lower() if char.isascii() else char for char in value)
+
+
+def _find_users(db, query: str, limit: int) -> List[User]:
+    """Сначала совпадения по началу имени, затем по подстроке (от 3 символов)"""
+    active = User.is_active == True
+
+    if not SEARCH_ENABLED:
+        return db.query(User).filter(User.username.ilike(f"%{query}%"), active).limit(limit).all()
+
+    # Префикс: диапазон по индексу ix_users_username_lower
+    prefix = _ascii_lower(query)
+    users = db.query(User).filter(
+        func.lower(User.username) >= prefix,
+        func.lower(User.username) < prefix + "\U0010ffff",
+        active
+    ).order_by(func.length(User.username), User.username).limit(limit).all()
+
+    # Подстрока: триграммный индекс работает для запросов от 3 символов
+    if len(users) < limit and len(query) >= 3:
+        found_ids = [user.id for user in users]
+        substring_ids = [row[0] for row in db.execute(text(
+            "SELECT rowid FROM users_fts WHERE users_fts MATCH :match ORDER BY rank LIMIT :limit"
+        ), {"match": '"' + query.replace('"', '""') + '"', "limit": limit + len(found_ids)})]
+        substring_ids = [user_id for user_id in substring_ids if user_id not in found_ids]
+
+        if substring_ids:
+            matched = db.query(User).filter(User.id.in_(substring_ids), active).all()
+            matched.sort(key=lambda user: (len(user.username), user.username))
+            users.extend(matched[:limit - len(users)])
+
+    return users
+
+
+def search_users(db, query: str, limit: int, exclude_user_id: int) -> List[dict]:
+    """Поиск активных пользователей по имени; короткие запросы кэшируются"""
+    # Берем на одного больше, чтобы после исключения текущего пользователя хватило limit
+    key = (_ascii_lower(query), limit + 1)
+    cacheable = len(query) <= settings.user_search_cache_max_query
+
+    users = user_search_cache.get(key) if cacheable else None
+    if users is None:
+        # В кэше храним простые словари, а не ORM-объекты сессии
+        users = [
+            {"id": user.id, "username": user.username, "email": user.email, "avatar_path": user.avatar_path}
+            for user in _find_users(db, query, limit + 1)
+        ]
+        if cacheable:
+            user_search_cache.put(key, users)
+
+    return [user for user in users if user["id"] != exclude_user_id][:limit]
@@ -0,0 +1,356 @@
+import asyncio
+import glob
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from sqlalchemy import create_engine, delete, func, insert, select, text, update
+
+from app.config import settings
+from app.database import engine, message_shards, message_id_sequence, shard_metadata, sqlite_profile, Message, \
+    MessageShardWatermark, MESSAGE_ID_STRIDE
+from app.queries import directory_updates
+
+logger = logging.getLogger(__name__)
+
+# Сообщений за один шаг копирования при переносе чата
+COPY_CHUNK_SIZE = 1000
+
+# Сообщений шарда в одной транзакции обновления каталога
+APPLY_BATCH_SIZE = 1000
+
+messages_table = Message.__table__
+watermark_table = MessageShardWatermark.__table__
+
+
+def _plain_engine(shard: int):
+    # Служебные операции со схемой и переносом идут без ATTACH каталога: иначе имя messages
+    # в файле без этой таблицы найдется в каталоге
+    shard_engine = create_engine(message_shards.url(shard))
+    sqlite_profile.apply(shard_engine)
+    return shard_engine
+
+
+def _sequence_start(max_id: int, shard: int) -> int:
+    """Значение последовательности шарда, после которого выдаются только id больше max_id"""
+    return (max_id // MESSAGE_ID_STRIDE) * MESSAGE_ID_STRIDE + shard
+
+
+def _existing_shards() -> List[int]:
+    """Номера найденных файлов шардов (включая оставшиеся от большего MESSAGE_SHARDS)"""
+    pattern = re.compile(
+        re.escape(message_shards.path_template).replace(re.escape("{shard}"), r"(\d+)") + "$"
+    )
+    shards = set()
+    for path in glob.glob(message_shards.path_template.format(shard="*")):
+        match = pattern.search(path)
+        if match is not None:
+            shards.add(int(match.group(1)))
+    return sorted(shards)
+
+
+def _locations() -> Dict[Optional[int], object]:
+    """Места хранения сообщений: основная база (None) и файлы шардов"""
+    locations = {None: engine}
+    for shard in sorted(set(_existing_shards()) | set(range(message_shards.count))):
+        locations[shard] = _plain_engine(shard)
+    return locations
+
+
+def _dispose(locations: Dict[Optional[int], object]):
+    for location, location_engine in locations.items():
+        if location is not None:
+            location_engine.dispose()
+
+
+def _max_message_id(locations: Dict[Optional[int], object]) -> int:
+    max_id = 0
+    for location_engine in locations.values():
+        with location_engine.connect() as connection:
+            max_id = max(max_id, connection.execute(select(func.max(messages_table.c.id))).scalar() or 0)
+    return max_id
+
+
+def _advance_sequences(locations: Dict[Optional[int], object]):
+    """Последовательности текущих шардов - не ниже наибольшего id во всех местах хранения"""
+    max_id = _max_message_id(locations)
+    for shard in range(message_shards.count):
+        with locations[shard].begin() as connection:
+            current = connection.execute(select(message_id_sequence.c.last_id)).scalar()
+            start = _sequence_start(max_id, shard)
+            if current is None:
+                connection.execute(insert(message_id_sequence).values(id=1, last_id=start))
+            elif current < start:
+                connection.execute(message_id_sequence.update().values(last_id=start))
+
+
+def max_message_id() -> int:
+    """Наибольший id сообщения во всех местах хранения"""
+    locations = _locations()
+    try:
+        return _max_message_id(locations)
+    finally:
+        _dispose(locations)
+
+
+def prepare_message_shards():
+    """Схема файлов шардов: messages с индексами, FTS-индекс и последовательность id"""
+    locations = _locations()
+    try:
+        _prepare(locations)
+    finally:
+        _dispose(locations)
+
+
+def _prepare(locations: Dict[Optional[int], object]):
+    from app.search import SEARCH_ENABLED, MESSAGES_FTS_DDL
+
+    for shard in range(message_shards.count):
+        with locations[shard].begin() as connection:
+            has_fts = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            )).first() is not None
+            messages_table.create(connection, checkfirst=True)
+            shard_metadata.create_all(connection)
+            if SEARCH_ENABLED:
+                for ddl in MESSAGES_FTS_DDL:
+                    connection.execute(text(ddl))
+                if not has_fts:
+                    connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+    _advance_sequences(locations)
+    _init_watermarks(locations)
+
+    # Сообщения вне своих шардов (включение шардирования или смена их числа) не видны приложению
+    misplaced = [
+        "основная база" if location is None else message_shards.path(location)
+        for location, location_engine in locations.items()
+        if (location is None or location >= message_shards.count) and _has_messages(location_engine)
+    ]
+    if misplaced:
+        logger.warning(
+            "Сообщения вне шардов (%s): выполните python -m app.manage rebalance-messages", ", ".join(misplaced)
+        )
+
+
+def _shard_max_id(location_engine) -> int:
+    with location_engine.connect() as connection:
+        return connection.execute(select(func.max(messages_table.c.id))).scalar() or 0
+
+
+def _init_watermarks(locations: Dict[Optional[int], object]):
+    """Отметки для новых шардов: сообщения, уже лежащие в шарде, считаются учтенными в каталоге"""
+    with engine.begin() as connection:
+        known = set(connection.execute(select(watermark_table.c.shard)).scalars())
+        for shard in range(message_shards.count):
+            if shard not in known:
+                connection.execute(insert(watermark_table).values(
+                    shard=shard, last_message_id=_shard_max_id(locations[shard])
+                ))
+
+
+def _reset_watermarks(locations: Dict[Optional[int], object]):
+    """После переноса: все сообщения учтены, отметки - по текущему содержимому шардов"""
+    with engine.begin() as connection:
+        connection.execute(delete(watermark_table))
+        for shard in range(message_shards.count):
+            connection.execute(insert(watermark_table).values(
+                shard=shard, last_message_id=_shard_max_id(locations[shard])
+            ))
+
+
+def _has_messages(location_engine) -> bool:
+    with location_engine.connect() as connection:
+        return connection.execute(select(messages_table.c.id).limit(1)).first() is not None
+
+
+@dataclass
+class ChatMove:
+    chat_id: int
+    source: Optional[int]
+    target: Optional[int]
+    messages: int
+
+
+def plan_rebalance() -> List[ChatMove]:
+    """Чаты, сообщения которых лежат не в том месте, которое им назначает текущий MESSAGE_SHARDS"""
+    moves = []
+    locations = _locations()
+    try:
+        for location, location_engine in locations.items():
+            with location_engine.connect() as connection:
+                counts = connection.execute(
+                    select(messages_table.c.chat_id, func.count()).group_by(messages_table.c.chat_id)
+                ).all()
+            for chat_id, count in counts:
+                target = message_shards.shard_of(chat_id)
+                if target != location:
+                    moves.append(ChatMove(chat_id, location, target, count))
+    finally:
+        _dispose(locations)
+    return moves
+
+
+def rebalance_messages(moves: Optional[List[ChatMove]] = None) -> List[ChatMove]:
+    """
+    Перенос сообщений чатов в шарды по текущему MESSAGE_SHARDS (или обратно в основную базу при 0).
+    Выполняется при остановленном сервисе. id сообщений сохраняются - курсоры прочтения,
+    сводки и журнал изменений остаются верными. Чат сначала целиком копируется, затем удаляется
+    из источника, поэтому прерванный перенос можно просто запустить снова
+    """
+    if moves is None:
+        moves = plan_rebalance()
+    locations = _locations()
+    try:
+        # Каталог должен учесть все сообщения до переноса: отметки после него пересчитываются
+        _apply_locations(locations)
+        _move_chats(locations, moves)
+        if message_shards.enabled:
+            _advance_sequences(locations)
+        _reset_watermarks(locations)
+    finally:
+        _dispose(locations)
+    return moves
+
+
+def _move_chats(locations: Dict[Optional[int], object], moves: List[ChatMove]):
+    for move in moves:
+        source, target = locations[move.source], locations[move.target]
+        with source.connect() as source_connection, target.begin() as target_connection:
+            # Остаток прерванного переноса этого чата
+            target_connection.execute(delete(messages_table).where(messages_table.c.chat_id == move.chat_id))
+            last_id = 0
+            while True:
+                rows = source_connection.execute(
+                    select(messages_table).where(
+                        messages_table.c.chat_id == move.chat_id, messages_table.c.id > last_id
+                    ).order_by(messages_table.c.id).limit(COPY_CHUNK_SIZE)
+                ).mappings().all()
+                if not rows:
+                    break
+                target_connection.execute(insert(messages_table), [dict(row) for row in rows])
+                last_id = rows[-1]["id"]
+        with source.begin() as source_connection:
+            source_connection.execute(delete(messages_table).where(messages_table.c.chat_id == move.chat_id))
+
+
+# Обновление каталога по сообщениям шардов. Отправка пишет сообщение только в файл шарда -
+# отправки в разные шарды не ждут друг друга и общую блокировку каталога. Сводки, время обновления
+# чатов, счетчики непрочитанных и журнал изменений догоняют шард одной транзакцией каталога
+# на пакет сообщений. Внутри шарда id выдаются под блокировкой записи шарда, поэтому сообщения
+# фиксируются по возрастанию id и "учтено до id" (MessageShardWatermark) точно описывает,
+# что каталог уже видел. Отметка сдвигается в той же транзакции, что и обновление каталога:
+# после сбоя неучтенные сообщения просто применяются при следующем проходе.
+# Цена - каталог отстает от шарда на задержку применения: сводки, счетчики и /sync
+# видят сообщение на десятки миллисекунд позже, чем история чата и WebSocket
+def apply_shard_messages(shard: int, shard_engine, limit: int = APPLY_BATCH_SIZE) -> int:
+    """Учесть в каталоге следующие сообщения шарда после отметки; возвращает их число"""
+    with engine.connect() as connection:
+        watermark = connection.execute(
+            select(watermark_table.c.last_message_id).where(watermark_table.c.shard == shard)
+        ).scalar()
+    if watermark is None:
+        return 0
+    with shard_engine.connect() as connection:
+        messages = connection.execute(
+            select(
+                messages_table.c.id, messages_table.c.chat_id, messages_table.c.sender_id,
+                messages_table.c.created_at
+            ).where(messages_table.c.id > watermark).order_by(messages_table.c.id).limit(limit)
+        ).mappings().all()
+    if not messages:
+        return 0
+
+    with engine.begin() as connection:
+        # Отметка сдвигается первым запросом: он берет блокировку записи каталога, а условие
+        # по прежнему значению не дает двум процессам учесть одни и те же сообщения дважды
+        claimed = connection.execute(
+            update(watermark_table).where(
+                watermark_table.c.shard == shard, watermark_table.c.last_message_id == watermark
+            ).values(last_message_id=messages[-1]["id"])
+        ).rowcount
+        if not claimed:
+            return 0
+        for statement, parameters in directory_updates([dict(message) for message in messages]):
+            connection.execute(statement, parameters)
+    return len(messages)
+
+
+def _apply_shard(shard: int, shard_engine) -> int:
+    total = 0
+    while True:
+        applied = apply_shard_messages(shard, shard_engine)
+        total += applied
+        if applied < APPLY_BATCH_SIZE:
+            return total
+
+
+def _apply_locations(locations: Dict[Optional[int], object]) -> int:
+    return sum(
+        _apply_shard(location, location_engine)
+        for location, location_engine in locations.items() if location is not None
+    )
+
+
+def apply_pending_messages() -> int:
+    """Учесть в каталоге все неучтенные сообщения во всех файлах шардов (служебные команды)"""
+    locations = _locations()
+    try:
+        return _apply_locations(locations)
+    finally:
+        _dispose(locations)
+
+
+class DirectoryApplier:
+    def __init__(self, delay: float, poll_interval: float = 1.0):
+        self.delay = delay
+        # Опрос подбирает сообщения других воркеров и оставшиеся после сбоя
+        self.poll_interval = poll_interval
+        self._event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not message_shards.enabled:
+            return
+        self._event = asyncio.Event()
+        self._event.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка; уже записанные в шарды сообщения учитываются до выхода"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self.apply)
+
+    def notify(self):
+        """В шард записаны новые сообщения"""
+        if self._event is not None:
+            self._event.set()
+
+    def apply(self) -> int:
+        return sum(
+            _apply_shard(shard, shard_engine) for shard, shard_engine in enumerate(message_shards.read_engines)
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            # Отправки за delay секунд учитываются одной транзакцией каталога
+            await asyncio.sleep(self.delay)
+            self._event.clear()
+            try:
+                await asyncio.to_thread(self.apply)
+            except Exception:
+                logger.exception("Ошибка обновления каталога по шардам сообщений")
+
+
+directory_applier = DirectoryApplier(settings.message_shard_apply_delay_ms / 1000)
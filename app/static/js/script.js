@@ -6,6 +6,21 @@ let authForm, chatInterface, loginForm, registerForm;
 let currentUser = null;
 let currentChat = null;
 let accessToken = null;
+let realtimeSocket = null;
+let loadedMessages = [];
+let nextBeforeId = null;
+let loadingOlderMessages = false;
+let realtimeReconnectDelay = 1000;
+// Курсор дельта-синхронизации (/api/sync) и последний загруженный список чатов
+let syncCursor = null;
+let cachedChats = [];
+let syncInProgress = false;
+let syncPending = false;
+// Присутствие: кадр keep-alive чаще, чем истекает TTL на сервере, и ограничение частоты событий набора
+const PRESENCE_PING_INTERVAL = 25000;
+const TYPING_SEND_INTERVAL = 2000;
+let presencePingTimer = null;
+let lastTypingSentAt = 0;
 
 // Инициализация при загрузке страницы
 document.addEventListener('DOMContentLoaded', function() {
@@ -57,6 +72,7 @@ async function checkAuthStatus() {
                 showChatInterface();
                 loadUserData();
                 loadChats();
+                connectRealtime();
             } else {
                 console.log('Токен невалиден, показываем форму входа');
                 localStorage.clear();
@@ -176,6 +192,7 @@ function setupEventListeners() {
                 sendMessage();
             }
         });
+        messageInput.addEventListener('input', sendTyping);
     }
     
     // Меню для мобильных
@@ -192,6 +209,16 @@ function setupEventListeners() {
     if (fileInput) {
         fileInput.addEventListener('change', handleFileUpload);
     }
+    
+    // Догрузка старых сообщений при прокрутке вверх
+    const messagesContainer = document.getElementById('messages');
+    if (messagesContainer) {
+        messagesContainer.addEventListener('scroll', function() {
+            if (messagesContainer.scrollTop < 50) {
+                loadOlderMessages();
+            }
+        });
+    }
 }
 
 // Дебаунс для поиска
@@ -312,13 +339,14 @@ function displaySearchResults(users) {
             const userId = user.id || user.user_id;
             const username = user.username || user.name || 'Без имени';
             const email = user.email || '';
-            const avatar = user.avatar_path || user.avatar || '/static/img/default-avatar.png';
+            const avatar = avatarSources(user);
 
             userItem.innerHTML = `
-                <img src="${avatar}"
+                <img src="${avatar.src}"
                      class="user-avatar"
                      alt="${username}"
-                     onerror="this.onerror=null; this.src='/static/img/default-avatar.png'">
+                     data-fallback="${avatar.fallback}"
+                     onerror="fallbackImage(this)">
                 <div class="user-info">
                     <div class="username">${escapeHtml(username)}</div>
                     ${email ? `<div class="email">${escapeHtml(email)}</div>` : ''}
@@ -475,6 +503,7 @@ async function login() {
             showChatInterface();
             loadUserData();
             loadChats();
+            connectRealtime();
 
             showNotification('Успешный вход!', 'success');
         } else {
@@ -619,12 +648,12 @@ function loadUserData() {
     const currentUsername = document.getElementById('current-username');
     
     if (currentUserAvatar) {
-        currentUserAvatar.src = currentUser.avatar_path 
-            ? currentUser.avatar_path 
-            : '/static/img/default-avatar.png';
+        const avatar = avatarSources(currentUser);
+        currentUserAvatar.dataset.fallback = avatar.fallback;
         currentUserAvatar.onerror = function() {
-            this.src = '/static/img/default-avatar.png';
+            fallbackImage(this);
         };
+        currentUserAvatar.src = avatar.src;
     }
     
     if (currentUsername) {
@@ -648,6 +677,14 @@ async function loadChats() {
         // Показываем индикатор загрузки
         showLoader('#chat-list', 'Загрузка чатов...');
 
+        // Позиция журнала изменений до загрузки: все более поздние изменения придут через /sync
+        const syncResponse = await fetch(`${API_BASE_URL}/sync`, {
+            headers: { 'Authorization': `Bearer ${accessToken}` }
+        });
+        if (syncResponse.ok) {
+            syncCursor = (await syncResponse.json()).cursor;
+        }
+
         const response = await fetch(`${API_BASE_URL}/chats`, {
             method: 'GET',
             headers: {
@@ -691,6 +728,7 @@ async function loadChats() {
             throw new Error('Неверный формат данных. Ожидался массив чатов.');
         }
 
+        cachedChats = data;
         displayChats(data);
 
     } catch (error) {
@@ -778,6 +816,7 @@ function displayChats(chats) {
             // Определяем название чата и аватар
             let chatName = chat.chat_name || chat.name || 'Без названия';
             let chatAvatar = chat.chat_avatar || chat.avatar || '/static/img/default-avatar.png';
+            let chatAvatarFallback = '/static/img/default-avatar.png';
 
             // Для личных чатов используем имя собеседника
             if (chat.chat_type === 'private' || chat.type === 'private') {
@@ -792,9 +831,11 @@ function displayChats(chats) {
 
                     if (otherParticipant) {
                         chatName = otherParticipant.username || otherParticipant.name || chatName;
-                        chatAvatar = otherParticipant.avatar_path ||
-                                    otherParticipant.avatar ||
-                                    chatAvatar;
+                        if (otherParticipant.avatar_path || otherParticipant.avatar) {
+                            const avatar = avatarSources(otherParticipant);
+                            chatAvatar = avatar.src;
+                            chatAvatarFallback = avatar.fallback;
+                        }
                     }
                 }
             }
@@ -819,6 +860,16 @@ function displayChats(chats) {
                 }
             }
 
+            // Собеседник личного чата в сети; набор текста показывается вместо последнего сообщения
+            const isOnline = chat.chat_type === 'private' && (chat.presence || []).some(p => p.online);
+            if (isOnline) {
+                chatItem.classList.add('online');
+            }
+            const isTyping = (chat.typing_user_ids || []).length > 0;
+            if (isTyping) {
+                lastMessage = typingText(chat);
+            }
+
             // Бейдж непрочитанных сообщений
             let unreadBadge = '';
             if (chat.unread_count > 0) {
@@ -829,13 +880,14 @@ function displayChats(chats) {
                 <img src="${chatAvatar}"
                      class="chat-avatar"
                      alt="${chatName}"
-                     onerror="this.onerror=null; this.src='/static/img/default-avatar.png'">
+                     data-fallback="${chatAvatarFallback}"
+                     onerror="fallbackImage(this)">
                 <div class="chat-info">
                     <div class="chat-name-row">
                         <div class="chat-name">${escapeHtml(chatName)}</div>
                         <div class="chat-time">${lastMessageTime}</div>
                     </div>
-                    <div class="chat-last-message">${escapeHtml(lastMessage)}</div>
+                    <div class="chat-last-message${isTyping ? ' typing' : ''}">${escapeHtml(lastMessage)}</div>
                 </div>
                 ${unreadBadge}
             `;
@@ -902,21 +954,84 @@ async function loadChatMessages(chatId) {
             throw new Error(`Ошибка загрузки сообщений: ${response.status}`);
         }
 
-        const messages = await response.json();
+        const page = await response.json();
+        const messages = page.messages;
         console.log('Загружено сообщений:', messages.length);
 
-        displayMessages(messages);
+        loadedMessages = messages;
+        nextBeforeId = page.next_before_id;
+        displayMessages(loadedMessages);
+
+        if (messages.length > 0) {
+            markChatRead(chatId, messages[messages.length - 1].id);
+        }
     } catch (error) {
         console.error('Ошибка при загрузке сообщений:', error);
         showNotification('Ошибка при загрузке сообщений', 'error');
     }
 }
 
+// Загрузка более старых сообщений по курсору
+async function loadOlderMessages() {
+    if (!currentChat || !nextBeforeId || loadingOlderMessages) return;
+
+    const chatId = currentChat;
+    loadingOlderMessages = true;
+
+    try {
+        const response = await fetch(`${API_BASE_URL}/chats/${chatId}/messages?limit=50&before_id=${nextBeforeId}`, {
+            headers: {
+                'Authorization': `Bearer ${accessToken}`
+            }
+        });
+
+        if (!response.ok) {
+            throw new Error(`Ошибка загрузки сообщений: ${response.status}`);
+        }
+
+        const page = await response.json();
+        if (chatId !== currentChat) return;
+
+        loadedMessages = page.messages.concat(loadedMessages);
+        nextBeforeId = page.next_before_id;
+        displayMessages(loadedMessages, false);
+    } catch (error) {
+        console.error('Ошибка при загрузке старых сообщений:', error);
+    } finally {
+        loadingOlderMessages = false;
+    }
+}
+
+// Отметка сообщений чата как прочитанных
+async function markChatRead(chatId, messageId) {
+    try {
+        const response = await fetch(`${API_BASE_URL}/chats/${chatId}/read`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${accessToken}`,
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ message_id: messageId })
+        });
+
+        if (response.ok) {
+            const badge = document.querySelector(`.chat-item[data-chat-id="${chatId}"] .unread-badge`);
+            if (badge) {
+                badge.remove();
+            }
+        }
+    } catch (error) {
+        console.error('Ошибка при отметке прочтения:', error);
+    }
+}
+
 // Отображение сообщений
-function displayMessages(messages) {
+function displayMessages(messages, scrollToBottom = true) {
     const messagesContainer = document.getElementById('messages');
     if (!messagesContainer) return;
     
+    // Запоминаем расстояние до низа, чтобы после догрузки истории список не прыгал
+    const distanceFromBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop;
     messagesContainer.innerHTML = '';
     
     if (messages.length === 0) {
@@ -951,7 +1066,11 @@ function displayMessages(messages) {
     }
     
     // Прокручиваем вниз
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    if (scrollToBottom) {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    } else {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight - distanceFromBottom;
+    }
 }
 
 // Группировка сообщений по дате
@@ -993,8 +1112,19 @@ function createMessageElement(message) {
         const fileName = message.file_path.split('/').pop();
         const fileType = message.file_type || 'file';
         
+        // Для изображений показываем миниатюру, полный размер - по клику
+        const thumbnail = message.thumbnail_path ? `
+                <a href="${message.file_path}" target="_blank">
+                    <img src="${message.thumbnail_path}"
+                         class="file-thumbnail"
+                         alt="${fileName}"
+                         loading="lazy"
+                         data-fallback="${message.file_path}"
+                         onerror="fallbackImage(this)">
+                </a>` : '';
+
         messageContent += `
-            <div class="message-file">
+            <div class="message-file">${thumbnail}
                 <div class="file-preview">
                     <i class="fas fa-file ${getFileIcon(fileType)}"></i>
                     <div class="file-info">
@@ -1023,6 +1153,33 @@ function createMessageElement(message) {
     return messageDiv;
 }
 
+// Идентификатор сообщения на стороне клиента для безопасных повторов отправки
+function generateClientMsgId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Повтор запроса при сетевой ошибке или ответе 5xx с растущей задержкой
+async function fetchWithRetry(url, options, attempts = 3) {
+    let delay = 500;
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(url, options);
+            if (response.status < 500 || attempt >= attempts) {
+                return response;
+            }
+        } catch (error) {
+            if (attempt >= attempts) {
+                throw error;
+            }
+        }
+        await new Promise(resolve => setTimeout(resolve, delay));
+        delay *= 2;
+    }
+}
+
 // Отправка сообщения
 async function sendMessage() {
     console.log('Отправка сообщения');
@@ -1040,8 +1197,10 @@ async function sendMessage() {
         const formData = new FormData();
         formData.append('chat_id', currentChat);
         formData.append('content', content);
+        // Один id на все попытки: сервер не создаст дубликат, если ответ на первую потерялся
+        formData.append('client_msg_id', generateClientMsgId());
         
-        const response = await fetch(`${API_BASE_URL}/messages`, {
+        const response = await fetchWithRetry(`${API_BASE_URL}/messages`, {
             method: 'POST',
             headers: {
                 'Authorization': `Bearer ${accessToken}`
@@ -1058,12 +1217,12 @@ async function sendMessage() {
         
         // Очищаем поле ввода
         messageInput.value = '';
+        lastTypingSentAt = 0;
         
-        // Обновляем сообщения
-        await loadChatMessages(currentChat);
-        
-        // Обновляем список чатов
-        loadChats();
+        // При активном WebSocket сообщение придет push-событием, иначе догружаем изменения
+        if (!isRealtimeConnected()) {
+            await syncChanges();
+        }
         
     } catch (error) {
         console.error('Ошибка при отправке сообщения:', error);
@@ -1071,6 +1230,199 @@ async function sendMessage() {
     }
 }
 
+// Подключение к WebSocket для получения событий в реальном времени
+function connectRealtime() {
+    if (!accessToken || realtimeSocket) return;
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const url = `${protocol}//${window.location.host}/api/ws?token=${encodeURIComponent(accessToken)}`;
+    const socket = new WebSocket(url);
+    realtimeSocket = socket;
+
+    socket.onopen = function() {
+        console.log('WebSocket подключен');
+        realtimeReconnectDelay = 1000;
+        // Догружаем то, что изменилось, пока соединения не было
+        syncChanges();
+        clearInterval(presencePingTimer);
+        presencePingTimer = setInterval(() => sendRealtime({ type: 'ping' }), PRESENCE_PING_INTERVAL);
+    };
+
+    socket.onmessage = function(event) {
+        try {
+            handleRealtimeEvent(JSON.parse(event.data));
+        } catch (error) {
+            console.error('Ошибка обработки события WebSocket:', error);
+        }
+    };
+
+    socket.onclose = function() {
+        if (realtimeSocket !== socket) return;
+        realtimeSocket = null;
+        clearInterval(presencePingTimer);
+
+        // Переподключаемся с экспоненциальной задержкой
+        if (accessToken) {
+            setTimeout(connectRealtime, realtimeReconnectDelay);
+            realtimeReconnectDelay = Math.min(realtimeReconnectDelay * 2, 30000);
+        }
+    };
+}
+
+function disconnectRealtime() {
+    clearInterval(presencePingTimer);
+    if (realtimeSocket) {
+        const socket = realtimeSocket;
+        realtimeSocket = null;
+        socket.close();
+    }
+}
+
+function isRealtimeConnected() {
+    return realtimeSocket !== null && realtimeSocket.readyState === WebSocket.OPEN;
+}
+
+function sendRealtime(data) {
+    if (isRealtimeConnected()) {
+        realtimeSocket.send(JSON.stringify(data));
+    }
+}
+
+// Событие набора текста не чаще раза в TYPING_SEND_INTERVAL; сервер сам снимает его по TTL
+function sendTyping() {
+    const now = Date.now();
+    if (!currentChat || now - lastTypingSentAt < TYPING_SEND_INTERVAL) return;
+    lastTypingSentAt = now;
+    sendRealtime({ type: 'typing', chat_id: currentChat });
+}
+
+function typingText(chat) {
+    if (chat.chat_type === 'private') {
+        return 'печатает...';
+    }
+    const names = chat.typing_user_ids.map(userId => {
+        const participant = (chat.participants || []).find(p => p.id === userId);
+        return participant ? participant.username : 'Кто-то';
+    });
+    return `${names.join(', ')} ${names.length > 1 ? 'печатают' : 'печатает'}...`;
+}
+
+// Изменения присутствия и набора текста приходят пачкой: { online: [...], typing: [...] }
+function applyPresence(data) {
+    const online = new Map((data.online || []).map(entry => [entry.user_id, entry]));
+    for (const chat of cachedChats) {
+        if (online.size > 0 && chat.presence) {
+            chat.presence = chat.presence.map(entry => online.get(entry.user_id) || entry);
+        }
+        for (const entry of data.typing || []) {
+            if (entry.chat_id !== chat.id) continue;
+            const typingIds = (chat.typing_user_ids || []).filter(userId => userId !== entry.user_id);
+            chat.typing_user_ids = entry.typing ? typingIds.concat(entry.user_id) : typingIds;
+        }
+    }
+    displayChats(cachedChats);
+}
+
+// Обработка событий, пришедших по WebSocket
+function handleRealtimeEvent(event) {
+    if (event.type === 'message') {
+        const message = event.data;
+        if (message.chat_id === currentChat) {
+            appendMessage(message);
+            if (message.sender_id !== currentUser?.id) {
+                markChatRead(message.chat_id, message.id);
+            }
+        }
+        syncChanges();
+    } else if (event.type === 'presence') {
+        applyPresence(event.data);
+    }
+}
+
+// Дельта-синхронизация: запрашиваются только изменения после syncCursor
+async function syncChanges() {
+    if (!accessToken || syncCursor === null) return;
+    if (syncInProgress) {
+        syncPending = true;
+        return;
+    }
+
+    syncInProgress = true;
+    try {
+        let hasMore = true;
+        while (hasMore) {
+            const response = await fetch(`${API_BASE_URL}/sync?since=${syncCursor}`, {
+                headers: { 'Authorization': `Bearer ${accessToken}` }
+            });
+            if (!response.ok) {
+                throw new Error(`Ошибка синхронизации: ${response.status}`);
+            }
+
+            const delta = await response.json();
+            if (delta.full_resync) {
+                // Журнал на сервере уже очищен - загружаем все заново
+                syncCursor = null;
+                await loadChats();
+                if (currentChat) {
+                    await loadChatMessages(currentChat);
+                }
+                return;
+            }
+
+            applySyncDelta(delta);
+            syncCursor = delta.cursor;
+            hasMore = delta.has_more;
+        }
+    } catch (error) {
+        console.error('Ошибка синхронизации:', error);
+    } finally {
+        syncInProgress = false;
+        if (syncPending) {
+            syncPending = false;
+            syncChanges();
+        }
+    }
+}
+
+function applySyncDelta(delta) {
+    if (delta.chats.length > 0) {
+        const changedIds = new Set(delta.chats.map(chat => chat.id));
+        cachedChats = cachedChats.filter(chat => !changedIds.has(chat.id)).concat(delta.chats);
+        cachedChats.sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at));
+        displayChats(cachedChats);
+    }
+
+    // Новые сообщения открытого чата (пришедшие по WebSocket уже показаны)
+    const loadedIds = new Set(loadedMessages.map(message => message.id));
+    let lastIncoming = null;
+    delta.messages.forEach(message => {
+        if (message.chat_id !== currentChat || loadedIds.has(message.id)) return;
+        appendMessage(message);
+        if (message.sender_id !== currentUser?.id) {
+            lastIncoming = message;
+        }
+    });
+    if (lastIncoming) {
+        markChatRead(currentChat, lastIncoming.id);
+    }
+}
+
+// Добавление одного сообщения в открытый чат
+function appendMessage(message) {
+    const messagesContainer = document.getElementById('messages');
+    if (!messagesContainer) return;
+
+    loadedMessages.push(message);
+
+    const emptyChat = messagesContainer.querySelector('.empty-chat');
+    if (emptyChat) {
+        emptyChat.remove();
+    }
+
+    messagesContainer.appendChild(createMessageElement(message));
+    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+}
+
 // Обработка загрузки файла
 function handleFileUpload(event) {
     const file = event.target.files[0];
@@ -1090,10 +1442,14 @@ function logout() {
     localStorage.removeItem('access_token');
     localStorage.removeItem('current_user');
     
+    disconnectRealtime();
+
     // Сбрасываем переменные
     accessToken = null;
     currentUser = null;
     currentChat = null;
+    syncCursor = null;
+    cachedChats = [];
     
     // Показываем форму авторизации
     showAuthForm();
@@ -1149,6 +1505,25 @@ function showNotification(message, type = 'info') {
 }
 
 // Вспомогательные функции
+
+// Аватар для списков: сначала уменьшенная копия, затем оригинал и аватар по умолчанию
+function avatarSources(user) {
+    const original = user.avatar_path || user.avatar;
+    const sources = [user.avatar_small, original, '/static/img/default-avatar.png'].filter(Boolean);
+    return { src: sources[0], fallback: sources.slice(1).join('|') };
+}
+
+// Переход к следующему источнику из data-fallback (миниатюра может еще строиться)
+function fallbackImage(img) {
+    const fallbacks = (img.dataset.fallback || '').split('|').filter(Boolean);
+    if (!fallbacks.length) {
+        img.onerror = null;
+        return;
+    }
+    img.dataset.fallback = fallbacks.slice(1).join('|');
+    img.src = fallbacks[0];
+}
+
 function escapeHtml(text) {
     const div = document.createElement('div');
     div.textContent = text;
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Dict
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+# Запас на поля формы и заголовки частей multipart сверх размера самого файла
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+@dataclass(frozen=True)
+class StoredUpload:
+    path: str
+    size: int
+    sha256: str
+
+
+def _too_large(max_size: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File is too large (limit {max_size} bytes)")
+
+
+async def save_upload(file: UploadFile, file_path: str, max_size: int,
+                      chunk_size: int = 1024 * 1024) -> StoredUpload:
+    """Потоковое сохранение файла по частям с подсчетом размера и SHA-256.
+    Превышение лимита прерывает запись (413), недописанный файл удаляется"""
+    partial_path = file_path + ".part"
+    digest = hashlib.sha256()
+    size = 0
+
+    buffer = await run_in_threadpool(open, partial_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise _too_large(max_size)
+            digest.update(chunk)
+            await run_in_threadpool(buffer.write, chunk)
+        await run_in_threadpool(buffer.close)
+        # Файл появляется под итоговым именем только целиком
+        os.replace(partial_path, file_path)
+    except BaseException:
+        buffer.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return StoredUpload(path=file_path, size=size, sha256=digest.hexdigest())
+
+
+# ASGI-middleware: ограничение размера тела запросов с загрузкой файлов.
+# Запрос с большим Content-Length отклоняется до чтения тела,
+# а тело без длины (chunked) обрывается, как только превысит лимит
+class UploadLimitMiddleware:
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.limits:
+            await self.app(scope, receive, send)
+            return
+
+        max_body = self.limits[scope["path"]] + MULTIPART_OVERHEAD
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body:
+            await self._reject(scope, receive, send, self.limits[scope["path"]])
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    # Исключение прерывает разбор формы, обработчик отвечает 413
+                    raise _too_large(self.limits[scope["path"]])
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, scope, receive, send, max_size: int):
+        error = _too_large(max_size)
+        response = JSONResponse({"detail": error.detail}, status_code=error.status_code,
+                                headers={"Connection": "close"})
+        await response(scope, receive, send)
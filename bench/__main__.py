@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+DEFAULT_SCENARIOS = ["register", "login", "inbox", "history", "send"]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _remove_database(database_path: str):
+    # Вместе с базой - журналы SQLite: иначе новая база откроется рядом с WAL прошлого прогона
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+
+
+def _prepare_environment(args):
+    # Настройки приложения читаются при импорте, поэтому база задается до импорта app
+    if args.url is None:
+        database_path = args.database
+        if not args.keep_db:
+            _remove_database(database_path)
+        os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+        os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.environ.setdefault("SECRET_KEY", "bench-secret-key")
+
+
+async def _run(args) -> dict:
+    import httpx
+    from app.config import settings
+    from bench.seed import seed
+    from bench.scenarios import BenchContext, QueryCounter, run_scenario
+
+    if args.url is None:
+        from app.main import app
+        from app import database
+        from app.ingest import message_writer
+
+        engines = [database.engine, database.read_engine, database.async_engine.sync_engine]
+        engines.extend(database.message_shards.engines + database.message_shards.read_engines)
+        engines.extend(shard_engine.sync_engine for shard_engine in database.message_shards.async_engines)
+        if message_writer is not None:
+            engines.extend(writer_engine.sync_engine for writer_engine in message_writer.engines)
+        counter = QueryCounter(engines)
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://bench"
+        # ASGITransport не выполняет lifespan - запускаем обработчики startup/shutdown сами
+        await app.router.startup()
+    else:
+        app, counter, transport, base_url = None, None, None, args.url
+
+    print(f"🌱 Наполнение базы: {args.users} пользователей...")
+    data = seed(
+        users=args.users, private_chats_per_user=args.private_chats, groups=args.groups,
+        group_size=args.group_size, messages_per_chat=args.messages, random_seed=args.seed
+    )
+    print(f"   чатов: {len(data.chat_ids)}, сообщений: {data.message_count}")
+
+    results = {}
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60) as client:
+            context = BenchContext(client, data, random_seed=args.seed)
+            for name in args.scenarios:
+                # Сценарии с bcrypt на порядок медленнее - для них отдельное число запросов
+                total = args.auth_requests if name in ("register", "login") else args.requests
+                print(f"🏃 {name}: {total} запросов, {args.concurrency} клиентов")
+                result = await run_scenario(name, context, total, args.concurrency, counter)
+                results[name] = result.to_dict()
+                latency = results[name]["latency_ms"]
+                print(f"   {results[name]['rps']} req/s, p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+                      f"p99 {latency['p99']} ms, ошибок: {result.errors}, "
+                      f"запросов к БД на запрос: {results[name]['db_queries_per_request']}")
+    finally:
+        if app is not None:
+            await app.router.shutdown()
+        # Сидирование пишет через движки приложения и при прогоне по --url
+        from app.database import dispose_engines
+        await dispose_engines()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "target": args.url or "in-process",
+            "database_url": settings.database_url,
+            "ingest_mode": settings.ingest_mode,
+            "inbox_use_summary": settings.inbox_use_summary,
+            "message_shards": settings.message_shards,
+            "sqlite_journal_mode": settings.sqlite_journal_mode,
+            "sqlite_synchronous": settings.sqlite_synchronous,
+        },
+        "params": {
+            "users": args.users,
+            "private_chats_per_user": args.private_chats,
+            "groups": args.groups,
+            "group_size": args.group_size,
+            "messages_per_chat": args.messages,
+            "requests": args.requests,
+            "auth_requests": args.auth_requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "scenarios": results,
+    }
+
+
+def run(args):
+    unknown = set(args.scenarios) - set(DEFAULT_SCENARIOS)
+    if unknown:
+        print(f"❌ Неизвестные сценарии: {', '.join(sorted(unknown))}")
+        sys.exit(2)
+
+    _prepare_environment(args)
+    report = asyncio.run(_run(args))
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"✅ Отчет сохранен: {args.output}")
+
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.candidate, encoding="utf-8") as file:
+        candidate = json.load(file)
+
+    def change(old, new):
+        if old in (None, 0) or new is None:
+            return "    n/a"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"Сравнение {baseline['meta'].get('commit')} -> {candidate['meta'].get('commit')}")
+    print(f"{'сценарий':<10} {'req/s':>16} {'p95, ms':>18} {'p99, ms':>18} {'БД/запрос':>16}")
+    for name, new in candidate["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        print(
+            f"{name:<10} "
+            f"{new['rps']:>8} {change(old['rps'], new['rps'])} "
+            f"{new['latency_ms']['p95']:>9} {change(old['latency_ms']['p95'], new['latency_ms']['p95'])} "
+            f"{new['latency_ms']['p99']:>9} {change(old['latency_ms']['p99'], new['latency_ms']['p99'])} "
+            f"{str(new['db_queries_per_request']):>7} "
+            f"{change(old['db_queries_per_request'], new['db_queries_per_request'])}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API мессенджера")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Наполнить базу и прогнать сценарии")
+    run_parser.add_argument("--users", type=int, default=200)
+    run_parser.add_argument("--private-chats", type=int, default=3, help="Личных чатов, начатых каждым пользователем")
+    run_parser.add_argument("--groups", type=int, default=20)
+    run_parser.add_argument("--group-size", type=int, default=10)
+    run_parser.add_argument("--messages", type=int, default=100, help="Сообщений в каждом чате")
+    run_parser.add_argument("--requests", type=int, default=1000, help="Запросов на сценарий")
+    run_parser.add_argument("--auth-requests", type=int, default=100, help="Запросов для register и login")
+    run_parser.add_argument("--concurrency", type=int, default=20, help="Параллельных клиентов")
+    run_parser.add_argument("--scenarios", nargs="+", default=DEFAULT_SCENARIOS, metavar="NAME",
+                            help=f"Сценарии: {', '.join(DEFAULT_SCENARIOS)}")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--database", default="./bench.db", help="Файл SQLite для прогона внутри процесса")
+    run_parser.add_argument("--keep-db", action="store_true", help="Не пересоздавать базу")
+    run_parser.add_argument("--url", default=None,
+                            help="Адрес запущенного сервера; база наполняется по DATABASE_URL сервера, "
+                                 "запросы к БД не считаются")
+    run_parser.add_argument("--output", default="bench_report.json")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Сравнить два отчета")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
+
+# python -m bench run --users 500 --requests 2000 --output before.json
+# python -m bench run --output after.json
+# python -m bench compare before.json after.json
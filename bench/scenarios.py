@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy import event
+
+from app.auth import create_access_token
+from bench.seed import BENCH_PASSWORD, SeedResult
+
+
+# Подсчет SQL-запросов к базе приложения (только при запуске внутри процесса)
+class QueryCounter:
+    def __init__(self, engines):
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    index = math.ceil(percent / 100 * len(sorted_values)) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int = 0
+    errors: int = 0
+    duration: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    db_queries: Optional[int] = None
+    status_codes: Dict[int, int] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+            "duration_s": round(self.duration, 3),
+            "rps": round(self.requests / self.duration, 1) if self.duration else 0.0,
+            "latency_ms": {
+                "p50": round(_percentile(latencies, 50) * 1000, 2),
+                "p95": round(_percentile(latencies, 95) * 1000, 2),
+                "p99": round(_percentile(latencies, 99) * 1000, 2),
+                "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            },
+            "db_queries": self.db_queries,
+            "db_queries_per_request": (
+                round(self.db_queries / self.requests, 2) if self.db_queries is not None and self.requests else None
+            ),
+        }
+
+
+# Состояние прогона, общее для всех сценариев
+class BenchContext:
+    def __init__(self, client: httpx.AsyncClient, data: SeedResult, random_seed: int = 0):
+        self.client = client
+        self.data = data
+        self.rng = random.Random(random_seed)
+        self.tokens = {
+            user_id: create_access_token({"sub": username}) for user_id, username in data.usernames.items()
+        }
+        # Пользователи, у которых есть хотя бы один чат
+        self.active_users = [user_id for user_id in data.user_ids if data.chats_by_user.get(user_id)]
+        self.register_counter = itertools.count()
+        self.run_id = f"{time.time_ns():x}"[-8:]
+
+    def headers(self, user_id: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+    def random_member(self):
+        """Случайный пользователь и один из его чатов"""
+        user_id = self.rng.choice(self.active_users)
+        return user_id, self.rng.choice(self.data.chats_by_user[user_id])
+
+
+async def scenario_register(context: BenchContext, worker: "Worker") -> httpx.Response:
+    number = next(context.register_counter)
+    username = f"benchnew_{context.run_id}_{number}"
+    return await context.client.post("/api/register", json={
+        "username": username, "email": f"{username}@example.com", "password": BENCH_PASSWORD
+    })
+
+
+async def scenario_login(context: BenchContext, worker: "Worker") -> httpx.Response:
+    user_id = context.rng.choice(context.data.user_ids)
+    return await context.client.post("/api/login", json={
+        "username": context.data.usernames[user_id], "password": BENCH_PASSWORD
+    })
+
+
+async def scenario_inbox(context: BenchContext, worker: "Worker") -> httpx.Response:
+    user_id = context.rng.choice(context.active_users)
+    return await context.client.get("/api/chats", headers=context.headers(user_id))
+
+
+async def scenario_history(context: BenchContext, worker: "Worker") -> httpx.Response:
+    # Клиент листает историю вверх, пока она не закончится, затем открывает другой чат
+    if worker.history_cursor is None:
+        worker.history_user, worker.history_chat = context.random_member()
+        params = {"limit": 50}
+    else:
+        params = {"limit": 50, "before_id": worker.history_cursor}
+
+    response = await context.client.get(
+        f"/api/chats/{worker.history_chat}/messages",
+        params=params, headers=context.headers(worker.history_user)
+    )
+    if response.status_code == 200:
+        page = response.json()
+        worker.history_cursor = page["next_before_id"] if page["has_more"] else None
+    else:
+        worker.history_cursor = None
+    return response
+
+
+async def scenario_send(context: BenchContext, worker: "Worker") -> httpx.Response:
+    user_id, chat_id = context.random_member()
+    return await context.client.post(
+        "/api/messages",
+        data={"chat_id": str(chat_id), "content": f"bench message from {user_id}"},
+        headers=context.headers(user_id)
+    )
+
+
+SCENARIOS: Dict[str, Callable[[BenchContext, "Worker"], Awaitable[httpx.Response]]] = {
+    "register": scenario_register,
+    "login": scenario_login,
+    "inbox": scenario_inbox,
+    "history": scenario_history,
+    "send": scenario_send,
+}
+
+
+# Состояние отдельного клиента (например, позиция в истории чата)
+@dataclass
+class Worker:
+    history_user: Optional[int] = None
+    history_chat: Optional[int] = None
+    history_cursor: Optional[int] = None
+
+
+async def run_scenario(name: str, context: BenchContext, total: int, concurrency: int,
+                       counter: Optional[QueryCounter] = None) -> ScenarioResult:
+    """total запросов сценария, выполняемых concurrency параллельными клиентами"""
+    scenario = SCENARIOS[name]
+    result = ScenarioResult(name=name)
+    issued = itertools.count()
+
+    async def client_loop():
+        worker = Worker()
+        while next(issued) < total:
+            started = time.perf_counter()
+            try:
+                response = await scenario(context, worker)
+                status_code = response.status_code
+            except httpx.HTTPError:
+                status_code = 0
+            result.latencies.append(time.perf_counter() - started)
+            result.requests += 1
+            result.status_codes[status_code] = result.status_codes.get(status_code, 0) + 1
+            if not 200 <= status_code < 300:
+                result.errors += 1
+
+    queries_before = counter.count if counter is not None else None
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    result.duration = time.perf_counter() - started
+    if counter is not None:
+        result.db_queries = counter.count - queries_before
+    return result
@@ -0,0 +1,138 @@
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import insert, select, update, func
+
+from app.database import engine, User, Chat, ChatParticipant, Message, ChatSummary, ChatType, message_shards, \
+    unread_count_source
+from app.auth import hash_password
+from app.sharding import max_message_id, rebalance_messages
+
+BENCH_PASSWORD = "bench-password"
+
+
+@dataclass
+class SeedResult:
+    usernames: Dict[int, str] = field(default_factory=dict)
+    # Пользователь -> его чаты
+    chats_by_user: Dict[int, List[int]] = field(default_factory=dict)
+    message_count: int = 0
+
+    @property
+    def user_ids(self) -> List[int]:
+        return list(self.usernames)
+
+    @property
+    def chat_ids(self) -> List[int]:
+        return sorted({chat_id for chat_ids in self.chats_by_user.values() for chat_id in chat_ids})
+
+
+def _next_id(connection, model) -> int:
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def seed(users: int, private_chats_per_user: int, groups: int, group_size: int,
+         messages_per_chat: int, random_seed: int = 0) -> SeedResult:
+    """Наполнение базы пользователями, личными и групповыми чатами и историей сообщений.
+    Все пользователи получают пароль BENCH_PASSWORD"""
+    rng = random.Random(random_seed)
+    result = SeedResult()
+    # Хэш один на всех: bcrypt на каждого пользователя сделал бы наполнение слишком долгим
+    password_hash = hash_password(BENCH_PASSWORD)
+    started_at = datetime.utcnow() - timedelta(days=30)
+
+    with engine.begin() as connection:
+        user_id = _next_id(connection, User)
+        prefix = f"bench{user_id}"
+        user_rows = []
+        for number in range(users):
+            result.usernames[user_id + number] = f"{prefix}_{number}"
+            user_rows.append({
+                "id": user_id + number,
+                "username": f"{prefix}_{number}",
+                "email": f"{prefix}_{number}@example.com",
+                "password_hash": password_hash,
+                "is_active": True,
+                "created_at": started_at
+            })
+        connection.execute(insert(User), user_rows)
+        user_ids = result.user_ids
+
+        # Личные чаты: каждый пользователь начинает переписку с несколькими случайными собеседниками
+        pairs = set()
+        for member in user_ids:
+            others = [other for other in user_ids if other != member]
+            for other in rng.sample(others, min(private_chats_per_user, len(others))):
+                pairs.add((min(member, other), max(member, other)))
+
+        chat_members: List[tuple] = [(ChatType.PRIVATE, None, list(pair)) for pair in sorted(pairs)]
+        for number in range(groups):
+            members = rng.sample(user_ids, min(group_size, len(user_ids)))
+            chat_members.append((ChatType.GROUP, f"Bench group {number}", members))
+
+        chat_id = _next_id(connection, Chat)
+        chat_rows, participant_rows = [], []
+        for offset, (chat_type, chat_name, members) in enumerate(chat_members):
+            current_chat_id = chat_id + offset
+            is_private = chat_type == ChatType.PRIVATE
+            chat_rows.append({
+                "id": current_chat_id,
+                "chat_type": chat_type,
+                "chat_name": chat_name,
+                "creator_id": members[0],
+                "pair_low_id": min(members) if is_private else None,
+                "pair_high_id": max(members) if is_private else None,
+                "is_active": True,
+                "created_at": started_at,
+                "updated_at": started_at
+            })
+            for member in members:
+                participant_rows.append({
+                    "chat_id": current_chat_id,
+                    "user_id": member,
+                    "is_admin": chat_type == ChatType.GROUP and member == members[0],
+                    "joined_at": started_at
+                })
+                result.chats_by_user.setdefault(member, []).append(current_chat_id)
+        connection.execute(insert(Chat), chat_rows)
+        connection.execute(insert(ChatParticipant), participant_rows)
+
+        message_id = _next_id(connection, Message)
+        if message_shards.enabled:
+            message_id = max(message_id, max_message_id() + 1)
+        summary_rows = []
+        for offset, (_, _, members) in enumerate(chat_members):
+            current_chat_id = chat_id + offset
+            message_rows = []
+            for number in range(messages_per_chat):
+                created_at = started_at + timedelta(minutes=number)
+                message_rows.append({
+                    "id": message_id,
+                    "chat_id": current_chat_id,
+                    "sender_id": rng.choice(members),
+                    "content": f"Benchmark message {number} in chat {current_chat_id}",
+                    "created_at": created_at,
+                    "updated_at": created_at
+                })
+                message_id += 1
+            if message_rows:
+                connection.execute(insert(Message), message_rows)
+            summary_rows.append({
+                "chat_id": current_chat_id,
+                "last_message_id": message_rows[-1]["id"] if message_rows else None,
+                "message_count": len(message_rows)
+            })
+            result.message_count += len(message_rows)
+        connection.execute(insert(ChatSummary), summary_rows)
+        # Курсоры прочтения на нуле - все чужие сообщения непрочитаны
+        connection.execute(update(ChatParticipant).where(
+            ChatParticipant.chat_id >= chat_id
+        ).values(unread_count=unread_count_source()))
+
+    # Сообщения пишутся в основную базу и раскладываются по шардам так же, как при миграции
+    if message_shards.enabled:
+        rebalance_messages()
+
+    return result